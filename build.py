@@ -35,6 +35,7 @@ def build_egg(spec):
     z.writestr('EGG-INFO/entry_points.txt', """[console_scripts]
 ironegg = egginst.main:main
 ironpkg = enstaller.main:main
+ironpkg-serve = enstaller.serve:main
 """)
     z.close()
 
@@ -8,25 +8,57 @@ More text here...
 Egginst class
 -------------
 
-Is instantiated by an argument ARG (see below) and an optional verbose
-keyword argument and has the following methods (for public use):
+Is instantiated by an argument ARG (see below) and the optional keyword
+arguments verbose, workers (number of threads used for extracting), store
+(directory of the shared store of unpacked eggs, whose files are hardlinked
+into the prefix) and prefix (the environment into which the package is
+installed, sys.prefix by default), and has the following methods (for public
+use):
 
-install():
-    Installs the egg, provided by ARG, into the current Python environment
+install(differential=False, staged=False, precompile=False):
+    Installs the egg, provided by ARG, into the current Python environment.
+    A staged install is extracted into a staging directory first, and
+    rolled back when it fails.  With precompile, the .py files are
+    byte-compiled (in parallel), and the .pyc files recorded.
 
-remove():
+remove(rmdirs=True, defer=False):
     Remove an installed package.  The ARG may be:
        * the full path of the egg which was used during the install
        * the egg name
        * or simply the project name
+    When defer is True, the files are moved into the trash directory of
+    the prefix (mostly a single rename per top-level directory), instead of
+    being deleted.
 
 
 Functions:
 ----------
 
-get_installed():
-    Generator returns a sorted list of all installed packages.
+remove_dirs(eggs):
+    Remove the directories which became empty when the packages of the
+    EggInst objects were removed using remove(rmdirs=False), in a single
+    pass.
+
+install_batch(eggs, workers=4, differential=False, staged=False,
+              precompile=False):
+    Install the eggs of a list of EggInst objects concurrently, except the
+    ones whose files overlap, with the same result as installing them one
+    after another.
+
+purge_trash(background=False, prefix=None):
+    Delete the packages in the trash directory, optionally in a (returned)
+    background thread.
+
+recover(cname=None, verbose=False, prefix=None):
+    Recover interrupted staged installs, i.e. roll the committed ones
+    forward, and discard the others.
+
+get_installed(prefix=None):
+    Generator returns a sorted list of all installed packages (in prefix).
     Each element is the filename of the egg which was used to install the
     package.
 """
-from egginst.main import EggInst, get_installed, name_version_fn
+from egginst.main import (EggInst, get_installed, install_batch,
+                          name_version_fn, remove_dirs)
+from egginst.staging import recover
+from egginst.utils import purge_trash
@@ -0,0 +1,172 @@
+"""
+Advisory file locks, which allow several processes to work on the same
+prefix, or the same local repository.  The lock is held on an open lock
+file (using fcntl.flock on Unix, and msvcrt.locking on Windows), such that
+it is released by the operating system when the process dies.  Where
+neither is available (e.g. IronPython), the lock file is created
+exclusively, and removed when the lock is released.
+
+Information about the holder of a lock (process id, host, time and
+command) is written to the file path + '.info', and is displayed while
+waiting for the lock, or when the timeout expires.
+
+Locks created with remove=True (e.g. the locks of the many files in the
+local repository) remove their files when they are released.  On Unix,
+another process may have opened the lock file just before it was removed,
+so a lock is only considered acquired if the locked file is (still) the
+one at the path.  On Windows, the file is only removed when no other
+process has it open.
+"""
+import os
+import sys
+import time
+import socket
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+# seconds to wait for a lock before giving up, None means wait forever
+DEFAULT_TIMEOUT = 600
+
+
+class LockError(Exception):
+    pass
+
+
+class FileLock(object):
+
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT, verbose=True,
+                 remove=False):
+        self.path = path
+        self.timeout = timeout
+        self.verbose = verbose
+        self.remove = remove
+        self.fd = None
+
+    def holder(self):
+        """
+        Returns a string describing the holder of the lock, as far as it is
+        known.
+        """
+        try:
+            fi = open(self.path + '.info')
+            info = fi.read().strip()
+            fi.close()
+        except IOError:
+            info = ''
+        return info or 'unknown'
+
+    def try_lock(self):
+        """
+        Try to acquire the lock without blocking, return True on success.
+        """
+        if fcntl is None and msvcrt is None:
+            try:
+                self.fd = os.open(self.path,
+                                  os.O_CREAT | os.O_EXCL | os.O_RDWR)
+            except OSError:
+                return False
+            return True
+
+        fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        try:
+            if fcntl:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError):
+            os.close(fd)
+            return False
+        if fcntl and not self.same_file(fd):
+            # removed (or replaced) by the previous holder
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def same_file(self, fd):
+        try:
+            return os.fstat(fd).st_ino == os.stat(self.path).st_ino
+        except OSError:
+            return False
+
+    def acquire(self):
+        dn = os.path.dirname(self.path)
+        if dn and not os.path.isdir(dn):
+            os.makedirs(dn)
+        t0 = time.time()
+        delay = 0.05
+        waiting = False
+        while not self.try_lock():
+            if not waiting and self.verbose:
+                print "Waiting for lock %s, held by: %s" % (self.path,
+                                                           self.holder())
+                waiting = True
+            if (self.timeout is not None and
+                        time.time() - t0 > self.timeout):
+                msg = ("Timeout (%s sec) waiting for lock %s, held by: %s" %
+                       (self.timeout, self.path, self.holder()))
+                if fcntl is None and msvcrt is None:
+                    msg += " (if the process is gone, remove the lock file)"
+                raise LockError(msg)
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
+
+        try:
+            fo = open(self.path + '.info', 'w')
+            fo.write('pid %i on %s since %s: %s\n' % (
+                    os.getpid(), socket.gethostname(), time.ctime(),
+                    ' '.join(sys.argv)))
+            fo.close()
+        except IOError:
+            pass
+
+    def release(self):
+        if self.fd is None:
+            return
+        if fcntl is None and msvcrt is None:
+            self.remove_info()
+            os.close(self.fd)
+            os.unlink(self.path)
+        else:
+            if self.remove:
+                self.remove_info()
+            if fcntl and self.remove:
+                # while holding the lock, see try_lock()
+                os.unlink(self.path)
+            if fcntl:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self.fd, 0, 0)
+                msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+            os.close(self.fd)
+            if msvcrt and self.remove:
+                # fails while another process has the file open
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+        self.fd = None
+
+    def remove_info(self):
+        try:
+            os.unlink(self.path + '.info')
+        except OSError:
+            pass
+
+
+def prefix_lock(prefix=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Returns the (not yet acquired) lock of the prefix, which is held while
+    packages are installed or removed.
+    """
+    return FileLock(os.path.join(prefix or sys.prefix, '.ironpkg.lock'),
+                    timeout)
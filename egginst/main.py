@@ -8,13 +8,23 @@ are responsibilities of a package manager, e.g. enpkg.  You just give it
 eggs and it installs/uninstalls them.
 """
 import os
+import re
 import sys
+import Queue
+import threading
 import zipfile
+import tempfile
+import py_compile
 import ConfigParser
-from os.path import abspath, basename, dirname, join, isdir, isfile
+from os.path import (abspath, basename, dirname, expanduser, getsize, join,
+                     isdir, isfile, islink)
 
-from egginst.utils import pprint_fn_action, rmdir_er, rm_rf, human_bytes
+from egginst.utils import (pprint_fn_action, prune_dirs, rm_rf, human_bytes,
+                           write_member, mk_trash_dir, crc32_file, md5_file,
+                           ProgressBar)
 from egginst import scripts
+from egginst.staging import Transaction, recover
+from egginst.locking import DEFAULT_TIMEOUT, LockError, prefix_lock
 
 
 def name_version_fn(fn):
@@ -31,43 +41,207 @@ def name_version_fn(fn):
 
 class EggInst(object):
 
-    def __init__(self, fpath, verbose=False):
+    def __init__(self, fpath, verbose=False, workers=1, store=None,
+                 prefix=None, md5=None):
         self.fpath = fpath
         self.cname = name_version_fn(basename(fpath))[0].lower()
+        # the prefix (environment) into which the package is installed
+        self.prefix = abspath(prefix or sys.prefix)
 
         # This is the directory which contains the EGG-INFO directories of all
         # installed packages
-        self.meta_dir = join(sys.prefix, 'EGG-INFO', self.cname)
+        self.meta_dir = join(self.prefix, 'EGG-INFO', self.cname)
         self.meta_txt = join(self.meta_dir, '__egginst__.txt')
-        self.bin_dir = sys.prefix
-        self.site_packages = join(sys.prefix, r'Lib\site-packages')
+        self.bin_dir = self.prefix
+        self.site_packages = join(self.prefix, r'Lib\site-packages')
+        # the interpreter of the prefix, which scripts are made to use
+        if self.prefix == abspath(sys.prefix):
+            self.executable = sys.executable
+        else:
+            self.executable = join(self.bin_dir, basename(sys.executable))
 
         self.files = []
+        # maps paths of files extracted from the egg to tuple(size, CRC32)
+        self.file_info = {}
+        # the same for the previously installed version (differential)
+        self.old_info = {}
+        # maps paths of files whose data differs from the archive (scripts
+        # whose hashbang was fixed) to the tuple(size, CRC32) of the archive,
+        # which is what is compared in a differential upgrade
+        self.member_info = {}
+        self.old_member_info = {}
         self.verbose = verbose
+        # number of threads used to extract the egg
+        self.workers = workers
+        # the transaction of a staged install
+        self.transaction = None
+        # the shared store of unpacked eggs (see populate_store()), and the
+        # directory of this egg in it
+        self.store = store
+        self.store_dir = None
+        # the md5 of the egg (when known already), which names its directory
+        # in the store
+        self.md5 = md5
+        self.store_scripts = set()
+        # maps archive names to files extracted already, while the egg was
+        # downloaded (see egginst.stream)
+        self.prestaged = {}
+        self.show_progress = True
+        # in batch mode (see install_batch()), the event which is set once
+        # the post-install scripts of the previous eggs have been run
+        self.post_event = None
 
     def rel_prefix(self, path):
-        assert abspath(path).startswith(sys.prefix)
-        return path[len(sys.prefix) + 1:]
+        assert abspath(path).startswith(self.prefix)
+        return path[len(self.prefix) + 1:]
 
 
-    def install(self):
+    def install(self, differential=False, staged=False, precompile=False):
+        """
+        Install the egg.  When differential is True, and another version
+        of the package is installed, the package is upgraded in place:
+        only files which changed (according to the size and CRC32 recorded
+        when the old version was installed) are written, and files which
+        are no longer part of the package are removed afterwards.  When
+        staged is True, the egg is extracted into a staging directory, and
+        the files are then moved into place, such that the install is
+        rolled back when it fails (see egginst.staging).  When precompile
+        is True, the .py files of the package are byte-compiled after the
+        install, see compile().
+        """
+        if staged:
+            recover(self.cname, self.verbose, self.prefix)
+            self.transaction = Transaction(self.cname, self.prefix)
+
+        old_files = []
+        if differential and isfile(self.meta_txt):
+            self.read_meta()
+            old_files = self.files
+            self.old_info = self.file_info
+            self.old_member_info = self.member_info
+            self.files = []
+            self.file_info = {}
+            self.member_info = {}
+            self.run('pre_egguninst.py')
+
         if not isdir(self.meta_dir):
             os.makedirs(self.meta_dir)
 
         self.z = zipfile.ZipFile(self.fpath)
         self.arcnames = self.z.namelist()
 
-        self.extract()
+        if not staged:
+            self.extract()
+            self.complete(precompile)
+        else:
+            try:
+                self.extract()
+            except:
+                self.z.close()
+                self.transaction.finish()
+                raise
+            self.transaction.commit()
+            self.transaction.add_generated(self.generated_files())
+            try:
+                self.complete(precompile)
+            except:
+                self.roll_back()
+                raise
+            self.transaction.write_journal('completed')
+            self.transaction.finish()
+
+        if old_files:
+            self.remove_stale(old_files)
 
+
+    def complete(self, precompile=False):
+        """
+        Complete the install, after the egg was extracted.
+        """
         scripts.create_proxies(self)
 
         self.entry_points()
         self.z.close()
+        if self.transaction:
+            # the files created above, which did not exist before
+            self.transaction.add_generated(self.files, backup=False)
         scripts.fix_scripts(self)
-        self.run('post_egginst.py')
+        if precompile:
+            self.compile()
+        if self.post_event:
+            self.post_event.wait()
+        if self.run('post_egginst.py') and self.transaction:
+            raise Exception("post_egginst.py of %s failed" % self.cname)
         self.write_meta()
 
 
+    def roll_back(self):
+        """
+        Roll back a staged install, after the staged files were moved into
+        place.
+        """
+        # the files created after the files were moved into place
+        self.transaction.add_generated(self.files, backup=False)
+        self.transaction.roll_back(self.roots())
+        if not isfile(self.meta_txt):
+            # the package was not installed before
+            rm_rf(self.meta_dir)
+
+
+    def generated_files(self):
+        """
+        Returns the list of files which complete() may (re-)generate:  the
+        metadata, and the files of the installed version which were not
+        extracted from the egg (entry point scripts, proxies, ...), except
+        compiled files.
+        """
+        res = [self.meta_txt, join(self.meta_dir, '__entry_points__.txt')]
+        res.extend(p for p in self.installed_files()
+                   if not p.endswith(('.pyc', '.pyo')))
+        return res
+
+    def installed_files(self):
+        """
+        Returns the list of files recorded by the installed version of the
+        package (if any).
+        """
+        if not isfile(self.meta_txt):
+            return []
+        d = {}
+        execfile(self.meta_txt, d)
+        return [join(self.prefix, f) for f in d['rel_files']]
+
+
+    def compile(self, workers=None):
+        """
+        Byte-compile the .py files of the package (not the ones in its
+        EGG-INFO directory) using a pool of workers processes, and add the
+        .pyc files to self.files, such that they are removed exactly along
+        with the package.
+        """
+        paths = [p for p in self.files
+                 if p.endswith('.py') and not p.startswith(self.meta_dir)]
+        files = set(self.files)
+        for path in compile_files(paths, workers):
+            if path and path not in files:
+                self.files.append(path)
+
+
+    def remove_stale(self, old_files):
+        """
+        Remove the files of a previously installed version, which are not
+        part of this install.
+        """
+        new = set(self.files)
+        new.add(self.meta_txt)
+        stale = [p for p in old_files if p not in new]
+        for p in stale:
+            rm_rf(p)
+            if p.endswith('.py') and isfile(p + 'c'):
+                rm_rf(p + 'c')
+        self.rmdirs(stale)
+
+
     def entry_points(self):
         lines = list(self.lines_from_arcname('EGG-INFO/entry_points.txt',
                                              ignore_empty=False))
@@ -93,21 +267,41 @@ class EggInst(object):
         fo = open(self.meta_txt, 'w')
         fo.write('# egginst metadata\n')
         fo.write('egg_name = %r\n' % basename(self.fpath))
-        fo.write('prefix = %r\n' % sys.prefix)
+        fo.write('prefix = %r\n' % self.prefix)
         fo.write('installed_size = %i\n' % self.installed_size)
         fo.write('rel_files = [\n')
         fo.write('  %r,\n' % self.rel_prefix(self.meta_txt))
         for f in self.files:
             fo.write('  %r,\n' % self.rel_prefix(f))
         fo.write(']\n')
+        # tuples(size, CRC32) of the files extracted from the egg
+        fo.write('file_info = {\n')
+        for f in self.files:
+            if f in self.file_info:
+                fo.write('  %r: (%i, %i),\n' % ((self.rel_prefix(f),) +
+                                                self.file_info[f]))
+        fo.write('}\n')
+        # the same for the archives of files whose data differs from them
+        fo.write('member_info = {\n')
+        for f in self.files:
+            if f in self.member_info:
+                fo.write('  %r: (%i, %i),\n' % ((self.rel_prefix(f),) +
+                                                self.member_info[f]))
+        fo.write('}\n')
         fo.close()
 
     def read_meta(self):
-        d = {'installed_size': -1}
+        d = {'installed_size': -1, 'file_info': {}, 'member_info': {}}
         execfile(self.meta_txt, d)
-        for name in ['egg_name', 'prefix', 'installed_size', 'rel_files']:
+        for name in ['egg_name', 'installed_size', 'rel_files']:
             setattr(self, name, d[name])
-        self.files = [join(sys.prefix, f) for f in d['rel_files']]
+        # the prefix may have been moved (or copied) since the install, so
+        # the files are always relative to self.prefix (not the recorded one)
+        self.files = [join(self.prefix, f) for f in d['rel_files']]
+        self.file_info = dict((join(self.prefix, f), info)
+                              for f, info in d['file_info'].iteritems())
+        self.member_info = dict((join(self.prefix, f), info)
+                                for f, info in d['member_info'].iteritems())
 
 
     def lines_from_arcname(self, arcname,
@@ -125,29 +319,141 @@ class EggInst(object):
 
 
     def extract(self):
-        cur = n = 0
         size = sum(self.z.getinfo(name).file_size for name in self.arcnames)
-        sys.stdout.write('%9s [' % human_bytes(size))
-        for name in self.arcnames:
-            n += self.z.getinfo(name).file_size
-            if size == 0:
-                rat = 1
-            else:
-                rat = float(n) / size
-            if rat * 64 >= cur:
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                cur += 1
-            self.write_arcname(name)
+        progress = ProgressBar(size, self.show_progress)
+        plan = self.prepare()
+        if self.store and 'EGG-INFO/post_egginst.py' not in self.arcnames:
+            # the post-install script may modify the installed files in
+            # place, which would modify the store (and every prefix linked
+            # to it), so such eggs are always written
+            self.populate_store()
+        if self.transaction:
+            plan = self.transaction.stage(plan)
+        if self.prestaged:
+            plan = self.use_prestaged(plan, progress)
+        if self.workers > 1:
+            self.extract_parallel(plan, progress)
+        else:
+            for arcname, path, exists in plan:
+                progress.update(self.z.getinfo(arcname).file_size)
+                self.write_file(self.z, arcname, path, exists)
 
         self.installed_size = size
-        sys.stdout.write('.' * (65-cur) + ']\n')
-        sys.stdout.flush()
+        progress.finish()
+
+
+    def prepare(self):
+        """
+        Determine the destination paths of all archives, add them to
+        self.files (in archive order), and create the directories they go
+        into.  Returns a list of tuples(arcname, path, exists) of the files
+        to be written, where exists tells whether a file (which needs to be
+        removed first) exists at the path.  This is determined by listing
+        each directory once, instead of checking every single path.
+        Existing files which are unchanged since the previous install (in a
+        differential upgrade) are not written again.
+        """
+        items = []
+        dirs = set()
+        for arcname in self.arcnames:
+            path = self.dst_arcname(arcname)
+            if path is None:
+                continue
+            self.files.append(path)
+            zinfo = self.z.getinfo(arcname)
+            info = self.file_info[path] = zinfo.file_size, zinfo.CRC
+            items.append((arcname, path, info))
+            dirs.add(dirname(path))
+
+        existing = set()
+        for dn in sorted(dirs):
+            if isdir(dn):
+                existing.update(join(dn, fn) for fn in os.listdir(dn))
+            else:
+                try:
+                    os.makedirs(dn)
+                except OSError:
+                    # created concurrently by another egg (batch mode)
+                    if not isdir(dn):
+                        raise
+
+        plan = []
+        for arcname, path, info in items:
+            exists = path in existing
+            old = self.old_member_info.get(path, self.old_info.get(path))
+            if exists and old == info:
+                # unchanged since the previous install (differential upgrade)
+                if path in self.old_member_info:
+                    # the file (with its fixed hashbang) is kept as is
+                    self.member_info[path] = info
+                    self.file_info[path] = self.old_info[path]
+                continue
+            plan.append((arcname, path, exists))
+        return plan
+
+
+    def use_prestaged(self, plan, progress):
+        """
+        Move the files which were extracted while the egg was downloaded
+        into place, and return the rest of the plan.  Files in the bin
+        directory whose hashbang needs to be fixed are written again.
+        """
+        rest = []
+        for arcname, path, exists in plan:
+            src = self.prestaged.get(arcname)
+            if src is None or (
+                    self.get_dst(arcname).startswith(self.bin_dir) and
+                    scripts.needs_fix(src, self.executable)):
+                rest.append((arcname, path, exists))
+                continue
+            if exists:
+                rm_rf(path)
+            os.rename(src, path)
+            if (arcname.startswith('EGG-INFO/scripts/') or
+                    arcname.endswith('.pyd')):
+                os.chmod(path, 0755)
+            progress.update(self.z.getinfo(arcname).file_size)
+        return rest
+
+
+    def extract_parallel(self, plan, progress):
+        """
+        Extract the egg using several threads, each of which opens its own
+        zip-file object.
+        """
+        q = Queue.Queue()
+        for item in plan:
+            q.put(item)
+
+        errors = []
+        def worker():
+            z = zipfile.ZipFile(self.fpath)
+            try:
+                while not errors:
+                    try:
+                        arcname, path, exists = q.get_nowait()
+                    except Queue.Empty:
+                        return
+                    self.write_file(z, arcname, path, exists)
+                    progress.update(z.getinfo(arcname).file_size)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                z.close()
+
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(self.workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
 
 
     def get_dst(self, arcname):
         for start, cond, dst_dir in [
-            ('EGG-INFO/prefix/',  True,       sys.prefix),
+            ('EGG-INFO/prefix/',  True,       self.prefix),
             ('EGG-INFO/scripts/', True,       self.bin_dir),
             ('EGG-INFO/',         True,       self.meta_dir),
             ('',                  True,       self.site_packages),
@@ -156,45 +462,149 @@ class EggInst(object):
                 return abspath(join(dst_dir, arcname[len(start):]))
         raise Exception("Didn't expect to get here")
 
-    def write_arcname(self, arcname):
+    def dst_arcname(self, arcname):
+        """
+        Returns the destination path of an archive, or None if the archive
+        is not installed.
+        """
         if arcname.endswith('/') or arcname.startswith('.unused'):
+            return None
+        return self.get_dst(arcname)
+
+    def write_file(self, z, arcname, path, exists=True):
+        if exists:
+            rm_rf(path)
+        if self.link_file(arcname, path):
             return
-        path = self.get_dst(arcname)
-        dn, fn = os.path.split(path)
-        data = self.z.read(arcname)
-
-        self.files.append(path)
-        if not isdir(dn):
-            os.makedirs(dn)
-        rm_rf(path)
-        fo = open(path, 'wb')
-        fo.write(data)
-        fo.close()
-        if arcname.startswith(('EGG-INFO/scripts/')) or fn.endswith('.pyd'):
+        dst = self.get_dst(arcname)
+        if dst.startswith(self.bin_dir):
+            # goes into the bin directory, fix the hashbang while writing
+            # (path may be a staged path)
+            if scripts.write_script_member(z, arcname, path,
+                                           self.executable):
+                # record the size and CRC32 of the data actually written
+                self.member_info[dst] = self.file_info[dst]
+                self.file_info[dst] = getsize(path), crc32_file(path)
+        else:
+            write_member(z, arcname, path)
+        if arcname.startswith('EGG-INFO/scripts/') or arcname.endswith('.pyd'):
             os.chmod(path, 0755)
 
+    def populate_store(self):
+        """
+        Extract the egg into its directory in the store, which is named by
+        the md5 of the egg, unless this was done before (possibly for
+        another prefix).  Only files which may be hardlinked into a prefix
+        are extracted, i.e. not the EGG-INFO metadata and scripts, and
+        files with a python hashbang (which is rewritten when installing)
+        are recorded in a list next to the directory.  The files in the
+        store are read-only, such that writing to an installed (linked)
+        file fails, instead of modifying all prefixes it is linked into.
+        """
+        if self.md5 is None:
+            self.md5 = md5_file(self.fpath)
+        self.store_dir = join(self.store, self.md5)
+        scripts_txt = self.store_dir + '.scripts'
+        if not isdir(self.store_dir):
+            if not isdir(self.store):
+                os.makedirs(self.store)
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.store)
+            fo = open(tmp_dir + '.scripts', 'w')
+            for arcname in self.arcnames:
+                if arcname.endswith('/') or not self.linkable(arcname):
+                    continue
+                path = join(tmp_dir, *arcname.split('/'))
+                if not isdir(dirname(path)):
+                    os.makedirs(dirname(path))
+                if scripts.write_store_member(self.z, arcname, path):
+                    fo.write(arcname + '\n')
+                if arcname.endswith('.pyd'):
+                    os.chmod(path, 0555)
+                else:
+                    os.chmod(path, 0444)
+            fo.close()
+            # the list is the same for any process populating the directory,
+            # and is moved into place first, such that it exists whenever
+            # the directory does
+            try:
+                os.rename(tmp_dir + '.scripts', scripts_txt)
+            except OSError:
+                # exists already (Windows)
+                rm_rf(tmp_dir + '.scripts')
+            try:
+                os.rename(tmp_dir, self.store_dir)
+            except OSError:
+                # populated concurrently by another process
+                rm_rf(tmp_dir)
+
+        self.store_scripts = set(open(scripts_txt).read().splitlines())
+
+    def linkable(self, arcname):
+        return (arcname.startswith('EGG-INFO/prefix/') or
+                not arcname.startswith('EGG-INFO/'))
+
+    def link_file(self, arcname, path):
+        """
+        Hardlink the file arcname from the store to path, and return True,
+        or return False when the file needs to be written instead.
+        """
+        if not (self.store_dir and self.linkable(arcname)) or \
+                arcname in self.store_scripts:
+            return False
+        try:
+            os.link(join(self.store_dir, *arcname.split('/')), path)
+        except (AttributeError, OSError):
+            return False
+        return True
+
     def run(self, fn):
         path = join(self.meta_dir, fn)
         if not isfile(path):
             return
         from subprocess import call
-        call([sys.executable, path, '--prefix', sys.prefix],
-             cwd=dirname(path))
+        # the interpreter of the prefix may not be installed (yet)
+        exe = self.executable
+        if not isfile(exe):
+            exe = sys.executable
+        return call([exe, path, '--prefix', self.prefix],
+                    cwd=dirname(path))
 
-    def rmdirs(self):
+    def roots(self):
         """
-        Remove empty directories for the files in self.files recursively
+        Returns the set of directories into which packages are installed,
+        which are never removed.
         """
-        for path in set(dirname(p) for p in self.files):
-            if isdir(path):
-                rmdir_er(path)
+        return set([self.prefix, self.bin_dir, self.site_packages,
+                    join(self.prefix, 'EGG-INFO')])
 
-    def remove(self):
+    def rmdirs(self, files=None):
+        """
+        Remove the directories of the files (self.files by default), which
+        are empty now
+        """
+        if files is None:
+            files = self.files
+        prune_dirs(files, self.roots())
+
+    def remove(self, rmdirs=True, defer=False):
+        """
+        Remove the installed package.  When rmdirs is False, the directories
+        which became empty are not removed, see remove_dirs() below.  When
+        defer is True, the files are only moved into the trash directory,
+        see move_to_trash().
+        """
         if not isdir(self.meta_dir):
             print "Error: Can't find meta data for:", self.cname
             return
 
         self.read_meta()
+        if defer:
+            self.run('pre_egguninst.py')
+            self.move_to_trash()
+            if rmdirs:
+                self.rmdirs()
+            return
+
         cur = n = 0
         nof = len(self.files) # number of files
         sys.stdout.write('%9s [' % human_bytes(self.installed_size))
@@ -209,21 +619,241 @@ class EggInst(object):
                 cur += 1
             rm_rf(p)
             if p.endswith('.py') and isfile(p + 'c'):
-                # remove the corresponding .pyc
+                # remove the corresponding .pyc (unless it was recorded
+                # by compile(), it was created when importing the module)
                 rm_rf(p + 'c')
-        self.rmdirs()
+        if rmdirs:
+            self.rmdirs()
         rm_rf(self.meta_dir)
         sys.stdout.write('.' * (65-cur) + ']\n')
         sys.stdout.flush()
 
+    def top_dir(self, path):
+        """
+        Returns the top-level directory of path, i.e. the directory right
+        below the (innermost) root containing the path, or None if the path
+        is directly in a root, or the directory contains a root itself.
+        """
+        roots = self.roots()
+        for root in sorted(roots, key=len, reverse=True):
+            if not (path.startswith(root) and
+                    path[len(root):len(root) + 1] in ('/', '\\')):
+                continue
+            parts = re.split(r'[/\\]', path[len(root) + 1:], 1)
+            if len(parts) == 1:
+                return None
+            top = join(root, parts[0])
+            for r in roots:
+                if r == top or (r.startswith(top) and
+                                r[len(top)] in ('/', '\\')):
+                    return None
+            return top
+        return None
 
-def get_installed():
+    def owns_dir(self, dir_path, files):
+        """
+        Returns True if all files below dir_path (recursively) are in the
+        set files (or are the compiled files of the .py files in files).
+        """
+        for root, dirs, fns in os.walk(dir_path):
+            for fn in fns + [d for d in dirs if islink(join(root, d))]:
+                p = join(root, fn)
+                if p in files:
+                    continue
+                if p.endswith(('.pyc', '.pyo')) and p[:-1] in files:
+                    continue
+                return False
+        return True
+
+    def move_to_trash(self):
+        """
+        Move the files of the installed package (whose metadata must have
+        been read already) into a new directory in the trash, which is
+        deleted later using egginst.utils.purge_trash().  Each top-level
+        directory, which contains nothing but files of this package, is
+        moved using a single rename, and the remaining files one by one,
+        such that no files of other packages (or the user) are moved.
+        """
+        files = set(self.files)
+        owned = {}
+        dst_dir = mk_trash_dir(self.cname, self.prefix)
+        moved = set()
+        def move(src):
+            dst = join(dst_dir, '%i_%s' % (len(moved), basename(src)))
+            moved.add(src)
+            try:
+                os.rename(src, dst)
+            except OSError:
+                rm_rf(src)
+
+        for p in self.files:
+            top = self.top_dir(p)
+            if top is not None:
+                if top not in owned:
+                    owned[top] = self.owns_dir(top, files)
+                if owned[top]:
+                    if top not in moved:
+                        move(top)
+                    continue
+            if isfile(p):
+                move(p)
+            if p.endswith('.py') and isfile(p + 'c'):
+                move(p + 'c')
+        rm_rf(self.meta_dir)
+
+
+def compile_file(path):
+    """
+    Byte-compile the file at path, and return the path of the compiled
+    file, or None if the file could not be compiled.
+    """
+    try:
+        py_compile.compile(path, doraise=True)
+    except (py_compile.PyCompileError, IOError):
+        return None
+    return path + (__debug__ and 'c' or 'o')
+
+
+def compile_files(paths, workers=None):
+    """
+    Byte-compile the files, in parallel using a process pool when the
+    multiprocessing module is available, and return the list of the
+    results of compile_file() above.
+    """
+    try:
+        import multiprocessing
+    except ImportError:
+        # e.g. IronPython
+        return map(compile_file, paths)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers < 2 or len(paths) < 2:
+        return map(compile_file, paths)
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(compile_file, paths,
+                        max(1, len(paths) / (4 * workers)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def remove_dirs(eggs):
+    """
+    Remove the directories which became empty when the packages of the
+    EggInst objects were removed (using remove(rmdirs=False)) in a single
+    pass, instead of once for each package.
     """
-    Generator returns a sorted list of all installed packages.
+    files = []
+    roots = set()
+    for ei in eggs:
+        files.extend(ei.files)
+        roots.update(ei.roots())
+    prune_dirs(files, roots)
+
+
+def batch_deps(eggs, differential=False):
+    """
+    Returns a list containing, for each of the eggs (EggInst objects), the
+    set of indices of the earlier eggs, whose paths overlap with its paths.
+    The paths of an egg are the destination paths of its namelist(), its
+    metadata, the scripts it generates, and (in a differential upgrade) the
+    files of the installed version, which may be removed.
+    """
+    deps = []
+    owner = {}
+    for i, ei in enumerate(eggs):
+        z = zipfile.ZipFile(ei.fpath)
+        paths = set(ei.dst_arcname(arcname) for arcname in z.namelist())
+        paths.update(scripts.script_paths(ei, z))
+        z.close()
+        paths.discard(None)
+        paths.add(ei.meta_txt)
+        if differential:
+            paths.update(ei.installed_files())
+        deps.append(set(owner[p] for p in paths if p in owner))
+        for p in paths:
+            owner[p] = i
+    return deps
+
+
+def install_batch(eggs, workers=4, differential=False, staged=False,
+                  precompile=False):
+    """
+    Install the eggs (a list of EggInst objects) concurrently, using a pool
+    of worker threads.  An egg is only installed once all earlier eggs (in
+    the given order) with overlapping paths (see batch_deps()) have been
+    installed.  The
+    post-install scripts are run in the given order, such that the result
+    is the same as installing the eggs one after another.
+    """
+    deps = batch_deps(eggs, differential)
+    done = [threading.Event() for ei in eggs]
+    for i, ei in enumerate(eggs):
+        ei.show_progress = False
+        if i > 0:
+            ei.post_event = done[i - 1]
+
+    cond = threading.Condition()
+    pending = range(len(eggs))
+    finished = set()
+    errors = []
+
+    def next_egg():
+        # the first pending egg (which is ready, since all the eggs it
+        # depends on are earlier) is always picked before later ones
+        cond.acquire()
+        try:
+            while pending and not errors:
+                for i in pending:
+                    if deps[i] <= finished:
+                        pending.remove(i)
+                        return i
+                cond.wait()
+            return None
+        finally:
+            cond.release()
+
+    def worker():
+        while True:
+            i = next_egg()
+            if i is None:
+                return
+            ei = eggs[i]
+            pprint_fn_action(basename(ei.fpath), 'installing')
+            try:
+                ei.install(differential, staged, precompile)
+            except Exception:
+                errors.append(sys.exc_info())
+            cond.acquire()
+            finished.add(i)
+            done[i].set()
+            if errors:
+                # no more eggs are installed, don't let the running ones
+                # wait for them
+                for event in done:
+                    event.set()
+            cond.notifyAll()
+            cond.release()
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(workers, len(eggs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def get_installed(prefix=None):
+    """
+    Generator returns a sorted list of all installed packages (in prefix,
+    which defaults to sys.prefix).
     Each element is the filename of the egg which was used to install the
     package.
     """
-    egg_info_dir = join(sys.prefix, 'EGG-INFO')
+    egg_info_dir = join(prefix or sys.prefix, 'EGG-INFO')
     if not isdir(egg_info_dir):
         return
 
@@ -236,11 +866,11 @@ def get_installed():
         yield d['egg_name']
 
 
-def print_installed():
+def print_installed(prefix=None):
     fmt = '%-20s %s'
     print fmt % ('Project name', 'Version')
     print 40 * '='
-    for fn in get_installed():
+    for fn in get_installed(prefix):
         print fmt % name_version_fn(fn)
 
 
@@ -250,19 +880,93 @@ def main():
     p = OptionParser(usage="usage: %prog [options] [EGGS ...]",
                      description=__doc__)
 
+    p.add_option("--differential",
+                 action="store_true",
+                 help="when another version of a package is installed, only "
+                      "write the files which changed, and remove the ones "
+                      "which are no longer part of the package")
+
+    p.add_option("--batch",
+                 action="store_true",
+                 help="install the eggs concurrently (--jobs at a time, "
+                      "default 4), except ones which have files in common, "
+                      "and run their post-install scripts in order")
+
+    p.add_option("--compile",
+                 action="store_true",
+                 help="byte-compile the .py files of the installed eggs "
+                      "(using a pool of processes, one for each CPU), and "
+                      "record the .pyc files")
+
+    p.add_option("--crc",
+                 action="store_true",
+                 help="when verifying, compute the CRC32 of all files, "
+                      "not just the ones modified after the install")
+
+    p.add_option('-j', "--jobs",
+                 action="store",
+                 type="int",
+                 help="number of threads used to extract each egg "
+                      "(default 1), or to install eggs in batch mode, or to "
+                      "verify packages (default 4)",
+                 metavar='N')
+
     p.add_option('-l', "--list",
                  action="store_true",
                  help="list all installed packages")
 
+    p.add_option("--lock-timeout",
+                 action="store",
+                 type="float",
+                 default=DEFAULT_TIMEOUT,
+                 help="seconds to wait for other processes installing into "
+                      "the same prefix (default %default)",
+                 metavar='SEC')
+
+    p.add_option("--prefix",
+                 action="store",
+                 help="install prefix, i.e. the environment into which eggs "
+                      "are installed (default: sys.prefix)",
+                 metavar='PATH')
+
+    p.add_option("--recover",
+                 action="store_true",
+                 help="recover interrupted staged installs, i.e. roll "
+                      "committed ones forward, and discard the others")
+
     p.add_option('-r', "--remove",
                  action="store_true",
                  help="remove package(s), requires the egg or project name(s)")
 
+    p.add_option("--staged",
+                 action="store_true",
+                 help="extract each egg into a staging directory first, and "
+                      "move the files into place afterwards, such that a "
+                      "failed install is rolled back")
+
+    p.add_option("--store",
+                 action="store",
+                 help="extract each egg once into the directory DIR (shared "
+                      "by several prefixes), and install (read-only) hardlinks "
+                      "to its files, except for scripts, metadata and eggs "
+                      "with a post-install script",
+                 metavar='DIR')
+
+    p.add_option("--verify",
+                 action="store_true",
+                 help="verify the files of the installed package(s) given "
+                      "by name (all packages by default), and report files "
+                      "which are modified, missing or extra")
+
     p.add_option('-v', "--verbose", action="store_true")
     p.add_option('-n', "--dry-run", action="store_true")
     p.add_option('--version', action="store_true")
 
     opts, args = p.parse_args()
+    if opts.prefix:
+        # the prefix is compared with (absolute) paths, and identifies the
+        # lock of the prefix
+        opts.prefix = abspath(expanduser(opts.prefix))
 
     if opts.version:
         from enstaller import __version__
@@ -272,23 +976,59 @@ def main():
     if opts.list:
         if args:
             p.error("the --list option takes no arguments")
-        print_installed()
+        print_installed(opts.prefix)
         return
 
-    for path in args:
-        ei = EggInst(path, opts.verbose)
-        fn = basename(path)
-        if opts.remove:
-            pprint_fn_action(fn, 'removing')
-            if opts.dry_run:
-                continue
-            ei.remove()
+    if opts.verify:
+        from egginst.verify import verify
+        if verify(args, opts.crc, max(1, opts.jobs or 4), opts.prefix):
+            sys.exit(1)
+        return
 
-        else: # default is always install
-            pprint_fn_action(fn, 'installing')
-            if opts.dry_run:
-                continue
-            ei.install()
+    # other processes may not install into the prefix at the same time
+    lock = prefix_lock(opts.prefix, opts.lock_timeout)
+    try:
+        lock.acquire()
+    except LockError, e:
+        print e
+        sys.exit(1)
+    try:
+        if opts.recover:
+            if args:
+                p.error("the --recover option takes no arguments")
+            recover(verbose=True, prefix=opts.prefix)
+            return
+
+        if opts.batch and not (opts.remove or opts.dry_run):
+            eggs = []
+            for path in args:
+                eggs.append(EggInst(path, opts.verbose, store=opts.store,
+                                    prefix=opts.prefix))
+            install_batch(eggs, max(1, opts.jobs or 4), opts.differential,
+                          opts.staged, opts.compile)
+            return
+
+        removed = []
+        for path in args:
+            ei = EggInst(path, opts.verbose, max(1, opts.jobs or 1),
+                         opts.store, opts.prefix)
+            fn = basename(path)
+            if opts.remove:
+                pprint_fn_action(fn, 'removing')
+                if opts.dry_run:
+                    continue
+                ei.remove(rmdirs=False)
+                removed.append(ei)
+
+            else: # default is always install
+                pprint_fn_action(fn, 'installing')
+                if opts.dry_run:
+                    continue
+                ei.install(opts.differential, opts.staged, opts.compile)
+
+        remove_dirs(removed)
+    finally:
+        lock.release()
 
 
 if __name__ == '__main__':
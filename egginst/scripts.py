@@ -1,9 +1,12 @@
 import os
 import sys
 import re
+import shutil
+import ConfigParser
+from cStringIO import StringIO
 from os.path import abspath, basename, join, isdir, isfile, islink
 
-from egginst.utils import rm_rf
+from egginst.utils import rm_rf, write_member
 
 
 verbose = False
@@ -24,9 +27,10 @@ def write_exe(dst):
     os.chmod(dst, 0755)
 
 
-def create_proxy(src, bin_dir):
+def create_proxy(src, bin_dir, exe=None):
     """
-    create a proxy of src in bin_dir (Windows only)
+    create a proxy of src in bin_dir (Windows only), which is run by the
+    interpreter exe (default: executable)
     """
     if verbose:
         print "Creating proxy executable to: %r" % src
@@ -52,7 +56,7 @@ import subprocess
 src = %(src)r
 
 sys.exit(subprocess.call([src] + sys.argv[1:]))
-''' % dict(python=executable, src=src))
+''' % dict(python=exe or executable, src=src))
     fo.close()
     return dst, dst_script
 
@@ -75,29 +79,27 @@ def create_proxies(egg):
                 src = abspath(join(egg.prefix, arcname))
             if verbose:
                 print "     src: %r" % src
-            egg.files.extend(create_proxy(src, egg.bin_dir))
+            egg.files.extend(create_proxy(src, egg.bin_dir, egg.executable))
         else:
-            data = egg.z.read(arcname)
             dst = abspath(join(egg.prefix, action, basename(arcname)))
             if verbose:
                 print "     dst: %r" % dst
             rm_rf(dst)
-            fo = open(dst, 'wb')
-            fo.write(data)
-            fo.close()
+            write_member(egg.z, arcname, dst)
             egg.files.append(dst)
 
 
-def write_script(path, entry_pt, egg_name):
+def write_script(path, entry_pt, egg_name, exe=None):
     """
-    Write an entry point script to path.
+    Write an entry point script to path, which is run by the interpreter
+    exe (default: executable).
     """
     if verbose:
         print 'Creating script: %s' % path
 
     assert entry_pt.count(':') == 1
     module, func = entry_pt.strip().split(':')
-    python = '"%s"' % executable
+    python = '"%s"' % (exe or executable)
 
     rm_rf(path)
     fo = open(path, 'w')
@@ -134,19 +136,60 @@ def create(egg, conf):
         fname += '-script.py'
 
         path = join(egg.bin_dir, fname)
-        write_script(path, entry_pt, basename(egg.fpath))
+        write_script(path, entry_pt, basename(egg.fpath), egg.executable)
         egg.files.append(path)
 
 
-def fix_script(path):
+def script_paths(egg, z):
     """
-    Fixes a single located at path.
+    Returns the paths of the entry point scripts and proxies, which are
+    created (see create() and create_proxies() above) when the egg (the
+    zip-file object z) is installed.
+    """
+    names = z.namelist()
+    res = []
+    arcname = 'EGG-INFO/entry_points.txt'
+    if arcname in names:
+        conf = ConfigParser.ConfigParser()
+        conf.readfp(StringIO(z.read(arcname)))
+        if conf.has_section('console_scripts'):
+            for name, entry_pt in conf.items('console_scripts'):
+                res.append(join(egg.bin_dir, '%s.exe' % name))
+                res.append(join(egg.bin_dir, '%s-script.py' % name))
+
+    arcname = 'EGG-INFO/inst/files_to_install.txt'
+    if arcname in names:
+        for line in z.read(arcname).splitlines():
+            line = line.strip()
+            if line == '' or line.startswith('#'):
+                continue
+            arcname, action = line.split()
+            if action == 'PROXY':
+                dst_name = basename(arcname)
+                if dst_name.startswith('epd-'):
+                    dst_name = dst_name[4:]
+                dst = join(egg.bin_dir, dst_name)
+                res.extend([dst, dst[:-4] + '-script.py'])
+            else:
+                res.append(abspath(join(egg.prefix, action,
+                                        basename(arcname))))
+    return res
+
+
+def fix_script(path, exe=None):
+    """
+    Fixes a single located at path, such that it is run by the interpreter
+    exe (default: executable).
     """
     if islink(path) or not isfile(path):
         return
 
     fi = open(path)
-    data = fi.read()
+    if fi.read(2) != '#!':
+        # not a script, avoid reading (possibly large) data files
+        fi.close()
+        return
+    data = '#!' + fi.read()
     fi.close()
 
     if ' egginst ' in data:
@@ -158,7 +201,7 @@ def fix_script(path):
     if not (m and 'python' in m.group().lower()):
         return
 
-    python = '"%s"' % executable
+    python = '"%s"' % (exe or executable)
     new_data = hashbang_pat.sub('#!' + python.replace('\\', '\\\\'),
                                 data, count=1)
     if new_data == data:
@@ -171,10 +214,110 @@ def fix_script(path):
     os.chmod(path, 0755)
 
 
+def python_hashbang(line):
+    """
+    Returns True if line is a hashbang line which refers to python.
+    """
+    body = line.rstrip('\r\n')
+    return body.startswith('#!') and 'python' in body.lower()
+
+
+def fix_hashbang(line, exe=None):
+    """
+    Returns the first line of a script with its (python) hashbang replaced,
+    such that it points to the interpreter exe (default: executable), or
+    None if nothing needs to be fixed.
+    """
+    if not python_hashbang(line):
+        return None
+    body = line.rstrip('\r\n')
+    new_line = '#!"%s"' % (exe or executable) + line[len(body):]
+    if new_line == line:
+        return None
+    return new_line
+
+
+def read_head(fi, exe=None):
+    """
+    Read the first line (and up to 4096 more bytes) of a script from the file object fi,
+    and return a tuple(head, new_line), where head is the data read, and
+    new_line the fixed first line (see fix_hashbang()), or None if nothing
+    needs to be fixed.  Like fix_script(), scripts created by egginst
+    (which is mentioned in their first comment) are not fixed.
+    """
+    line = fi.readline(4096)
+    head = line + fi.read(4096)
+    new_line = None
+    if line.endswith('\n') or len(line) < 4096:
+        new_line = fix_hashbang(line, exe)
+    if new_line and ' egginst ' in head:
+        new_line = None
+    if new_line:
+        head = new_line + head[len(line):]
+    return head, new_line
+
+
+def write_script_member(z, arcname, path, exe=None, chunk_size=65536):
+    """
+    Write the member arcname of the zip-file object z, which is installed
+    into the bin directory, to path (like utils.write_member), and fix its
+    hashbang (see read_head()) while doing so, such that the file is only
+    written once.  Returns True if the hashbang was fixed, i.e. the data
+    written differs from the member.
+    """
+    fi = z.open(arcname)
+    fo = open(path, 'wb')
+    try:
+        head, new_line = read_head(fi, exe)
+        fo.write(head)
+        shutil.copyfileobj(fi, fo, chunk_size)
+    finally:
+        fo.close()
+        fi.close()
+    if new_line:
+        if verbose:
+            print "Updating: %r" % path
+        os.chmod(path, 0755)
+        return True
+    return False
+
+
+def needs_fix(path, exe=None):
+    """
+    Returns True if the hashbang of the file at path needs to be fixed.
+    """
+    fi = open(path, 'rb')
+    head, new_line = read_head(fi, exe)
+    fi.close()
+    return new_line is not None
+
+
+def write_store_member(z, arcname, path, chunk_size=65536):
+    """
+    Write the member arcname of the zip-file object z unchanged to path, and
+    return True if it has a python hashbang, which may be fixed when
+    installing it (depending on the interpreter of the prefix).
+    """
+    fi = z.open(arcname)
+    fo = open(path, 'wb')
+    try:
+        line = fi.readline(4096)
+        fo.write(line)
+        shutil.copyfileobj(fi, fo, chunk_size)
+    finally:
+        fo.close()
+        fi.close()
+    return python_hashbang(line)
+
+
 def fix_scripts(egg):
+    """
+    Fix the scripts in the bin directory, which were not extracted from the
+    egg (the ones which were, are fixed by write_script_member()).
+    """
     for path in egg.files:
-        if path.startswith(egg.bin_dir):
-            fix_script(path)
+        if path.startswith(egg.bin_dir) and path not in egg.file_info:
+            fix_script(path, egg.executable)
 
 
 if __name__ == '__main__':
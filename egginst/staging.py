@@ -0,0 +1,216 @@
+"""
+Staged installs:  The files of an egg are first extracted into a staging
+directory in the prefix (i.e. on the same filesystem), and then moved into
+place using renames.  Files which are replaced are moved into the staging
+directory as backups, such that an install can be rolled back.
+
+Each transaction has a journal in the EGG-INFO directory, which lists the
+destination of each staged file (the staged file is named by its index).
+Once all files are staged, the journal is marked as committed.  The files
+which are generated when completing the install (the metadata, entry point
+scripts, proxies, ...) are also listed in the journal, together with copies
+of the ones they replace, and once the install is complete the journal is
+marked as such.  After a crash, a completed transaction is simply finished,
+a committed one is rolled back (restoring the backups, and the generated
+files), and the staged files of all others are discarded, see recover()
+below.  All of these only take time proportional to the number of renames.
+"""
+import os
+import sys
+import shutil
+from os.path import abspath, dirname, isdir, isfile, join
+
+from egginst.utils import prune_dirs, rm_rf
+
+
+def stage_dir(cname, prefix):
+    return join(prefix, '.stage_ironpkg', cname)
+
+
+def journal_path(cname, prefix):
+    return join(prefix, 'EGG-INFO', '.%s.journal' % cname)
+
+
+class Transaction(object):
+
+    def __init__(self, cname, prefix=None):
+        self.cname = cname
+        self.prefix = abspath(prefix or sys.prefix)
+        self.stage_dir = stage_dir(cname, self.prefix)
+        self.journal = journal_path(cname, self.prefix)
+        self.state = None
+        # destination paths, the staged file of dsts[i] is named i
+        self.dsts = []
+        # paths of the files generated when completing the install, the
+        # copy of the file generated[i] replaced is named g<i>
+        self.generated = []
+
+    def staged(self, i):
+        return join(self.stage_dir, str(i))
+
+    def backup(self, i):
+        return join(self.stage_dir, '%i.old' % i)
+
+    def gen_backup(self, i):
+        return join(self.stage_dir, 'g%i' % i)
+
+    def stage(self, plan):
+        """
+        Start the transaction for the plan (see EggInst.prepare()), and
+        return the plan with the paths replaced by the staged paths.
+        """
+        rm_rf(self.stage_dir)
+        try:
+            os.makedirs(self.stage_dir)
+        except OSError:
+            # the parent was just removed by another transaction (see
+            # finish() below)
+            os.makedirs(self.stage_dir)
+        self.dsts = [path for arcname, path, exists in plan]
+        self.write_journal('staging')
+        return [(arcname, self.staged(i), False)
+                for i, (arcname, path, exists) in enumerate(plan)]
+
+    def write_journal(self, state):
+        self.state = state
+        dn = dirname(self.journal)
+        if not isdir(dn):
+            os.makedirs(dn)
+        fo = open(self.journal + '.tmp', 'w')
+        fo.write('# egginst journal\n')
+        fo.write('state = %r\n' % state)
+        fo.write('rel_files = [\n')
+        for path in self.dsts:
+            fo.write('  %r,\n' % path[len(self.prefix) + 1:])
+        fo.write(']\n')
+        fo.write('generated = [\n')
+        for path in self.generated:
+            fo.write('  %r,\n' % path[len(self.prefix) + 1:])
+        fo.write(']\n')
+        fo.flush()
+        os.fsync(fo.fileno())
+        fo.close()
+        rm_rf(self.journal)
+        os.rename(self.journal + '.tmp', self.journal)
+
+    def read_journal(self):
+        d = {'generated': []}
+        execfile(self.journal, d)
+        self.state = d['state']
+        self.dsts = [join(self.prefix, f) for f in d['rel_files']]
+        self.generated = [join(self.prefix, f) for f in d['generated']]
+
+    def commit(self):
+        """
+        Mark the transaction as committed, and move the staged files into
+        place.
+        """
+        self.write_journal('committed')
+        self.roll_forward()
+
+    def add_generated(self, paths, backup=True):
+        """
+        Add the paths of files which are (about to be) generated when
+        completing the install to the journal.  When backup is True, the
+        existing files are copied first, such that they can be restored.
+        """
+        known = set(self.generated)
+        known.update(self.dsts)
+        new = [p for p in paths if p not in known]
+        if not new:
+            return
+        for path in new:
+            if backup and isfile(path):
+                shutil.copy2(path, self.gen_backup(len(self.generated)))
+            self.generated.append(path)
+        self.write_journal(self.state)
+
+    def roll_forward(self):
+        for i, dst in enumerate(self.dsts):
+            src = self.staged(i)
+            if not isfile(src):
+                # already moved into place
+                continue
+            if isfile(dst) and not isfile(self.backup(i)):
+                os.rename(dst, self.backup(i))
+            rm_rf(dst)
+            if not isdir(dirname(dst)):
+                os.makedirs(dirname(dst))
+            os.rename(src, dst)
+
+    def roll_back(self, roots):
+        """
+        Remove the generated files (restoring the ones they replaced), undo
+        the renames done so far, restore the backups, remove the directories
+        (below the roots) which became empty, and finish the transaction.
+        """
+        for i in xrange(len(self.generated) - 1, -1, -1):
+            path = self.generated[i]
+            rm_rf(path)
+            if isfile(self.gen_backup(i)):
+                os.rename(self.gen_backup(i), path)
+        for i in xrange(len(self.dsts) - 1, -1, -1):
+            dst = self.dsts[i]
+            if not isfile(self.staged(i)) and isfile(dst):
+                os.rename(dst, self.staged(i))
+            if isfile(self.backup(i)):
+                rm_rf(dst)
+                os.rename(self.backup(i), dst)
+            elif dst.endswith('.py'):
+                # the module was byte-compiled after the commit
+                rm_rf(dst + 'c')
+        prune_dirs(self.dsts + self.generated, roots)
+        self.finish()
+
+    def finish(self):
+        """
+        Remove the staging directory (with the backups), and the journal.
+        The parent directory is removed as well, unless other transactions
+        use it.
+        """
+        rm_rf(self.stage_dir)
+        try:
+            os.rmdir(dirname(self.stage_dir))
+        except OSError:
+            pass
+        rm_rf(self.journal)
+
+
+def recover(cname=None, verbose=False, prefix=None):
+    """
+    Recover the interrupted transactions in prefix (only the one of the
+    package cname if given):  Completed transactions are finished, committed
+    ones are rolled back, and all others are discarded.  Returns the number
+    of transactions recovered.
+    """
+    from egginst.main import EggInst
+
+    prefix = abspath(prefix or sys.prefix)
+    egg_info_dir = join(prefix, 'EGG-INFO')
+    if cname:
+        fns = ['.%s.journal' % cname]
+    elif isdir(egg_info_dir):
+        fns = os.listdir(egg_info_dir)
+    else:
+        fns = []
+
+    n = 0
+    for fn in fns:
+        if not (fn.startswith('.') and fn.endswith('.journal') and
+                isfile(join(egg_info_dir, fn))):
+            continue
+        t = Transaction(fn[1:-8], prefix)
+        t.read_journal()
+        if t.state == 'completed':
+            action = 'finished'
+        elif t.state == 'committed':
+            # the install was not completed, restore the previous version
+            t.roll_back(EggInst(t.cname, prefix=prefix).roots())
+            action = 'rolled back'
+        else:
+            action = 'discarded'
+        t.finish()
+        if verbose:
+            print "Recovered install of %s (%s)" % (t.cname, action)
+        n += 1
+    return n
@@ -0,0 +1,128 @@
+"""
+Incremental extraction of an egg while it is being downloaded.  The data
+of the egg is fed (in chunks, as it arrives) to a StreamExtractor, which
+decodes the zip local file headers in order, and writes each member into
+a directory, before the egg is complete.  Once the download finished (and
+its md5 was verified), the egg is installed using the extracted files, see
+EggInst.use_prestaged(), such that the extraction time is hidden behind
+the download time.
+
+Members which cannot be decoded from the stream (e.g. when the sizes are
+only stored in a data descriptor after the data) end the decoding, and the
+remaining members are simply extracted from the egg when installing.
+"""
+import os
+import zlib
+import struct
+from os.path import join
+
+from egginst.utils import rm_rf
+
+
+LOCAL_SIG = 'PK\003\004'
+# signature, version, flags, method, time, date, CRC32, compressed size,
+# uncompressed size, filename length, extra field length
+LOCAL_FMT = '<4s2B4HL2L2H'
+LOCAL_SIZE = struct.calcsize(LOCAL_FMT)
+
+
+class StreamExtractor(object):
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        # maps the archive names to the paths of the extracted files
+        self.members = {}
+        # True, once no more members are decoded
+        self.done = False
+        self.buf = ''
+        self.cur = None
+
+    def feed(self, data):
+        """
+        Feed the next chunk of data of the egg.
+        """
+        if self.done:
+            return
+        self.buf += data
+        while not self.done:
+            if self.cur is None:
+                if not self.start_member():
+                    break
+            elif not self.write_member():
+                break
+
+    def start_member(self):
+        """
+        Decode the local header of the next member, and return True, or
+        return False if more data is needed.
+        """
+        if len(self.buf) < LOCAL_SIZE:
+            return False
+        (sig, v1, v2, flags, method, t, d, crc, csize, usize, fn_len,
+         extra_len) = struct.unpack(LOCAL_FMT, self.buf[:LOCAL_SIZE])
+        if (sig != LOCAL_SIG or flags & 0x09 or method not in (0, 8) or
+                csize == 0xffffffff):
+            # central directory, or a member which cannot be decoded from
+            # the stream (encrypted, data descriptor, unknown compression,
+            # ZIP64)
+            self.done = True
+            return False
+        header_len = LOCAL_SIZE + fn_len + extra_len
+        if len(self.buf) < header_len:
+            return False
+        arcname = self.buf[LOCAL_SIZE:LOCAL_SIZE + fn_len]
+        self.buf = self.buf[header_len:]
+
+        self.cur = cur = dict(arcname=arcname, left=csize, crc=crc,
+                              crc32=0, fo=None, decomp=None)
+        if not arcname.endswith('/'):
+            cur['path'] = join(self.dir_path, str(len(self.members)))
+            cur['fo'] = open(cur['path'], 'wb')
+            if method == 8:
+                cur['decomp'] = zlib.decompressobj(-15)
+        return True
+
+    def write_member(self):
+        """
+        Write the data of the current member, which is in the buffer, and
+        return True if the member is complete.
+        """
+        cur = self.cur
+        chunk = self.buf[:cur['left']]
+        self.buf = self.buf[len(chunk):]
+        cur['left'] -= len(chunk)
+        if cur['fo']:
+            if cur['decomp']:
+                chunk = cur['decomp'].decompress(chunk)
+            self.write(chunk)
+        if cur['left']:
+            return False
+
+        if cur['fo'] is None:
+            self.cur = None
+            return True
+        if cur['decomp']:
+            self.write(cur['decomp'].flush())
+        cur['fo'].close()
+        self.cur = None
+        if cur['crc32'] & 0xffffffff != cur['crc']:
+            os.unlink(cur['path'])
+            self.done = True
+            return False
+        self.members[cur['arcname']] = cur['path']
+        return True
+
+    def write(self, data):
+        self.cur['fo'].write(data)
+        self.cur['crc32'] = zlib.crc32(data, self.cur['crc32'])
+
+    def close(self):
+        """
+        Stop decoding, and remove the member which is incomplete.
+        """
+        self.done = True
+        if self.cur and self.cur['fo']:
+            self.cur['fo'].close()
+            rm_rf(self.cur['path'])
+        self.cur = None
+        self.buf = ''
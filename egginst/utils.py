@@ -1,9 +1,13 @@
 import os
 import sys
+import errno
+import hashlib
 import random
 import shutil
 import string
-from os.path import basename, isdir, isfile, join
+import threading
+import zlib
+from os.path import basename, dirname, isdir, isfile, join
 
 
 chars = string.letters + string.digits
@@ -20,6 +24,52 @@ def mk_tmp_dir():
     return tmp_dir
 
 
+def trash_dir(prefix=None):
+    """
+    Returns the trash directory of the prefix (sys.prefix by default), into
+    which the files of packages are moved when they are removed deferred.
+    """
+    return join(prefix or sys.prefix, '.trash_ironpkg')
+
+
+def mk_trash_dir(name, prefix=None):
+    """
+    Create a new (uniquely named) directory in the trash directory, and
+    return its path.
+    """
+    while True:
+        rand = ''.join(random.choice(chars) for x in xrange(10))
+        path = join(trash_dir(prefix), '%s_%s' % (rand, name))
+        if not isdir(path):
+            break
+    os.makedirs(path)
+    return path
+
+
+def purge_trash(background=False, prefix=None):
+    """
+    Delete the content of the trash directory, i.e. the packages which were
+    moved there at the time this function is called.  When background is
+    True, this is done by a thread, which is returned (the interpreter
+    waits for it before exiting).
+    """
+    dir_path = trash_dir(prefix)
+    if not isdir(dir_path):
+        return None
+    paths = [join(dir_path, fn) for fn in os.listdir(dir_path)]
+
+    def purge():
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+    if not background:
+        purge()
+        return None
+    t = threading.Thread(target=purge)
+    t.start()
+    return t
+
+
 def pprint_fn_action(fn, action):
     """
     Pretty print the distribution name (filename) and an action, the width
@@ -29,17 +79,74 @@ def pprint_fn_action(fn, action):
     print "%-56s %20s" % (fn, '[%s]' % action)
 
 
-def rmdir_er(dn):
+class ProgressBar(object):
+    """
+    A progress bar for an operation on total bytes, which may be updated
+    from several threads.  When show is False, nothing is displayed.
+    """
+    def __init__(self, total, show=True):
+        self.total = total
+        self.show = show
+        self.n = self.cur = 0
+        self.lock = threading.Lock()
+        if show:
+            sys.stdout.write('%9s [' % human_bytes(total))
+            sys.stdout.flush()
+
+    def update(self, n):
+        self.lock.acquire()
+        try:
+            self.n += n
+            if not (self.total and self.show):
+                return
+            while self.cur < 64 and float(self.n) / self.total * 64 >= self.cur:
+                sys.stdout.write('.')
+                self.cur += 1
+            sys.stdout.flush()
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        if not self.show:
+            return
+        sys.stdout.write('.' * (65 - self.cur) + ']\n')
+        sys.stdout.flush()
+
+
+def prune_dirs(files, roots):
     """
-    Remove empty directories recursively.
+    Remove the directories, which became empty after the files were
+    removed, bottom-up.  The candidates are all directories containing
+    the files, and their parent directories up to (but excluding) the root
+    directories, outside of which nothing is removed.  Each candidate is
+    removed at most once (deepest first), and when a directory is not
+    empty, none of its parents are tried.
     """
-    for name in os.listdir(dn):
-        path = join(dn, name)
-        if isdir(path):
-            rmdir_er(path)
+    def inside_root(dn):
+        for root in roots:
+            if dn.startswith(root) and dn[len(root):len(root) + 1] in '/\\':
+                return len(dn) > len(root)
+        return False
+
+    dirs = set()
+    for path in files:
+        dn = dirname(path)
+        while dn not in dirs and dn not in roots and inside_root(dn):
+            dirs.add(dn)
+            dn = dirname(dn)
 
-    if not os.listdir(dn):
-        os.rmdir(dn)
+    keep = set()
+    # a directory is always longer than its parent
+    for dn in sorted(dirs, key=len, reverse=True):
+        if dn in keep:
+            keep.add(dirname(dn))
+            continue
+        try:
+            os.rmdir(dn)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                # not empty, so neither are the parent directories
+                keep.add(dirname(dn))
 
 
 def rm_rf(path, verbose=False):
@@ -58,6 +165,64 @@ def rm_rf(path, verbose=False):
         shutil.rmtree(path)
 
 
+def replace(src, dst):
+    """
+    Rename src to dst, replacing dst if it exists.  On Windows (which
+    includes IronPython, where sys.platform is 'cli'), os.rename() does not
+    replace existing files, so dst is removed first.
+    """
+    if (os.name == 'nt' or sys.platform in ('win32', 'cli')) and isfile(dst):
+        os.unlink(dst)
+    os.rename(src, dst)
+
+
+def write_member(z, arcname, path, chunk_size=65536):
+    """
+    Write the member arcname of the zip-file object z to path.  The data is
+    decompressed and written in chunks, such that the memory used does not
+    depend on the size of the member.
+    """
+    fi = z.open(arcname)
+    fo = open(path, 'wb')
+    try:
+        shutil.copyfileobj(fi, fo, chunk_size)
+    finally:
+        fo.close()
+        fi.close()
+
+
+def crc32_file(path):
+    """
+    Returns the CRC32 of the file at path (as an unsigned integer, like the
+    CRCs in zip-files).
+    """
+    fi = open(path, 'rb')
+    crc = 0
+    while True:
+        chunk = fi.read(65536)
+        if not chunk:
+            break
+        crc = zlib.crc32(chunk, crc)
+    fi.close()
+    return crc & 0xffffffff
+
+
+def md5_file(path):
+    """
+    Returns the md5sum of the file (located at path) as a hexadecimal
+    string of length 32.
+    """
+    fi = open(path, 'rb')
+    h = hashlib.new('md5')
+    while True:
+        chunk = fi.read(65536)
+        if not chunk:
+            break
+        h.update(chunk)
+    fi.close()
+    return h.hexdigest()
+
+
 def human_bytes(n):
     """
     Return the number of bytes n in more human readable form.
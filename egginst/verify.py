@@ -0,0 +1,120 @@
+"""
+Verification of installed packages against the size and CRC32 of each
+file, which egginst records (in __egginst__.txt) when installing.
+"""
+import os
+import Queue
+import threading
+from os.path import dirname, getmtime, isfile, join
+
+from egginst.main import EggInst, get_installed
+from egginst.utils import crc32_file
+
+
+def verify_package(ei, recorded, crc=False):
+    """
+    Verify the installed package of the EggInst object ei, whose metadata
+    must have been read already.  recorded is the set of the files of all
+    installed packages.  Returns a tuple(modified, missing, extra) of lists
+    of paths.
+
+    The size of each file is compared to the one recorded, and the CRC32 is
+    only computed when the file was modified after the package was
+    installed, or when crc is True.  Extra files are files in the
+    directories of the package, which were not installed by any package.
+    """
+    t_inst = getmtime(ei.meta_txt)
+    modified, missing = [], []
+    for path in ei.files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            missing.append(path)
+            continue
+        info = ei.file_info.get(path)
+        if info is None:
+            # file was not extracted from the egg, e.g. a generated script
+            continue
+        size, crc32 = info
+        if st.st_size != size:
+            modified.append(path)
+        elif ((crc or st.st_mtime > t_inst) and
+                      crc32_file(path) != crc32):
+            modified.append(path)
+
+    roots = ei.roots()
+    extra = []
+    for dn in sorted(set(dirname(p) for p in ei.files) - roots):
+        if dn == ei.meta_dir or not os.path.isdir(dn):
+            continue
+        for fn in os.listdir(dn):
+            path = join(dn, fn)
+            if path in recorded or not isfile(path):
+                continue
+            if path.endswith(('.pyc', '.pyo')) and path[:-1] in recorded:
+                continue
+            extra.append(path)
+
+    return modified, missing, extra
+
+
+def verify(names=None, crc=False, workers=4, prefix=None):
+    """
+    Verify the installed packages (in prefix) given by names (egg or project
+    names), or all installed packages, using several threads.  Prints a report for
+    each package, and returns the number of packages with problems.
+    """
+    installed = []
+    recorded = set()
+    for egg_name in get_installed(prefix):
+        ei = EggInst(egg_name, prefix=prefix)
+        ei.read_meta()
+        installed.append(ei)
+        recorded.update(ei.files)
+
+    if names:
+        cnames = set(EggInst(name, prefix=prefix).cname for name in names)
+        for cname in cnames - set(ei.cname for ei in installed):
+            print "Error: Can't find meta data for:", cname
+        installed = [ei for ei in installed if ei.cname in cnames]
+
+    q = Queue.Queue()
+    for ei in installed:
+        q.put(ei)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                ei = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[ei.cname] = verify_package(ei, recorded, crc)
+            except Exception, e:
+                results[ei.cname] = e
+
+    threads = [threading.Thread(target=worker) for i in xrange(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    n = 0
+    for ei in installed:
+        res = results[ei.cname]
+        if isinstance(res, Exception):
+            n += 1
+            print "%s: Error: %s" % (ei.egg_name, res)
+            continue
+        modified, missing, extra = res
+        if not (modified or missing or extra):
+            print "%s: OK" % ei.egg_name
+            continue
+        n += 1
+        print "%s:" % ei.egg_name
+        for label, paths in [('modified', modified), ('missing', missing),
+                             ('extra', extra)]:
+            for path in paths:
+                print "    %-9s %s" % (label + ':', ei.rel_prefix(path))
+    return n
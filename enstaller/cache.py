@@ -0,0 +1,303 @@
+"""
+The local repository (LOCAL-REPO), into which distributions are fetched
+before being installed, is a content addressed cache:  Each egg is stored
+once, as a "blob" named by its md5 (in the '.blobs' sub-directory), and
+the egg filenames in the directory are hardlinks to these blobs.  Hence,
+the same egg fetched from different repositories (or under different
+names) is only stored (and fetched) once.  On systems without hardlinks,
+the eggs are simply stored by filename.
+
+The time of last use of each egg is recorded, such that the least recently
+used eggs can be removed when the cache exceeds a size limit.  The access
+times are kept in memory, and written once (see flush()), when the
+distributions were fetched, or at exit.  For eggs
+from repositories which provide no md5 (see indexed_repo/remote.py), the
+ETag of the egg is recorded as well.
+"""
+import os
+import time
+import atexit
+import threading
+from os.path import basename, isdir, join
+
+from egginst.locking import FileLock
+from egginst.utils import human_bytes, rm_rf
+from enstaller.fetch import fetch_lock
+
+
+BLOBS = '.blobs'
+ACCESS_TXT = '.access.txt'
+
+
+class LocalCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.blob_dir = join(path, BLOBS)
+        self.lock = threading.Lock()
+        self.scan()
+        # True when the access times changed since they were saved
+        self.dirty = False
+        atexit.register(self.flush)
+
+    def scan(self):
+        """
+        Load the state of the cache directory, i.e. map the filenames of
+        eggs and blobs to their tuple(size, inode), and read the access
+        times.  This is done once, instead of checking each egg separately.
+        """
+        self.files = self.scan_dir(self.path)
+        self.blobs = self.scan_dir(self.blob_dir)
+        self.atimes, self.etags = self.read_access()
+
+    def read_access(self):
+        """
+        Returns the access times and ETags (dictionaries mapping filenames
+        to them) recorded on disk.
+        """
+        atimes, etags = {}, {}
+        try:
+            fi = open(join(self.path, ACCESS_TXT))
+        except IOError:
+            return atimes, etags
+        for line in fi:
+            parts = line.split()
+            atimes[parts[0]] = float(parts[1])
+            if len(parts) > 2:
+                # ETags contain no whitespace
+                etags[parts[0]] = parts[2]
+        fi.close()
+        return atimes, etags
+
+    def scan_dir(self, dir_path):
+        res = {}
+        if not isdir(dir_path):
+            return res
+        for fn in os.listdir(dir_path):
+            if fn.startswith('.') or fn.endswith('.part'):
+                continue
+            st = os.stat(join(dir_path, fn))
+            res[fn] = st.st_size, st.st_ino
+        return res
+
+    def blob_path(self, md5):
+        return join(self.blob_dir, md5)
+
+    def lookup(self, fn, md5=None, size=None, etag=None, link=True):
+        """
+        Returns True if the egg with filename fn, md5 and size (and ETag,
+        if given) is in the cache.  If it is not, but a blob with the same
+        md5 is, the blob is linked to the filename (holding the fetch lock
+        of the egg), and True is returned as well.  When link is False
+        (dry-run), the cache is not modified, and True is returned if the
+        blob could be linked.
+        """
+        if (fn in self.files and self.files[fn][0] == size and
+                (etag is None or self.etags.get(fn) == etag)):
+            if link:
+                self.touch(fn)
+            return True
+        if not (md5 and self.blobs.get(md5, (None,))[0] == size):
+            return False
+        if not link:
+            return hasattr(os, 'link')
+        dst = join(self.path, fn)
+        lock = fetch_lock(dst)
+        lock.acquire()
+        try:
+            rm_rf(dst)
+            self.lock.acquire()
+            try:
+                self.files.pop(fn, None)
+                try:
+                    os.link(self.blob_path(md5), dst)
+                except (AttributeError, OSError):
+                    return False
+                self.files[fn] = self.blobs[md5]
+            finally:
+                self.lock.release()
+        finally:
+            lock.release()
+        self.touch(fn)
+        return True
+
+    def add(self, fn, md5=None, etag=None):
+        """
+        Add the egg fn, which was just fetched into the cache directory,
+        i.e. link the egg to a blob named by its md5, and record its ETag.
+        """
+        path = join(self.path, fn)
+        st = os.stat(path)
+        self.lock.acquire()
+        try:
+            self.files[fn] = st.st_size, st.st_ino
+            if etag:
+                self.etags[fn] = etag
+            else:
+                self.etags.pop(fn, None)
+            if md5 and hasattr(os, 'link'):
+                self.add_blob(path, md5)
+        finally:
+            self.lock.release()
+        self.touch(fn)
+
+    def add_blob(self, path, md5):
+        if not isdir(self.blob_dir):
+            os.makedirs(self.blob_dir)
+        blob = self.blob_path(md5)
+        rm_rf(blob)
+        try:
+            os.link(path, blob)
+        except OSError:
+            return
+        self.blobs[md5] = self.files[basename(path)]
+
+    def touch(self, fn):
+        """
+        Record that the egg fn was used now (in memory only).
+        """
+        self.lock.acquire()
+        try:
+            self.atimes[fn] = time.time()
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Write the access times to disk, if they changed.
+        """
+        self.lock.acquire()
+        try:
+            if self.dirty:
+                self.save()
+        finally:
+            self.lock.release()
+
+    def save(self):
+        """
+        Write the access times to disk.  More recent access times written
+        by other processes (since the cache was scanned) are kept.
+        """
+        self.dirty = False
+        if not isdir(self.path):
+            return
+        atimes, etags = self.read_access()
+        for fn, t in atimes.iteritems():
+            if t > self.atimes.get(fn, 0):
+                self.atimes[fn] = t
+                if fn in etags:
+                    self.etags[fn] = etags[fn]
+        path = join(self.path, ACCESS_TXT)
+        # unique per process, as several processes may share the cache
+        tmp = '%s.%i.tmp' % (path, os.getpid())
+        fo = open(tmp, 'w')
+        for fn in sorted(self.atimes):
+            if fn not in self.files:
+                continue
+            if fn in self.etags:
+                fo.write('%s %.2f %s\n' % (fn, self.atimes[fn],
+                                           self.etags[fn]))
+            else:
+                fo.write('%s %.2f\n' % (fn, self.atimes[fn]))
+        fo.close()
+        rm_rf(path)
+        os.rename(tmp, path)
+
+    def units(self):
+        """
+        Returns a list of tuples(size, key, paths) for the data stored in
+        the cache, where paths is the list of eggs (and blobs) which share
+        the same data, i.e. inode (the key).
+        """
+        res = {}
+        for d, dir_path in [(self.files, self.path),
+                            (self.blobs, self.blob_dir)]:
+            for fn, (size, ino) in d.iteritems():
+                # without inodes (Windows) each file is its own unit
+                key = ino or join(dir_path, fn)
+                if key not in res:
+                    res[key] = size, key, []
+                res[key][2].append(join(dir_path, fn))
+        return res.values()
+
+    def total_size(self):
+        return sum(size for size, key, paths in self.units())
+
+    def gc(self, max_size=0, keep=(), verbose=False):
+        """
+        Remove the least recently used eggs, which are not in keep (a set
+        of egg filenames, e.g. the ones currently installed), until the
+        total size of the cache is at most max_size bytes.  Each file is
+        removed holding its fetch lock, and eggs which are being fetched
+        (or linked) by another process are skipped.  Returns the number of
+        bytes freed.
+        """
+        keep = set(keep)
+        total = self.total_size()
+        candidates = []
+        for size, key, paths in self.units():
+            fns = [basename(p) for p in paths]
+            if keep.intersection(fns):
+                continue
+            atime = max([self.atimes.get(fn, 0) for fn in fns])
+            candidates.append((atime, size, paths))
+        candidates.sort()
+
+        freed = 0
+        for atime, size, paths in candidates:
+            if total - freed <= max_size:
+                break
+            locks = []
+            for path in paths:
+                lock = fetch_lock(path)
+                if not lock.try_lock():
+                    break
+                locks.append(lock)
+            try:
+                if len(locks) < len(paths):
+                    if verbose:
+                        print "In use, skipping: %r" % paths
+                    continue
+                for path in paths:
+                    if verbose:
+                        print "Removing: %r" % path
+                    rm_rf(path)
+            finally:
+                for lock in locks:
+                    lock.release()
+            freed += size
+        self.sweep_locks()
+        # rescan the files, but keep the access times (which may not have
+        # been saved yet)
+        self.files = self.scan_dir(self.path)
+        self.blobs = self.scan_dir(self.blob_dir)
+        self.save()
+        return freed
+
+    def sweep_locks(self):
+        """
+        Remove the fetch lock files (and their '.info' files) which are
+        left behind, e.g. by processes which were killed, unless they are
+        held.
+        """
+        for dir_path in self.path, self.blob_dir:
+            if not isdir(dir_path):
+                continue
+            for fn in os.listdir(dir_path):
+                if not (fn.startswith('.') and fn.endswith('.lock')):
+                    continue
+                lock = FileLock(join(dir_path, fn), remove=True)
+                if lock.try_lock():
+                    lock.release()
+
+
+def cache_gc(path, max_size=0, keep=(), verbose=False):
+    """
+    Remove least recently used eggs from the local repository, see
+    LocalCache.gc() above, and print how much space was freed.
+    """
+    c = LocalCache(path)
+    freed = c.gc(max_size, keep, verbose)
+    print "Freed %s, local repository size is now %s" % (
+        human_bytes(freed), human_bytes(c.total_size()))
@@ -14,15 +14,25 @@ HOME_CONFIG_PATH = abs_expanduser("~/" + CONFIG_FN)
 SYSTEM_CONFIG_PATH = join(sys.prefix, CONFIG_FN)
 
 
-def get_path():
+def system_config_path(prefix=None):
+    """
+    Return the path of the config file of the prefix (sys.prefix by
+    default).
+    """
+    if prefix is None:
+        return SYSTEM_CONFIG_PATH
+    return join(prefix, CONFIG_FN)
+
+
+def get_path(prefix=None):
     """
     Return the absolute path to our config file.
     """
     if isfile(HOME_CONFIG_PATH):
         return HOME_CONFIG_PATH
 
-    if isfile(SYSTEM_CONFIG_PATH):
-        return SYSTEM_CONFIG_PATH
+    if isfile(system_config_path(prefix)):
+        return system_config_path(prefix)
 
     return None
 
@@ -46,13 +56,30 @@ RC_TMPL = """\
 IndexedRepos = [
   'http://www.enthought.com/repo/.iron/eggs',
 ]
+
+# Eggs from local repositories are hardlinked (or cloned) into the local
+# repository (LOCAL-REPO) when possible, and copied otherwise.  When this
+# option is True, their MD5 is not computed, i.e. local repositories are
+# trusted to contain the eggs listed in their index.
+#trust_local_md5 = True
+
+# The maximal size (in MB) of the local repository.  Running enpkg with
+# the --cache-gc option removes the least recently used eggs, which are not
+# currently installed, until the local repository fits into this size.
+# When not set, all eggs which are not installed are removed.
+#local_size_limit = 2000
+
+# A directory, shared by several prefixes (e.g. sandboxes), into which each
+# egg is extracted once.  When set, the files of installed packages are
+# hardlinks to the files in this store, except for scripts and metadata.
+#unpacked_store = '~/.ironpkg-store'
 """
 
-def write():
+def write(prefix=None):
     """
     Return the default state of this project's config file.
     """
-    sys_prefix = sys.prefix
+    sys_prefix = prefix or sys.prefix
     version = __version__
 
     fo = open(HOME_CONFIG_PATH, 'w')
@@ -62,25 +89,30 @@ def write():
     print 77 * '='
 
 
-def read():
+def read(prefix=None):
     """
-    Return the current configuration as a dictionary, and fix some values and
+    Return the current configuration (of prefix, which is only used when
+    reading it the first time) as a dictionary, and fix some values and
     give defaults.
     """
     if hasattr(read, 'cache'):
         return read.cache
 
     d = {}
-    execfile(get_path(), d)
+    execfile(get_path(prefix), d)
     read.cache = dict(
         # defaults
-        local=join(sys.prefix, 'LOCAL-REPO'),
+        local=join(prefix or sys.prefix, 'LOCAL-REPO'),
+        trust_local_md5=False,
+        local_size_limit=None,
+        unpacked_store=None,
     )
-    for k in ['IndexedRepos', 'local']:
+    for k in ['IndexedRepos', 'local', 'trust_local_md5', 'local_size_limit',
+              'unpacked_store']:
         if not d.has_key(k):
             continue
         v = d[k]
-        if k == 'local':
+        if k in ('local', 'unpacked_store'):
             read.cache[k] = abs_expanduser(v)
         else:
             read.cache[k] = v
@@ -88,19 +120,22 @@ def read():
     return read()
 
 
-def print_config():
+def print_config(prefix=None):
     print "IronPkg version:", __version__
     print "sys.prefix:", sys.prefix
+    if prefix:
+        print "prefix:", prefix
     print "platform:", platform.platform()
     print "architecture:", platform.architecture()[0]
-    cfg_path = get_path()
+    cfg_path = get_path(prefix)
     print "config file:", cfg_path
     if cfg_path is None:
         return
-    conf = read()
+    conf = read(prefix)
     print
     print "config file setting:"
-    for k in ['local']:
+    for k in ['local', 'trust_local_md5', 'local_size_limit',
+              'unpacked_store']:
         print "    %s = %r" % (k, conf[k])
     print "    IndexedRepos:"
     for repo in conf['IndexedRepos']:
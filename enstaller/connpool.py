@@ -0,0 +1,184 @@
+"""
+A small pool of persistent HTTP/1.1 connections.  Opening a url through the
+pool reuses an idle connection to the same host (or proxy), such that
+fetching the index and many eggs from one repository only pays for a
+single TCP handshake.
+"""
+import base64
+import socket
+import httplib
+import threading
+import urllib
+import urllib2
+import urlparse
+
+from enstaller import __version__
+
+
+# maximal number of idle connections kept per host
+MAX_IDLE = 4
+# maximal number of redirects which are followed
+MAX_REDIRECTS = 5
+
+
+class PooledResponse(object):
+    """
+    File-like wrapper around an httplib response.  When closed after all
+    data has been read, the connection is given back to the pool.
+    """
+    def __init__(self, pool, key, conn, resp, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.url = url
+        self.code = resp.status
+        self.headers = resp.msg
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        return self.resp.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.resp.isclosed() and not self.resp.will_close:
+            # the response was read completely, and the server is willing
+            # to keep the connection open
+            self.pool.put(self.key, self.conn)
+        else:
+            self.resp.close()
+            self.conn.close()
+        self.conn = None
+
+
+class ConnectionPool(object):
+
+    def __init__(self, max_idle=MAX_IDLE):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a tuple(connection, reused) for key, which is a
+        tuple(scheme, host).
+        """
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        finally:
+            self.lock.release()
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host), False
+        return httplib.HTTPConnection(host), False
+
+    def put(self, key, conn):
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            for conns in self.idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+        finally:
+            self.lock.release()
+
+    def request(self, key, selector, headers):
+        """
+        Sends a GET request, and returns a tuple(connection, response).
+        When a reused connection turns out to have been closed by the
+        server in the meantime, the request is retried once on a new
+        connection.
+        """
+        while True:
+            conn, reused = self.get(key)
+            try:
+                conn.request('GET', selector, headers=headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+
+    def open(self, url, headers=None):
+        """
+        Open the url, and return a file-like response object.  Username
+        and password in the url are used for basic HTTP authentication.
+        Raises urllib2.HTTPError for responses other than 200 and 206.
+        """
+        for i in xrange(MAX_REDIRECTS + 1):
+            key, selector, hdrs = prepare_request(url)
+            hdrs.update(headers or {})
+            try:
+                conn, resp = self.request(key, selector, hdrs)
+            except (httplib.HTTPException, socket.error), e:
+                raise urllib2.URLError(e)
+            res = PooledResponse(self, key, conn, resp, url)
+
+            if resp.status in (200, 206):
+                return res
+
+            location = resp.getheader('location')
+            resp.read()
+            res.close()
+            if resp.status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            raise urllib2.HTTPError(url, resp.status, resp.reason,
+                                    resp.msg, None)
+
+        raise urllib2.URLError("too many redirects: %s" % url)
+
+
+def prepare_request(url):
+    """
+    Returns a tuple(pool key, selector, headers) for a request of url,
+    taking into account authentication in the url, as well as an HTTP
+    proxy (set in the environment).
+    """
+    scheme, netloc, path, params, query, frag = urlparse.urlparse(url)
+    auth, host = urllib2.splituser(netloc)
+
+    headers = {'User-Agent': 'IronPkg/%s' % __version__}
+    if auth:
+        user, passwd = urllib2.splitpasswd(auth)
+        userpass = '%s:%s' % (urllib.unquote(user),
+                              urllib.unquote(passwd or ''))
+        headers['Authorization'] = ('Basic %s' %
+                                    base64.b64encode(userpass))
+
+    selector = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+    proxy = urllib.getproxies().get(scheme)
+    if proxy and scheme == 'http' and not urllib.proxy_bypass(host):
+        p_scheme, p_netloc = urlparse.urlparse(proxy)[:2]
+        p_auth, p_host = urllib2.splituser(p_netloc or proxy)
+        if p_auth:
+            headers['Proxy-Authorization'] = ('Basic %s' %
+                                 base64.b64encode(urllib.unquote(p_auth)))
+        selector = '%s://%s%s' % (scheme, host, selector)
+        return ('http', p_host), selector, headers
+
+    return (scheme, host), selector, headers
+
+
+# the pool used by enstaller.utils.open_url
+pool = ConnectionPool()
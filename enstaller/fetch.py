@@ -0,0 +1,280 @@
+"""
+Fetching of distributions into a local directory.  Several files may be
+fetched concurrently, using a bounded number of worker threads and a limit
+on the number of simultaneous connections to each host.
+"""
+import os
+import sys
+import Queue
+import threading
+import urlparse
+from os.path import basename, dirname, getsize, isfile, join
+
+from egginst.locking import FileLock
+from egginst.utils import ProgressBar, human_bytes, rm_rf
+from enstaller.utils import md5_file, record_md5, write_data_from_url
+
+
+# default number of worker threads, and connections per host
+MAX_WORKERS = 4
+MAX_PER_HOST = 2
+
+# ioctl request number for reflinks, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+class FetchError(Exception):
+    pass
+
+
+def host_url(url):
+    """
+    Returns the key which is used to limit the number of simultaneous
+    connections, i.e. the network location for http:// urls, and simply
+    'file' for local files.
+    """
+    if url.startswith('file://'):
+        return 'file'
+    return urlparse.urlparse(url)[1]
+
+
+def clone_file(src, dst):
+    """
+    Try to create dst as a hardlink to src, or (on Linux) as a reflink,
+    i.e. a copy-on-write clone of src.  Both are instant, as no data is
+    copied.  Returns True on success, and False if neither is supported
+    (e.g. because src and dst are on different filesystems).
+    """
+    if hasattr(os, 'link'):
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass
+
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    fi = open(src, 'rb')
+    fo = open(dst, 'wb')
+    try:
+        try:
+            fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+            return True
+        except IOError:
+            pass
+    finally:
+        fi.close()
+        fo.close()
+    os.unlink(dst)
+    return False
+
+
+def fetch_lock(dst):
+    """
+    Returns the (not yet acquired) lock which is held while the file dst is
+    fetched (or otherwise written).  The lock file is removed when the lock
+    is released.
+    """
+    return FileLock(join(dirname(dst), '.%s.lock' % basename(dst)),
+                    remove=True)
+
+
+def fetch_file(url, dst, md5=None, size=None, callback=None,
+               progress=False, trust_md5=False, tee=None, force=False):
+    """
+    Fetch the url into dst.  The data is first written to dst + '.part',
+    and only once the data is complete (and its md5 verified), the file
+    is renamed to dst, and its md5 recorded in the digest memo (such that
+    it does not need to be computed again).  If a '.part' file from an
+    earlier (interrupted) download of an http:// url exists, the download
+    is resumed.  When progress is True (and the size is known), a progress
+    bar is displayed.
+
+    For file:// urls, the file is hardlinked or cloned if possible, and
+    only copied when this fails.  When trust_md5 is True, the md5 is not
+    computed for file:// urls, i.e. the local repository is trusted to
+    contain files matching the md5 of its index.
+
+    When tee is provided, it is called with the data as it is written,
+    see write_data_from_url() (but not when the file is hardlinked or
+    cloned, or fetched by another process already).
+
+    While fetching, a lock on dst is held, such that other processes fetching
+    the same file wait, and then find the file fetched (and md5 verified)
+    already.  When force is True, the file is fetched nonetheless.
+    """
+    lock = fetch_lock(dst)
+    lock.acquire()
+    try:
+        if (not force and md5 and isfile(dst) and
+                md5_file(dst, memo=True) == md5):
+            # fetched by another process, while we were waiting for the lock
+            if callback:
+                callback(getsize(dst))
+            return
+        _fetch_file(url, dst, md5, size, callback, progress, trust_md5, tee)
+    finally:
+        lock.release()
+
+
+def _fetch_file(url, dst, md5, size, callback, progress, trust_md5, tee):
+    part = dst + '.part'
+    if url.startswith('file://'):
+        rm_rf(part)
+        if trust_md5:
+            md5 = None
+        if clone_file(url[7:], part):
+            if md5 and md5_file(url[7:]) != md5:
+                # let write_data_from_url below report the mismatch
+                os.unlink(part)
+            else:
+                if callback:
+                    callback(getsize(part))
+                if progress and size:
+                    sys.stdout.write('%9s [%s]\n' % (human_bytes(size),
+                                                      65 * '.'))
+                    sys.stdout.flush()
+                rm_rf(dst)
+                os.rename(part, dst)
+                if md5:
+                    record_md5(dst, md5)
+                return
+
+    resume = (url.startswith('http://') and isfile(part) and
+              0 < getsize(part) < (size or sys.maxint))
+    fo = open(part, 'r+b' if resume else 'wb')
+    try:
+        try:
+            write_data_from_url(fo, url, md5, size if progress else None,
+                                callback, resume, tee)
+        except SystemExit:
+            # MD5 mismatch, the data in the '.part' file cannot be resumed
+            fo.close()
+            rm_rf(part)
+            raise
+    finally:
+        fo.close()
+    rm_rf(dst)
+    os.rename(part, dst)
+    if md5:
+        # the md5 was verified while writing the data
+        record_md5(dst, md5)
+
+
+class Fetcher(object):
+    """
+    Fetches files concurrently in background threads.  jobs is a list of
+    tuples (url, dst, md5, size), where md5 and size may be None.  The
+    files are started in the order given.  If any of the fetches fails,
+    no further fetches are started.  No file is renamed into place unless
+    it was fetched completely (and its md5 verified).  When a done callback
+    is provided, it is called (from the worker thread) with the arguments
+    (url, dst, md5) for each file fetched.  The options trust_md5 and force
+    are passed to fetch_file().
+    """
+    def __init__(self, jobs, workers=MAX_WORKERS, per_host=MAX_PER_HOST,
+                 progress=True, trust_md5=False, done=None, force=False):
+        self.jobs = jobs
+        self.trust_md5 = trust_md5
+        self.force = force
+        self.done_callback = done
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.sems = {}
+        for job in jobs:
+            self.queue.put(job)
+            host = host_url(job[0])
+            if host not in self.sems:
+                self.sems[host] = threading.BoundedSemaphore(per_host)
+
+        self.progress = None
+        if progress:
+            self.progress = ProgressBar(sum(job[3] or 0 for job in jobs))
+        self.errors = []
+        self.urls = set(job[0] for job in jobs)
+        self.done = set()
+        self.cond = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        for i in xrange(min(self.workers, len(self.jobs))):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def worker(self):
+        callback = self.progress.update if self.progress else None
+        while not self.errors:
+            try:
+                url, dst, md5, size = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            sem = self.sems[host_url(url)]
+            sem.acquire()
+            try:
+                try:
+                    fetch_file(url, dst, md5, size, callback,
+                               trust_md5=self.trust_md5, force=self.force)
+                    if self.done_callback:
+                        self.done_callback(url, dst, md5)
+                except SystemExit:
+                    # write_data_from_url exits on an MD5 mismatch
+                    self.finished(url, 'MD5 sums mismatch')
+                except Exception, e:
+                    self.finished(url, e)
+                else:
+                    self.finished(url)
+            finally:
+                sem.release()
+
+    def finished(self, url, error=None):
+        self.cond.acquire()
+        try:
+            if error is None:
+                self.done.add(url)
+            else:
+                self.errors.append((url, error))
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def check_errors(self):
+        if self.errors:
+            # '.part' files of interrupted downloads are kept, such that the
+            # next attempt can resume them (corrupted ones are already
+            # removed)
+            raise FetchError('\n'.join("Could not fetch %s: %s" % (url, e)
+                                       for url, e in self.errors))
+
+    def wait(self, url):
+        """
+        Wait until the url is fetched.  Raises FetchError if any of the
+        fetches failed.  Returns immediately for urls which are not fetched
+        by this object.
+        """
+        if url not in self.urls:
+            self.check_errors()
+            return
+        self.cond.acquire()
+        try:
+            while url not in self.done and not self.errors:
+                # a timeout makes the wait interruptible (Ctrl-C)
+                self.cond.wait(1)
+        finally:
+            self.cond.release()
+        self.check_errors()
+
+    def join(self):
+        """
+        Wait until all files are fetched.  Raises FetchError if any of the
+        fetches failed.
+        """
+        for t in self.threads:
+            while t.isAlive():
+                t.join(1)
+        if self.progress:
+            self.progress.finish()
+        self.check_errors()
+
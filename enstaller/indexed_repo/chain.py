@@ -1,25 +1,39 @@
 import os
 import sys
+import gzip
+import urllib2
 import zipfile
 from cStringIO import StringIO
-from os.path import basename, getsize, isfile, isdir, join
+from os.path import basename, dirname, isfile, isdir, join
 
 import metadata
 import dist_naming
+from delta import apply_delta
+from remote import RemoteIndexer
 from requirement import Req, add_Reqs_to_spec, filter_name, dist_as_req
-from enstaller.utils import (comparable_version, md5_file,
-                             rm_rf, write_data_from_url)
-from egginst.utils import pprint_fn_action
+from enstaller import connpool
+from enstaller.utils import (comparable_version, md5_file, record_md5,
+                             write_data_from_url)
+from enstaller.cache import LocalCache
+from enstaller.fetch import MAX_WORKERS, Fetcher, fetch_file, fetch_lock
+from egginst.utils import pprint_fn_action, rm_rf
 
 
 class Chain(object):
 
-    def __init__(self, repos=[], verbose=False):
+    def __init__(self, repos=[], verbose=False, remote_cache=None):
         self.verbose = verbose
 
+        # file in which the specs of eggs in unindexed http:// repos are
+        # cached, see index_remote() below
+        self.remote_cache = remote_cache
+
         # maps distributions to specs
         self.index = {}
 
+        # maps fetch directories to LocalCache objects
+        self.caches = {}
+
         # Chain of repositories, either local or remote
         self.repos = []
         for repo in repos:
@@ -63,10 +77,26 @@ class Chain(object):
         if self.verbose:
             print "\treading:", index_url
 
-        faux = StringIO()
-        write_data_from_url(faux, index_url)
-        index_data = faux.getvalue()
-        faux.close()
+        if index_url.startswith('http://'):
+            try:
+                fi = connpool.pool.open(index_url,
+                                        {'Accept-Encoding': 'gzip'})
+            except urllib2.HTTPError, e:
+                if e.code != 404:
+                    raise
+                # A remote url without index file
+                self.index_remote(repo)
+                return
+            index_data = fi.read()
+            if fi.info().getheader('Content-Encoding') == 'gzip':
+                index_data = gzip.GzipFile(
+                    fileobj=StringIO(index_data)).read()
+            fi.close()
+        else:
+            faux = StringIO()
+            write_data_from_url(faux, index_url)
+            index_data = faux.getvalue()
+            faux.close()
 
         new_index = metadata.parse_depend_index(index_data)
         for spec in new_index.itervalues():
@@ -282,7 +312,7 @@ class Chain(object):
 
 
     def fetch_dist(self, dist, fetch_dir, force=False, check_md5=False,
-                   dry_run=False):
+                   dry_run=False, trust_md5=False, tee=None):
         """
         Get a distribution, i.e. copy or download the distribution into
         fetch_dir.
@@ -301,20 +331,29 @@ class Chain(object):
               * If force=True, this option is has no effect, because the file
                 is forcefully downloaded, ignoring any existing file (as well
                 as the MD5).
+
+        trust_md5:
+            do not compute the MD5 of files fetched from local (file://)
+            repositories, i.e. trust that they match the MD5 in the index.
+            Local files are hardlinked or cloned when possible, in which
+            case no data needs to be read at all.
+
+        tee:
+            a function which is called with the data as it is written,
+            see enstaller.fetch.fetch_file().  Returns True if the
+            distribution was fetched.
+
+        When the previous build of the distribution is in fetch_dir, and the
+        repository publishes a delta from it, only the delta is downloaded,
+        see fetch_delta() below.
         """
-        md5 = self.index[dist].get('md5', None)
-        size = self.index[dist].get('size', None)
+        if not self.needs_fetch(dist, fetch_dir, force, check_md5, dry_run):
+            return
+        if not dry_run and self.fetch_delta(dist, fetch_dir):
+            return True
 
         fn = dist_naming.filename_dist(dist)
         dst = join(fetch_dir, fn)
-        # if force is not used, see if (i) the file exists (ii) its size is
-        # the expected (iii) optionally, make sure the md5 is the expected.
-        if (not force and isfile(dst) and getsize(dst) == size and
-                   (not check_md5 or md5_file(dst) == md5)):
-            if self.verbose:
-                print "Not forcing refetch, %r already exists" % dst
-            return
-
         pprint_fn_action(fn,
                  ['copying', 'downloading'][dist.startswith('http://')])
         if dry_run:
@@ -324,11 +363,167 @@ class Chain(object):
             print "Copying: %r" % dist
             print "     to: %r" % dst
 
-        fo = open(dst + '.part', 'wb')
-        write_data_from_url(fo, dist, md5, size)
-        fo.close()
+        spec = self.index[dist]
+        fetch_file(dist, dst, spec.get('md5'), spec.get('size'),
+                   progress=True, trust_md5=trust_md5, tee=tee, force=force)
+        cache = self.get_cache(fetch_dir)
+        cache.add(fn, spec.get('md5'), spec.get('etag'))
+        # once per download (unlike the lookups)
+        cache.flush()
+        return True
+
+
+    def fetch_dists(self, dists, fetch_dir, force=False, check_md5=False,
+                    dry_run=False, trust_md5=False, workers=MAX_WORKERS):
+        """
+        Get several distributions concurrently, using up to `workers`
+        threads.  The options are the same as for fetch_dist() above.
+        A single progress bar is displayed for all downloads.  Raises
+        FetchError if any of the distributions could not be fetched, in
+        which case no partially fetched eggs are left behind.
+        """
+        f = self.start_fetch(dists, fetch_dir, force, check_md5, dry_run,
+                             trust_md5, workers)
+        if f:
+            f.join()
+        if not dry_run:
+            self.get_cache(fetch_dir).flush()
+
+
+    def start_fetch(self, dists, fetch_dir, force=False, check_md5=False,
+                    dry_run=False, trust_md5=False, workers=MAX_WORKERS,
+                    progress=True):
+        """
+        Start fetching the distributions in the background, and return
+        the Fetcher object (or None when dry_run is used), whose wait(dist)
+        method blocks until the distribution is available in fetch_dir.
+        """
+        jobs = []
+        for dist in dists:
+            if not self.needs_fetch(dist, fetch_dir, force, check_md5,
+                                    dry_run):
+                continue
+            if not dry_run and self.fetch_delta(dist, fetch_dir):
+                # deltas are small, so they are simply fetched (and
+                # applied) before the other downloads are started
+                continue
+            fn = dist_naming.filename_dist(dist)
+            pprint_fn_action(fn,
+                     ['copying', 'downloading'][dist.startswith('http://')])
+            spec = self.index[dist]
+            jobs.append((dist, join(fetch_dir, fn),
+                         spec.get('md5'), spec.get('size')))
+
+        if dry_run:
+            return None
+        cache = self.get_cache(fetch_dir)
+        f = Fetcher(jobs, workers, progress=progress, trust_md5=trust_md5,
+                    force=force,
+                    done=lambda url, dst, md5: cache.add(
+                        basename(dst), md5, self.index[url].get('etag')))
+        f.start()
+        return f
+
+
+    def needs_fetch(self, dist, fetch_dir, force=False, check_md5=False,
+                    dry_run=False):
+        """
+        Returns True if the distribution needs to be fetched, i.e. unless
+        force is used, if the file (or a file with the same md5) does not
+        exist in fetch_dir, its size (or the ETag it was fetched with, for
+        unindexed remote repositories) is not the expected, or (optionally)
+        its md5 is not the expected.  When dry_run is True, fetch_dir is
+        not modified (see LocalCache.lookup()).
+        """
+        if force:
+            return True
+
+        md5 = self.index[dist].get('md5', None)
+        size = self.index[dist].get('size', None)
+        etag = self.index[dist].get('etag', None)
+
+        fn = dist_naming.filename_dist(dist)
+        dst = join(fetch_dir, fn)
+        if (self.get_cache(fetch_dir).lookup(fn, md5, size, etag,
+                                             link=not dry_run) and
+                   (not check_md5 or not isfile(dst) or
+                    md5_file(dst, memo=True) == md5)):
+            if self.verbose:
+                print "Not forcing refetch, %r already exists" % dst
+            return False
+        return True
+
+
+    def fetch_delta(self, dist, fetch_dir):
+        """
+        Try to reconstruct the distribution in fetch_dir from the previous
+        build (which must be in fetch_dir already) and the delta published
+        in the repository (see delta.py).  Returns True on success, and
+        False if no delta can be used, in which case the distribution needs
+        to be fetched entirely.  Deltas are only used for http:// repos.
+        """
+        spec = self.index[dist]
+        delta = spec.get('delta')
+        if not (delta and dist.startswith('http://')):
+            return False
+        base_path = join(fetch_dir, delta['base'])
+        if not (isfile(base_path) and
+                md5_file(base_path, memo=True) == delta['base_md5']):
+            return False
+
+        repo, fn = dist_naming.split_dist(dist)
+        dst = join(fetch_dir, fn)
+        # the same lock as when fetching the egg itself (see fetch_file)
+        lock = fetch_lock(dst)
+        lock.acquire()
+        try:
+            if isfile(dst) and md5_file(dst, memo=True) == spec['md5']:
+                # fetched by another process, while we were waiting
+                return True
+            if not self._fetch_delta(repo, base_path, delta, dst,
+                                     spec['md5']):
+                return False
+        finally:
+            lock.release()
+        self.get_cache(fetch_dir).add(fn, spec['md5'])
+        return True
+
+    def _fetch_delta(self, repo, base_path, delta, dst, md5):
+        part = dst + '.delta.part'
+        delta_path = join(dirname(dst), '.' + delta['file'])
+        pprint_fn_action(delta['file'], 'downloading')
+        try:
+            try:
+                fetch_file(repo + delta['file'], delta_path, delta['md5'],
+                           delta['size'], progress=True)
+                apply_delta(base_path, delta_path, part)
+            except Exception, e:
+                if self.verbose:
+                    print "Cannot use delta %r: %s" % (delta['file'], e)
+                rm_rf(part)
+                return False
+        finally:
+            rm_rf(delta_path)
+
+        if md5_file(part) != md5:
+            print ("WARNING: MD5 mismatch of %s reconstructed from delta" %
+                   basename(dst))
+            rm_rf(part)
+            return False
         rm_rf(dst)
-        os.rename(dst + '.part', dst)
+        os.rename(part, dst)
+        record_md5(dst, md5)
+        return True
+
+
+    def get_cache(self, fetch_dir):
+        """
+        Returns the LocalCache object for the fetch directory, whose state
+        is only scanned once.
+        """
+        if fetch_dir not in self.caches:
+            self.caches[fetch_dir] = LocalCache(fetch_dir)
+        return self.caches[fetch_dir]
 
 
     def dirname_repo(self, repo):
@@ -361,6 +556,21 @@ class Chain(object):
         self.index[dist] = spec
 
 
+    def index_remote(self, repo):
+        """
+        Add all distributions of a remote repository, which has no index
+        file, to the index, by reading the specs of the eggs using Range
+        requests, see remote.py.  This is the equivalent of
+        index_all_files() below for http:// repos.
+        """
+        if self.verbose:
+            print "\tno index file, indexing:", repo
+        indexer = RemoteIndexer(self.remote_cache, verbose=self.verbose)
+        for fn, spec in indexer.index_repo(repo).iteritems():
+            add_Reqs_to_spec(spec)
+            self.index[repo + fn] = spec
+
+
     def index_all_files(self, repo):
         """
         Add all distributions to the index, see index_file() above.
@@ -0,0 +1,183 @@
+"""
+Delta eggs:  Most upgrades are new builds of the same version, e.g.
+foo-1.2-3.egg -> foo-1.2-4.egg, in which only a few files changed.  A delta
+contains the members of the new build which changed (or were added), and
+a list of the members which were removed, such that the new build can be
+reconstructed from the previous one.
+
+In order to reconstruct the egg byte by byte (such that its md5 can be
+verified), the delta works on the records of the zip-file:  The new egg is
+a sequence of segments, each of which is either data stored in the delta
+(the local headers, the changed members and the central directory), or the
+(compressed) data of an unchanged member, which is copied from the previous
+build.  The delta itself is a zip-file with the two members:
+
+DELTA-INFO/manifest:
+    the segments, the names of the base and target egg, as well as the
+    removed and changed members
+
+DELTA-INFO/data:
+    the data of all segments which are stored in the delta
+"""
+import os
+import struct
+import zipfile
+from os.path import basename
+
+from dist_naming import split_eggname
+
+
+MANIFEST = 'DELTA-INFO/manifest'
+DATA = 'DELTA-INFO/data'
+
+
+def delta_name(base_fn, target_fn):
+    """
+    Returns the filename of the delta between two builds, e.g.
+    'foo-1.2-3_4.delta' for 'foo-1.2-3.egg' and 'foo-1.2-4.egg'.
+    """
+    return '%s_%i.delta' % (base_fn[:-4], split_eggname(target_fn)[2])
+
+
+def previous_build(fn, fns):
+    """
+    Returns the filename of the previous build (of the same name and
+    version) of the egg fn from the list of filenames fns, or None.
+    """
+    name, version, build = split_eggname(fn)
+    res = None
+    for fn2 in fns:
+        if not fn2.endswith('.egg'):
+            continue
+        n2, v2, b2 = split_eggname(fn2)
+        if (n2 == name and v2 == version and b2 < build and
+                (res is None or b2 > split_eggname(res)[2])):
+            res = fn2
+    return res
+
+
+def zip_records(path):
+    """
+    Returns a list of tuple(arcname, CRC, header start, data start, end)
+    of the members of the zip-file in the order they are stored, and the
+    offset of the central directory.
+    """
+    z = zipfile.ZipFile(path)
+    infos = sorted(z.infolist(), key=lambda info: info.header_offset)
+    cd_offset = z.start_dir
+    z.close()
+
+    fi = open(path, 'rb')
+    res = []
+    for i, info in enumerate(infos):
+        fi.seek(info.header_offset)
+        fn_len, extra_len = struct.unpack('<2H', fi.read(30)[26:30])
+        if i + 1 < len(infos):
+            end = infos[i + 1].header_offset
+        else:
+            end = cd_offset
+        res.append((info.filename, info.CRC, info.header_offset,
+                    info.header_offset + 30 + fn_len + extra_len, end))
+    fi.close()
+    return res, cd_offset
+
+
+def read_range(fi, start, end):
+    fi.seek(start)
+    return fi.read(end - start)
+
+
+def make_delta(base_path, target_path, delta_path):
+    """
+    Write the delta between the two eggs to delta_path.
+    """
+    base_recs, unused = zip_records(base_path)
+    target_recs, cd_offset = zip_records(target_path)
+    base = dict((rec[0], rec) for rec in base_recs)
+
+    fb = open(base_path, 'rb')
+    ft = open(target_path, 'rb')
+    data = []
+    size = [0]
+    # list of tuple(source, offset, length), where source is 'b' (base egg)
+    # or 'd' (delta data)
+    segments = []
+
+    def add_data(s):
+        if not s:
+            return
+        if segments and segments[-1][0] == 'd':
+            src, offset, length = segments.pop()
+            segments.append(('d', offset, length + len(s)))
+        else:
+            segments.append(('d', size[0], len(s)))
+        data.append(s)
+        size[0] += len(s)
+
+    changed = []
+    pos = 0
+    for arcname, crc, start, data_start, end in target_recs:
+        add_data(read_range(ft, pos, data_start))
+        pos = end
+        chunk = read_range(ft, data_start, end)
+        b = base.get(arcname)
+        if (b and b[1] == crc and b[4] - b[3] == end - data_start and
+                read_range(fb, b[3], b[4]) == chunk):
+            segments.append(('b', b[3], end - data_start))
+        else:
+            changed.append(arcname)
+            add_data(chunk)
+    ft.seek(pos)
+    add_data(ft.read())
+    fb.close()
+    ft.close()
+
+    target_names = set(rec[0] for rec in target_recs)
+    manifest = ['base = %r' % basename(base_path),
+                'target = %r' % basename(target_path),
+                'removed = %r' % sorted(set(base) - target_names),
+                'changed = %r' % changed,
+                'segments = [']
+    for seg in segments:
+        manifest.append('  %r,' % (seg,))
+    manifest.append(']\n')
+
+    z = zipfile.ZipFile(delta_path, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr(MANIFEST, '\n'.join(manifest))
+    z.writestr(DATA, ''.join(data))
+    z.close()
+
+
+def read_manifest(z):
+    d = {}
+    exec z.read(MANIFEST).replace('\r', '') in d
+    return d
+
+
+def apply_delta(base_path, delta_path, dst_path):
+    """
+    Reconstruct the egg from the previous build and the delta, and write
+    it to dst_path.  The caller is responsible for verifying its md5.
+    """
+    z = zipfile.ZipFile(delta_path)
+    manifest = read_manifest(z)
+    data = z.read(DATA)
+    z.close()
+
+    fb = open(base_path, 'rb')
+    fo = open(dst_path, 'wb')
+    try:
+        for src, offset, length in manifest['segments']:
+            if src == 'b':
+                fb.seek(offset)
+                while length:
+                    chunk = fb.read(min(length, 65536))
+                    if not chunk:
+                        raise IOError("truncated base egg: %s" % base_path)
+                    fo.write(chunk)
+                    length -= len(chunk)
+            else:
+                fo.write(data[offset:offset + length])
+    finally:
+        fo.close()
+        fb.close()
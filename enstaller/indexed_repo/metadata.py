@@ -9,8 +9,10 @@ from os.path import basename, isfile, join, getmtime, getsize
 
 from dist_naming import is_valid_eggname
 from requirement import Req
+from delta import delta_name, previous_build, make_delta, apply_delta
 
 from enstaller.utils import md5_file
+from egginst.utils import replace
 
 
 def parse_index(data):
@@ -107,6 +109,8 @@ def parse_data(data, index=False):
             var_names.append('mtime')
         if 'commit' in spec:
             var_names.append('commit')
+        if 'delta' in spec:
+            var_names.append('delta')
 
     res = {}
     for name in var_names:
@@ -158,26 +162,60 @@ def commit_from_dist(zip_path):
     return res
 
 
-def index_section(zip_path):
+def index_section(zip_path, delta=None):
     """
     Returns a section corresponding to the zip-file, which can be appended
-    to an index.
+    to an index.  delta is the dictionary describing the delta from the
+    previous build (see publish_delta() below), if any.
     """
     return ('==> %s <==\n' % basename(zip_path) +
             'size = %i\n'  % getsize(zip_path) +
             'md5 = %r\n' % md5_file(zip_path) +
             'mtime = %r\n' % getmtime(zip_path) +
+            ('delta = %r\n' % delta if delta else '') +
             commit_from_dist(zip_path) +
             '\n' +
             rawspec_from_dist(zip_path) + '\n')
 
 
-def update_index(dir_path, force=False, verbose=False):
+def publish_delta(dir_path, base_fn, fn):
+    """
+    Create the delta from the egg base_fn to the egg fn (both in dir_path),
+    and return the dictionary describing it, which is recorded in the index.
+    If the delta is not significantly smaller than the egg itself, or does
+    not reconstruct the egg exactly, no delta is published and None is
+    returned.
+    """
+    base_path = join(dir_path, base_fn)
+    path = join(dir_path, fn)
+    delta_fn = delta_name(base_fn, fn)
+    delta_path = join(dir_path, delta_fn)
+    make_delta(base_path, path, delta_path)
+
+    tmp_path = delta_path + '.tmp'
+    apply_delta(base_path, delta_path, tmp_path)
+    ok = md5_file(tmp_path) == md5_file(path)
+    os.unlink(tmp_path)
+    if not ok or getsize(delta_path) > getsize(path) / 2:
+        os.unlink(delta_path)
+        return None
+
+    return dict(base=base_fn, base_md5=md5_file(base_path),
+                file=delta_fn, size=getsize(delta_path),
+                md5=md5_file(delta_path))
+
+
+def update_index(dir_path, force=False, verbose=False, deltas=False):
     """
     Updates index-depend.txt in the directory specified.
     If index-depend.txt already exists, its content (which contains
     modification time stamps) is used to create the updated file.
     This can be disabled using the force option.
+
+    When deltas is True, a delta from the previous build (of the same
+    version) is published for each egg, see delta.py, and the delta files
+    which are no longer in the index (e.g. because one of their eggs was
+    removed) are removed, once the index is updated.
     """
     txt_path = join(dir_path, 'index-depend.txt')
     if verbose:
@@ -190,25 +228,59 @@ def update_index(dir_path, force=False, verbose=False):
 
     # since generating the new data may take a while, we first write to memory
     # and then write the file afterwards.
-    faux = StringIO()
+    fns = []
     for fn in sorted(os.listdir(dir_path), key=string.lower):
         if not fn.endswith('.egg'):
             continue
         if not is_valid_eggname(fn):
             print "WARNING: ignoring invalid egg name:", fn
             continue
+        fns.append(fn)
+
+    faux = StringIO()
+    # the delta files in the index
+    published = set()
+    for fn in fns:
         path = join(dir_path, fn)
+        base_fn = previous_build(fn, fns) if deltas else None
         if fn in section:
             spec = parse_data(section[fn], index=True)
-            if spec.get('mtime') == getmtime(path):
+            delta = spec.get('delta')
+            if spec.get('mtime') == getmtime(path) and (
+                    base_fn is None or (delta and delta['base'] == base_fn and
+                                        isfile(join(dir_path,
+                                                    delta['file'])))):
+                data = section[fn]
+                if delta and base_fn is None:
+                    # deltas are no longer published (or the previous
+                    # build is gone)
+                    data = re.sub(r'(?m)^delta = .*\n', '', data)
+                elif delta:
+                    published.add(delta['file'])
                 faux.write('==> %s <==\n' % fn)
-                faux.write(section[fn] + '\n')
+                faux.write(data + '\n')
                 continue
-        faux.write(index_section(path))
+        delta = publish_delta(dir_path, base_fn, fn) if base_fn else None
+        if delta:
+            published.add(delta['file'])
+        faux.write(index_section(path, delta))
         if verbose:
             sys.stdout.write('.')
             sys.stdout.flush()
 
     if verbose:
         print
+    # write to a temporary file first, such that the index is replaced
+    # atomically
+    fo = open(txt_path + '.tmp', 'w')
+    fo.write(faux.getvalue())
+    fo.close()
     faux.close()
+    replace(txt_path + '.tmp', txt_path)
+
+    if deltas:
+        for fn in os.listdir(dir_path):
+            if fn.endswith('.delta') and fn not in published:
+                if verbose:
+                    print "Removing:", fn
+                os.unlink(join(dir_path, fn))
@@ -0,0 +1,252 @@
+"""
+Indexing of remote (http://) repositories which do not publish an index
+file.  Instead of downloading each egg, only the parts of the egg which
+are needed to read EGG-INFO/spec/depend are requested using HTTP Range
+requests:  The end of the egg (which contains the end of central directory
+record, and usually the central directory itself), and the local record of
+spec/depend (which is often in the same range already).  Hence, an egg
+typically costs one to three small requests.  The eggs are indexed
+concurrently.
+
+The specs are cached by the ETag of the egg, such that an egg which has not
+changed only costs a single (conditional) request which returns no data.
+
+Note that, unlike the specs in an index file, these specs contain no md5
+(which would require reading the entire egg), so the data of the eggs
+fetched from such repositories cannot be verified.  Instead, the ETag of
+each egg is added to its spec, and the local repository uses it (in
+addition to the size) to tell whether a fetched egg is still current.
+"""
+import os
+import re
+import zlib
+import Queue
+import struct
+import threading
+import urllib2
+from os.path import dirname, isdir, isfile
+
+import metadata
+from dist_naming import is_valid_eggname
+from enstaller import connpool
+from enstaller.fetch import MAX_WORKERS
+from egginst.utils import replace
+
+
+# number of bytes requested from the end of each egg
+TAIL_SIZE = 16384
+
+SPEC_ARCNAME = 'EGG-INFO/spec/depend'
+
+EOCD_SIG = 'PK\005\006'
+# signature, disk numbers, number of entries (on this disk, total),
+# size and offset of the central directory, comment length
+EOCD_FMT = '<4s4H2LH'
+EOCD_SIZE = struct.calcsize(EOCD_FMT)
+
+CENTRAL_SIG = 'PK\001\002'
+# signature, versions, flags, method, time, date, CRC32, compressed size,
+# uncompressed size, filename, extra and comment length, disk number,
+# internal and external attributes, offset of local header
+CENTRAL_FMT = '<4s4B4HL2L5H2L'
+CENTRAL_SIZE = struct.calcsize(CENTRAL_FMT)
+
+LOCAL_SIZE = 30
+
+
+egg_pat = re.compile(r'[\w.]+-[\w.]+-\d+\.egg')
+
+def list_eggs(repo):
+    """
+    Returns the sorted list of egg filenames in the listing of the remote
+    repository, i.e. the eggs linked from an HTML directory index (or
+    listed as keys of a bucket listing).
+    """
+    fi = connpool.pool.open(repo)
+    data = fi.read()
+    fi.close()
+    return sorted(set(fn for fn in egg_pat.findall(data)
+                      if is_valid_eggname(fn)))
+
+
+class NotModified(Exception):
+    pass
+
+
+class RemoteIndexer(object):
+    """
+    Reads the specs of the eggs in remote repositories, see above.  When
+    cache_path is given, the specs are cached (by ETag) in this file.
+    """
+    def __init__(self, cache_path=None, workers=MAX_WORKERS, verbose=False):
+        self.cache_path = cache_path
+        self.workers = workers
+        self.verbose = verbose
+        # maps urls of eggs to tuple(ETag, size, raw spec data)
+        self.cache = {}
+        self.lock = threading.Lock()
+        if cache_path and isfile(cache_path):
+            d = {}
+            execfile(cache_path, d)
+            self.cache = d['entries']
+
+    def save(self):
+        if not self.cache_path:
+            return
+        if not isdir(dirname(self.cache_path)):
+            os.makedirs(dirname(self.cache_path))
+        tmp = '%s.%i.tmp' % (self.cache_path, os.getpid())
+        fo = open(tmp, 'w')
+        fo.write('# specs of eggs in unindexed remote repositories\n')
+        fo.write('entries = {\n')
+        for url in sorted(self.cache):
+            fo.write('  %r: %r,\n' % (url, self.cache[url]))
+        fo.write('}\n')
+        fo.close()
+        replace(tmp, self.cache_path)
+
+    def get_range(self, url, start, end=None, etag=None):
+        """
+        Request the bytes start to end (inclusive) of the url, or the last
+        -start bytes when start is negative.  Returns a tuple(data, offset
+        of the data, total size, ETag).  When etag is given, and the egg
+        still has this ETag, NotModified is raised.
+        """
+        if start < 0:
+            rng = 'bytes=%i' % start
+        else:
+            rng = 'bytes=%i-%i' % (start, end)
+        headers = {'Range': rng}
+        if etag:
+            headers['If-None-Match'] = etag
+        try:
+            fi = connpool.pool.open(url, headers)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                raise NotModified
+            raise
+        data = fi.read()
+        info = fi.info()
+        fi.close()
+        if fi.code == 206:
+            m = re.match(r'bytes (\d+)-\d+/(\d+)',
+                         info.getheader('Content-Range', ''))
+            offset, size = int(m.group(1)), int(m.group(2))
+        else:
+            # the server ignored the Range request, and sent everything
+            offset, size = 0, len(data)
+        return data, offset, size, info.getheader('ETag')
+
+    def read_spec(self, url):
+        """
+        Returns a tuple(ETag, size, raw spec data) of the egg at url.
+        """
+        cached = self.cache.get(url)
+        try:
+            data, offset, size, etag = self.get_range(
+                url, -TAIL_SIZE, etag=cached and cached[0])
+        except NotModified:
+            return cached
+
+        def get(start, n):
+            # return n bytes starting at start, using the data we have when
+            # possible
+            if offset <= start and start + n <= offset + len(data):
+                return data[start - offset:start + n - offset]
+            res, unused, unused, etag2 = self.get_range(url, start,
+                                                        start + n - 1)
+            if etag2 != etag:
+                raise IOError("%s changed while being indexed" % url)
+            return res
+
+        pos = data.rfind(EOCD_SIG)
+        if pos < 0 or len(data) - pos < EOCD_SIZE:
+            raise IOError("%s: end of central directory not found" % url)
+        cd_size, cd_offset = struct.unpack(
+            EOCD_FMT, data[pos:pos + EOCD_SIZE])[5:7]
+        cd = get(cd_offset, cd_size)
+
+        pos = 0
+        while cd[pos:pos + 4] == CENTRAL_SIG:
+            rec = struct.unpack(CENTRAL_FMT, cd[pos:pos + CENTRAL_SIZE])
+            method, crc, csize = rec[6], rec[9], rec[10]
+            fn_len, extra_len, comment_len = rec[12:15]
+            header_offset = rec[18]
+            arcname = cd[pos + CENTRAL_SIZE:pos + CENTRAL_SIZE + fn_len]
+            if arcname == SPEC_ARCNAME:
+                break
+            pos += CENTRAL_SIZE + fn_len + extra_len + comment_len
+        else:
+            raise KeyError("arcname=%r not in zip-file %s" %
+                           (SPEC_ARCNAME, url))
+
+        rec = get(header_offset, LOCAL_SIZE + fn_len + extra_len + csize)
+        # the extra field of the local header may differ from the one in
+        # the central directory
+        fn_len, extra_len = struct.unpack('<2H', rec[26:30])
+        start = LOCAL_SIZE + fn_len + extra_len
+        raw = rec[start:start + csize]
+        if len(raw) < csize:
+            raw = get(header_offset + start, csize)
+        if method == 8:
+            raw = zlib.decompress(raw, -15)
+        elif method != 0:
+            raise IOError("%s: unsupported compression of %s" %
+                          (url, SPEC_ARCNAME))
+        if zlib.crc32(raw) & 0xffffffff != crc:
+            raise IOError("%s: CRC mismatch of %s" % (url, SPEC_ARCNAME))
+        return etag, size, raw
+
+    def index_repo(self, repo):
+        """
+        Returns a dictionary mapping the filenames of the eggs in the
+        remote repository to their specs (which also contain the size, and
+        the ETag).  Eggs which cannot be indexed are skipped (with a
+        warning).
+        """
+        fns = list_eggs(repo)
+        queue = Queue.Queue()
+        for fn in fns:
+            queue.put(fn)
+        res = {}
+
+        def worker():
+            while True:
+                try:
+                    fn = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                url = repo + fn
+                try:
+                    etag, size, raw = self.read_spec(url)
+                    spec = metadata.parse_data(raw)
+                except Exception, e:
+                    print "WARNING: could not index %s: %s" % (url, e)
+                    continue
+                spec['size'] = size
+                spec['etag'] = etag
+                self.lock.acquire()
+                try:
+                    res[fn] = spec
+                    if etag:
+                        self.cache[url] = etag, size, raw
+                finally:
+                    self.lock.release()
+                if self.verbose:
+                    print "\tindexed", url
+
+        threads = []
+        for i in xrange(min(self.workers, len(fns))):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            while t.isAlive():
+                t.join(1)
+        for url in self.cache.keys():
+            if url.startswith(repo) and url[len(repo):] not in res:
+                # the egg is gone
+                del self.cache[url]
+        self.save()
+        return res
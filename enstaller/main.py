@@ -13,10 +13,15 @@ from os.path import basename, dirname, getmtime, isdir, isfile, join
 from optparse import OptionParser
 
 import egginst
-from egginst.utils import pprint_fn_action
+from egginst.locking import DEFAULT_TIMEOUT, LockError, prefix_lock
+from egginst.stream import StreamExtractor
+from egginst.utils import pprint_fn_action, rm_rf
 
 import config
-from utils import canonical, cname_fn, comparable_version
+import utils
+from cache import cache_gc
+from fetch import MAX_WORKERS, FetchError
+from utils import canonical, cname_fn, comparable_version, md5_file
 from indexed_repo import (Chain, Req, add_Reqs_to_spec, spec_as_req,
                           parse_data, dist_naming)
 
@@ -24,14 +29,20 @@ from indexed_repo import (Chain, Req, add_Reqs_to_spec, spec_as_req,
 # global options variables
 dry_run = None
 verbose = None
+differential = None
+deferred = None
+staged = None
+stream = None
+lock_timeout = None
 
 
-def get_installed_info(cname):
+def get_installed_info(cname, prefix=None):
     """
     Returns a dictionary with information about the package specified by the
-    canonical name found in sys.prefix, or None if the package is not found.
+    canonical name found in prefix (sys.prefix by default), or None if the
+    package is not found.
     """
-    egg_info_dir = join(sys.prefix, 'EGG-INFO')
+    egg_info_dir = join(prefix or sys.prefix, 'EGG-INFO')
     if not isdir(egg_info_dir):
         return None
     meta_txt = join(egg_info_dir, cname, '__egginst__.txt')
@@ -44,16 +55,17 @@ def get_installed_info(cname):
                 meta_dir=dirname(meta_txt))
 
 
-def egginst_remove(pkg):
+def egginst_remove(pkg, rmdirs=True, prefix=None):
     fn = basename(pkg)
     pprint_fn_action(fn, 'removing')
     if dry_run:
-        return
-    ei = egginst.EggInst(pkg)
-    ei.remove()
+        return None
+    ei = egginst.EggInst(pkg, prefix=prefix)
+    ei.remove(rmdirs, defer=deferred)
+    return ei
 
 
-def egginst_install(conf, dist):
+def egginst_install(conf, dist, prefix=None, prestaged=None):
     repo, fn = dist_naming.split_dist(dist)
     pkg_path = join(conf['local'], fn)
 
@@ -61,24 +73,31 @@ def egginst_install(conf, dist):
     if dry_run:
         return
 
-    ei = egginst.EggInst(pkg_path)
-    ei.install()
-    info = get_installed_info(cname_fn(fn))
+    md5 = None
+    if conf['unpacked_store']:
+        # the egg was fetched into LOCAL-REPO, so its md5 is in the memo
+        md5 = md5_file(pkg_path, memo=True)
+    ei = egginst.EggInst(pkg_path, store=conf['unpacked_store'],
+                         prefix=prefix, md5=md5)
+    if prestaged:
+        ei.prestaged = prestaged
+    ei.install(differential, staged)
+    info = get_installed_info(cname_fn(fn), prefix)
     path = join(info['meta_dir'], '__enpkg__.txt')
     fo = open(path, 'w')
     fo.write("repo = %r\n" % repo)
     fo.close()
 
 
-def print_installed_info(cname):
-    info = get_installed_info(cname)
+def print_installed_info(cname, prefix=None):
+    info = get_installed_info(cname, prefix)
     if info is None:
         print "%s is not installed" % cname
     else:
         print "%(egg_name)s was installed on: %(mtime)s" % info
 
 
-def info_option(c, cname):
+def info_option(c, cname, prefixes=None):
     print "Canonic.:", cname
     print "In repositories:"
     req = Req(cname)
@@ -93,7 +112,8 @@ def info_option(c, cname):
         print "Requirements: %s" % ', '.join(sorted(reqs))
 
     print "Available versions: %s" % ', '.join(c.list_versions(cname))
-    print_installed_info(cname)
+    for prefix in iter_prefixes(prefixes):
+        print_installed_info(cname, prefix)
 
 
 repo_pat = re.compile(r'/repo/([^\s/]+/[^\s/]+)/')
@@ -105,15 +125,15 @@ def shorten_repo(repo):
         return repo.replace('http://', '').replace('.enthought.com', '')
 
 
-def print_installed(pat=None):
+def print_installed(pat=None, prefix=None):
     fmt = '%-20s %-20s %s'
     print fmt % ('Project name', 'Version', 'Repository')
     print 60 * '='
-    for fn in egginst.get_installed():
+    for fn in egginst.get_installed(prefix):
         if pat and not pat.search(fn[:-4]):
             continue
         lst = list(egginst.name_version_fn(fn))
-        info = get_installed_info(cname_fn(fn))
+        info = get_installed_info(cname_fn(fn), prefix)
         if info is None:
             lst.append('')
         else:
@@ -127,12 +147,12 @@ def print_installed(pat=None):
         print fmt % tuple(lst)
 
 
-def whats_new(c):
+def whats_new(c, prefix=None):
     fmt = '%-25s %-15s %s'
     print fmt % ('Name', 'installed', 'available')
     print 60* "="
 
-    inst = set(egginst.get_installed())
+    inst = set(egginst.get_installed(prefix))
 
     something_new = False
     for egg_name in inst:
@@ -174,12 +194,12 @@ def search(c, pat=None):
         print fmt % (name, ', '.join(versions),  shorten_repo(repo))
 
 
-def read_depend_files():
+def read_depend_files(prefix=None):
     """
     Returns a dictionary mapping canonical project names to the spec
-    dictionaries of the installed packages.
+    dictionaries of the packages installed in prefix.
     """
-    egg_info_dir = join(sys.prefix, 'EGG-INFO')
+    egg_info_dir = join(prefix or sys.prefix, 'EGG-INFO')
     if not isdir(egg_info_dir):
         return {}
     res = {}
@@ -195,7 +215,7 @@ def read_depend_files():
     return res
 
 
-def depend_warn(pkgs, ignore_version=False):
+def depend_warn(pkgs, ignore_version=False, prefix=None):
     """
     Warns the user about packages to be changed (i.e. removed or updated),
     if other packages depend on the package.
@@ -209,7 +229,7 @@ def depend_warn(pkgs, ignore_version=False):
     names = {}
     for pkg in pkgs:
         names[cname_fn(pkg)] = pkg
-    index = read_depend_files()
+    index = read_depend_files(prefix)
     for spec in index.itervalues():
         if spec['cname'] in names:
             continue
@@ -222,12 +242,12 @@ def depend_warn(pkgs, ignore_version=False):
                 print "Warning: %s depends on %s" % (spec_as_req(spec), req)
 
 
-def remove_req(req):
+def remove_req(req, prefix=None):
     """
-    Tries remove a package from sys.prefix given a requirement object.
-    This function is only used for the --remove option.
+    Tries remove a package from prefix (sys.prefix by default) given a
+    requirement object.  This function is only used for the --remove option.
     """
-    d = get_installed_info(req.name)
+    d = get_installed_info(req.name, prefix)
     if not d:
         print "Package %r does not seem to be installed." % req.name
         return
@@ -238,8 +258,15 @@ def remove_req(req):
             print("Version mismatch: %s is installed cannot remove %s." %
                   (pkg, req))
             return
-    depend_warn([pkg], ignore_version=True)
-    egginst_remove(pkg)
+    depend_warn([pkg], ignore_version=True, prefix=prefix)
+    lock = prefix_lock(prefix, lock_timeout)
+    lock.acquire()
+    try:
+        egginst_remove(pkg, prefix=prefix)
+    finally:
+        lock.release()
+    if deferred and not dry_run:
+        egginst.purge_trash(background=True, prefix=prefix)
 
 
 def get_dists(c, req, recur):
@@ -274,14 +301,192 @@ def iter_dists_excl(dists, exclude_fn):
         yield dist
 
 
+def remove_replaced(dist, inst, rmdirs=True, prefix=None):
+    """
+    Removes the installed packages (inst is the set of their filenames)
+    which the distribution replaces, i.e. which have the same name, unless
+    the distribution itself is already installed.  Returns the list of
+    EggInst objects of the removed packages.
+    """
+    fn = dist_naming.filename_dist(dist)
+    if fn in inst or differential:
+        # if the distribution (which needs to be installed) is already
+        # installed don't remove it, and in a differential upgrade the old
+        # files are removed by the install itself
+        return []
+    res = []
+    cname = cname_fn(fn)
+    for fn_inst in inst:
+        if cname == cname_fn(fn_inst):
+            ei = egginst_remove(fn_inst, rmdirs, prefix)
+            if ei:
+                res.append(ei)
+    return res
+
+
+def iter_prefixes(prefixes):
+    """
+    Iterates over the prefixes (or only sys.prefix, when prefixes is None),
+    and prints each one when there are several.
+    """
+    if not prefixes:
+        prefixes = [sys.prefix]
+    for prefix in prefixes:
+        if len(prefixes) > 1:
+            print
+            print "prefix: %s" % prefix
+        yield prefix
+
+
+def install_dists(c, conf, req, dists, opts, prefix=None):
+    """
+    Install the distributions (which resolve the requirement) into prefix,
+    i.e. fetch them (unless they are in the local repository already),
+    remove the packages they replace, and install them.
+    """
+    # Other processes may not install into the prefix at the same time
+    lock = prefix_lock(prefix, lock_timeout)
+    lock.acquire()
+    try:
+        _install_dists(c, conf, req, dists, opts, prefix)
+    finally:
+        lock.release()
+
+
+def stream_install(c, conf, dist, inst, check_md5=False, prefix=None):
+    """
+    Fetch the distribution, while extracting its files into a directory in
+    the prefix, and install it afterwards.  When the download fails (or the
+    MD5 does not match), the extracted files are discarded, and nothing is
+    installed.
+    """
+    dir_path = join(prefix or sys.prefix, '.stream_ironpkg', cname_fn(
+            dist_naming.filename_dist(dist)))
+    rm_rf(dir_path)
+    os.makedirs(dir_path)
+    se = StreamExtractor(dir_path)
+    try:
+        c.fetch_dist(dist, conf['local'], check_md5=check_md5,
+                     trust_md5=conf['trust_local_md5'], tee=se.feed)
+        se.close()
+        remove_replaced(dist, inst, prefix=prefix)
+        egginst_install(conf, dist, prefix, se.members)
+    finally:
+        se.close()
+        rm_rf(dir_path)
+        try:
+            os.rmdir(dirname(dir_path))
+        except OSError:
+            # used by another install
+            pass
+
+
+def _install_dists(c, conf, req, dists, opts, prefix):
+    # Warn the user about packages which depend on what will be updated
+    depend_warn([dist_naming.filename_dist(d) for d in dists], prefix=prefix)
+
+    # Packages which are installed currently
+    inst = set(egginst.get_installed(prefix))
+
+    # These are the packahes which are being excluded from being installed
+    if opts.forceall:
+        exclude = set()
+    else:
+        exclude = set(inst)
+        if opts.force:
+            exclude.discard(dist_naming.filename_dist(dists[-1]))
+
+    if staged and not dry_run:
+        # roll interrupted installs forward (or back) first
+        egginst.recover(verbose=True, prefix=prefix)
+
+    check_md5 = opts.force or opts.forceall
+    trust_md5 = conf['trust_local_md5']
+    workers = max(1, opts.jobs)
+    installed_something = False
+    try:
+        if opts.pipeline and not dry_run:
+            # Fetch distributions in the background, and install each as
+            # soon as it has arrived (its dependencies were installed before)
+            f = c.start_fetch(list(iter_dists_excl(dists, exclude)),
+                              conf['local'], check_md5=check_md5,
+                              trust_md5=trust_md5, workers=workers,
+                              progress=False)
+            for dist in iter_dists_excl(dists, exclude):
+                f.wait(dist)
+                remove_replaced(dist, inst, prefix=prefix)
+                installed_something = True
+                egginst_install(conf, dist, prefix)
+            f.join()
+            if deferred:
+                egginst.purge_trash(background=True, prefix=prefix)
+
+        elif stream and not dry_run:
+            # Extract each distribution while it is downloaded, and install
+            # it (using the extracted files) once its MD5 was verified
+            for dist in iter_dists_excl(dists, exclude):
+                stream_install(c, conf, dist, inst, check_md5, prefix)
+                installed_something = True
+            if deferred:
+                egginst.purge_trash(background=True, prefix=prefix)
+
+        else:
+            # Fetch distributions
+            c.fetch_dists(list(iter_dists_excl(dists, exclude)),
+                          conf['local'], check_md5=check_md5,
+                          dry_run=dry_run, trust_md5=trust_md5,
+                          workers=workers)
+
+            # Remove packages (in reverse install order), and then the
+            # directories which became empty
+            removed = []
+            for dist in dists[::-1]:
+                removed.extend(remove_replaced(dist, inst, rmdirs=False,
+                                               prefix=prefix))
+            egginst.remove_dirs(removed)
+            if deferred and removed:
+                # delete the old packages while the new ones are installed
+                egginst.purge_trash(background=True, prefix=prefix)
+
+            # Install packages
+            for dist in iter_dists_excl(dists, exclude):
+                installed_something = True
+                egginst_install(conf, dist, prefix)
+
+    except FetchError, e:
+        print e
+        sys.exit(1)
+
+    if not installed_something:
+        print "No update necessary, %s is up-to-date." % req
+        print_installed_info(req.name, prefix)
+
 def main():
     p = OptionParser(usage="usage: %prog [options] [name] [version]",
                      description=__doc__)
 
+    p.add_option("--cache-gc",
+                 action="store_true",
+                 help="remove the least recently used eggs, which are not "
+                      "installed, from the local repository until it fits "
+                      "into the size limit (local_size_limit) and exit")
+
     p.add_option("--config",
                  action="store_true",
                  help="display the configuration and exit")
 
+    p.add_option("--deferred-remove",
+                 action="store_true",
+                 help="when upgrading, move the files of the old packages "
+                      "into the trash (which is deleted in the background "
+                      "after the install), instead of deleting them first")
+
+    p.add_option("--differential",
+                 action="store_true",
+                 help="upgrade installed packages in place, i.e. only write "
+                      "files which changed, and remove the ones which are "
+                      "no longer part of the package")
+
     p.add_option('-f', "--force",
                  action="store_true",
                  help="force install the main package "
@@ -296,10 +501,25 @@ def main():
                  action="store_true",
                  help="show information about a package")
 
+    p.add_option('-j', "--jobs",
+                 action="store",
+                 type="int",
+                 default=MAX_WORKERS,
+                 help="number of concurrent downloads (default %default)",
+                 metavar='N')
+
     p.add_option('-l', "--list",
                  action="store_true",
                  help="list the packages currently installed on the system")
 
+    p.add_option("--lock-timeout",
+                 action="store",
+                 type="float",
+                 default=DEFAULT_TIMEOUT,
+                 help="seconds to wait for other processes installing into "
+                      "the same prefix (default %default)",
+                 metavar='SEC')
+
     p.add_option('-n', "--dry-run",
                  action="store_true",
                  help="show what would have been downloaded/removed/installed")
@@ -308,15 +528,53 @@ def main():
                  action="store_true",
                  help="neither download nor install dependencies")
 
+    p.add_option("--paranoid",
+                 action="store_true",
+                 help="when checking the MD5 of files (see --force), always "
+                      "read the files, instead of using MD5s recorded when "
+                      "the files were fetched")
+
+    p.add_option("--pipeline",
+                 action="store_true",
+                 help="install each package as soon as it (and the packages "
+                      "it depends on) have been fetched, while the remaining "
+                      "packages are still being downloaded")
+
+    p.add_option("--prefix",
+                 action="append",
+                 help="install prefix, i.e. the environment to operate on "
+                      "(default: sys.prefix), may be given more than once, "
+                      "in which case the same packages are fetched once, "
+                      "and installed into (or listed for) each prefix",
+                 metavar='PATH')
+
+    p.add_option("--purge-trash",
+                 action="store_true",
+                 help="delete the packages left in the trash (by "
+                      "--deferred-remove) and exit")
+
     p.add_option("--remove",
                  action="store_true",
                  help="remove a package")
 
+    p.add_option("--staged",
+                 action="store_true",
+                 help="extract each package into a staging directory first, "
+                      "and move the files into place afterwards, such that "
+                      "a failed install is rolled back, and interrupted "
+                      "installs are recovered")
+
     p.add_option('-s', "--search",
                  action="store_true",
                  help="search the index in the repo (chain) of packages "
                       "and display versions available.")
 
+    p.add_option("--stream",
+                 action="store_true",
+                 help="extract each package while it is downloaded, and "
+                      "install it once the download is complete and its "
+                      "MD5 was verified")
+
     p.add_option('-v', "--verbose", action="store_true")
 
     p.add_option('--version', action="store_true")
@@ -343,25 +601,56 @@ def main():
         print "IronPkg version:", __version__
         return
 
+    if opts.prefix:                               #  prefixes
+        prefixes = [utils.abs_expanduser(p) for p in opts.prefix]
+    else:
+        prefixes = [sys.prefix]
+
     if opts.config:                               #  --config
-        config.print_config()
+        config.print_config(opts.prefix and prefixes[0])
         return
 
-    if config.get_path() is None:
+    if config.get_path(prefixes[0]) is None:
         # create config file if it dosn't exist
-        config.write()
+        config.write(prefixes[0])
 
-    conf = config.read()                          #  conf
+    conf = config.read(prefixes[0])               #  conf
 
-    global dry_run, version                       #  set globals
+    global dry_run, version, differential, deferred, staged, stream
+    global lock_timeout
     dry_run = opts.dry_run
+    differential = opts.differential
+    deferred = opts.deferred_remove
+    staged = opts.staged
+    stream = opts.stream
+    lock_timeout = opts.lock_timeout
     version = opts.version
+    utils.paranoid = opts.paranoid
 
     if opts.list:                                 #  --list
-        print_installed(pat)
+        for prefix in iter_prefixes(prefixes):
+            print_installed(pat, prefix)
+        return
+
+    if opts.purge_trash:                          #  --purge-trash
+        if args:
+            p.error("Option requires no arguments")
+        for prefix in prefixes:
+            egginst.purge_trash(prefix=prefix)
+        return
+
+    if opts.cache_gc:                             #  --cache-gc
+        if args:
+            p.error("Option requires no arguments")
+        keep = set()
+        for prefix in prefixes:
+            keep.update(egginst.get_installed(prefix))
+        cache_gc(conf['local'], (conf['local_size_limit'] or 0) * 2**20,
+                 keep, opts.verbose)
         return
 
-    c = Chain(conf['IndexedRepos'], verbose)      #  init chain
+    c = Chain(conf['IndexedRepos'], verbose,      #  init chain
+              remote_cache=join(conf['local'], '.remote_index.txt'))
 
     if opts.search:                               #  --search
         search(c, pat)
@@ -370,13 +659,14 @@ def main():
     if opts.info:                                 #  --info
         if len(args) != 1:
             p.error("Option requires one argument (name of package)")
-        info_option(c, canonical(args[0]))
+        info_option(c, canonical(args[0]), prefixes)
         return
 
     if opts.whats_new:                            # --whats-new
         if args:
             p.error("Option requires no arguments")
-        whats_new(c)
+        for prefix in iter_prefixes(prefixes):
+            whats_new(c, prefix)
         return
 
     if len(args) == 0:
@@ -385,56 +675,24 @@ def main():
         p.error("A requirement is a name and an optional version")
     req = Req(' '.join(args))
 
-    if opts.remove:                               #  --remove
-        remove_req(req)
-        return
-
-    dists = get_dists(c, req,                     #  dists
-                      recur=not opts.no_deps)
-
-    # Warn the user about packages which depend on what will be updated
-    depend_warn([dist_naming.filename_dist(d) for d in dists])
-
-    # Packages which are installed currently
-    inst = set(egginst.get_installed())
-
-    # These are the packahes which are being excluded from being installed
-    if opts.forceall:
-        exclude = set()
-    else:
-        exclude = set(inst)
-        if opts.force:
-            exclude.discard(dist_naming.filename_dist(dists[-1]))
+    try:
+        if opts.remove:                           #  --remove
+            for prefix in iter_prefixes(prefixes):
+                remove_req(req, prefix)
+            return
 
-    # Fetch distributions
-    if not isdir(conf['local']):
-        os.makedirs(conf['local'])
-    for dist in iter_dists_excl(dists, exclude):
-        c.fetch_dist(dist, conf['local'],
-                     check_md5=opts.force or opts.forceall,
-                     dry_run=dry_run)
+        dists = get_dists(c, req,                 #  dists
+                          recur=not opts.no_deps)
 
-    # Remove packages (in reverse install order)
-    for dist in dists[::-1]:
-        fn = dist_naming.filename_dist(dist)
-        if fn in inst:
-            # if the distribution (which needs to be installed) is already
-            # installed don't remove it
-            continue
-        cname = cname_fn(fn)
-        for fn_inst in inst:
-            if cname == cname_fn(fn_inst):
-                egginst_remove(fn_inst)
+        if not isdir(conf['local']):
+            os.makedirs(conf['local'])
 
-    # Install packages
-    installed_something = False
-    for dist in iter_dists_excl(dists, exclude):
-        installed_something = True
-        egginst_install(conf, dist)
+        for prefix in iter_prefixes(prefixes):
+            install_dists(c, conf, req, dists, opts, prefix)
 
-    if not installed_something:
-        print "No update necessary, %s is up-to-date." % req
-        print_installed_info(req.name)
+    except LockError, e:
+        print e
+        sys.exit(1)
 
 
 if __name__ == '__main__':
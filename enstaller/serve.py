@@ -0,0 +1,269 @@
+"""
+A small threaded HTTP server for a repository directory, which knows about
+the index file:  index-depend.txt is regenerated (using update_index) when
+the eggs in the directory change, and is sent gzip compressed to clients
+which accept it.  Connections are kept alive (HTTP/1.1), all files have an
+ETag (and If-None-Match is answered with 304), and Range requests are
+supported, such that interrupted downloads can be resumed, and unindexed
+repositories can be indexed remotely (see indexed_repo/remote.py).
+"""
+import os
+import re
+import gzip
+import hashlib
+import threading
+from cStringIO import StringIO
+from os.path import getmtime, getsize, isfile, join
+from optparse import OptionParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from enstaller import __version__
+from enstaller.indexed_repo import metadata
+
+
+INDEX_FN = 'index-depend.txt'
+CHUNK_SIZE = 65536
+
+
+class IndexedRepo(object):
+    """
+    The repository directory, with its index, which is kept up-to-date
+    (and in memory) as the eggs change.
+    """
+    def __init__(self, dir_path, deltas=False, verbose=False):
+        self.dir_path = dir_path
+        self.deltas = deltas
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.state = None
+        # the data of the index, its gzip compressed data, and its md5
+        self.index = self.index_gz = self.index_md5 = None
+
+    def egg_state(self):
+        res = []
+        for fn in sorted(os.listdir(self.dir_path)):
+            if fn.endswith('.egg'):
+                path = join(self.dir_path, fn)
+                res.append((fn, getmtime(path), getsize(path)))
+        return res
+
+    def refresh(self):
+        """
+        Regenerate the index, if the eggs changed since it was last read.
+        """
+        self.lock.acquire()
+        try:
+            state = self.egg_state()
+            if state == self.state and self.index is not None:
+                return
+            if self.verbose:
+                print "Updating index of %s" % self.dir_path
+            metadata.update_index(self.dir_path, deltas=self.deltas)
+            self.index = open(join(self.dir_path, INDEX_FN), 'rb').read()
+            faux = StringIO()
+            g = gzip.GzipFile(fileobj=faux, mode='wb', mtime=0)
+            g.write(self.index)
+            g.close()
+            self.index_gz = faux.getvalue()
+            self.index_md5 = hashlib.md5(self.index).hexdigest()
+            self.state = state
+        finally:
+            self.lock.release()
+
+    def listing(self):
+        lst = ['<html><head><title>IronPkg repository</title></head><body>']
+        for fn in sorted(os.listdir(self.dir_path)):
+            if not fn.startswith('.'):
+                lst.append('<a href="%s">%s</a><br>' % (fn, fn))
+        lst.append('</body></html>\n')
+        return '\n'.join(lst)
+
+
+class RepoHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'IronPkgServe/%s' % __version__
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def handle_request(self, send_body):
+        repo = self.server.repo
+        fn = self.path.split('?')[0].lstrip('/')
+        if fn == '':
+            self.send_data(repo.listing(), 'text/html', None, send_body)
+            return
+        if '/' in fn or '\\' in fn or fn.startswith('.'):
+            self.send_error(404)
+            return
+
+        if fn == INDEX_FN:
+            try:
+                repo.refresh()
+            except Exception, e:
+                self.send_error(500, "Cannot update index: %s" % e)
+                return
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                self.send_data(repo.index_gz, 'text/plain',
+                               '"%s-gz"' % repo.index_md5, send_body,
+                               gzipped=True)
+            else:
+                self.send_data(repo.index, 'text/plain',
+                               '"%s"' % repo.index_md5, send_body)
+            return
+
+        path = join(repo.dir_path, fn)
+        if not isfile(path):
+            self.send_error(404)
+            return
+        fi = open(path, 'rb')
+        try:
+            st = os.fstat(fi.fileno())
+            etag = '"%x-%x"' % (int(st.st_mtime * 1000), st.st_size)
+            self.send_file(fi, st.st_size, etag, send_body)
+        finally:
+            fi.close()
+
+    def not_modified(self, etag):
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return True
+        return False
+
+    def get_range(self, size, etag):
+        """
+        Returns the tuple(start, end) of the requested range (end is
+        exclusive), None if the entire file is to be sent, or False if the
+        range is not satisfiable.
+        """
+        rng = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if not rng or (if_range and if_range != etag):
+            return None
+        m = re.match(r'bytes=(\d*)-(\d*)$', rng.strip())
+        if m is None or m.groups() == ('', ''):
+            # multiple ranges are not supported, send everything
+            return None
+        if m.group(1) == '':
+            start = max(0, size - int(m.group(2)))
+            end = size
+        else:
+            start = int(m.group(1))
+            end = min(size, int(m.group(2) or size - 1) + 1)
+        if start >= end:
+            return False
+        return start, end
+
+    def send_data(self, data, ctype, etag, send_body, gzipped=False):
+        if self.not_modified(etag):
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def send_file(self, fi, size, etag, send_body):
+        if self.not_modified(etag):
+            return
+        rng = self.get_range(size, etag)
+        if rng is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%i' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if rng is None:
+            start, end = 0, size
+            self.send_response(200)
+        else:
+            start, end = rng
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %i-%i/%i' % (start, end - 1, size))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('ETag', etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not send_body:
+            return
+        fi.seek(start)
+        left = end - start
+        while left:
+            chunk = fi.read(min(left, CHUNK_SIZE))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            left -= len(chunk)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class RepoServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, repo, verbose=False):
+        HTTPServer.__init__(self, address, RepoHandler)
+        self.repo = repo
+        self.verbose = verbose
+
+
+def main():
+    p = OptionParser(usage="usage: %prog [options] [DIRECTORY]",
+                     description=__doc__)
+
+    p.add_option('-b', "--bind",
+                 action="store",
+                 default='',
+                 help="address to bind to (default: all interfaces)",
+                 metavar='ADDR')
+
+    p.add_option("--deltas",
+                 action="store_true",
+                 help="publish deltas between consecutive builds, when "
+                      "regenerating the index")
+
+    p.add_option('-p', "--port",
+                 action="store",
+                 type="int",
+                 default=8000,
+                 help="port to listen on (default %default)")
+
+    p.add_option('-v', "--verbose", action="store_true")
+
+    opts, args = p.parse_args()
+
+    if len(args) > 1:
+        p.error("At most one argument (the directory) expected")
+    dir_path = os.path.abspath(args[0] if args else '.')
+
+    repo = IndexedRepo(dir_path, opts.deltas, opts.verbose)
+    repo.refresh()
+    server = RepoServer((opts.bind, opts.port), repo, opts.verbose)
+    print "Serving %s on port %i" % (dir_path, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
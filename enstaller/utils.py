@@ -1,11 +1,13 @@
+import os
 import sys
 import hashlib
-import urlparse
+import threading
 import urllib2
-from os.path import abspath, expanduser
+from os.path import abspath, expanduser, join
 
-from egginst.utils import human_bytes, rm_rf
-from enstaller import __version__
+import egginst.utils
+from egginst.utils import human_bytes, replace, rm_rf
+from enstaller import connpool
 from enstaller.verlib import NormalizedVersion, IrrationalVersionError
 
 
@@ -44,58 +46,201 @@ def comparable_version(version):
         return version
 
 
-def md5_file(path):
+# The digest memo maps the (inode, size, mtime) of files to their md5, and
+# is stored in a file in the directory.  It is only used for the directory
+# into which eggs are fetched (LOCAL-REPO), i.e. when md5_file() is called
+# with memo=True, and never for repositories (whose index md5s need to be
+# computed from the data).  When paranoid is True, md5_file() always reads
+# the file, instead of using the memo.
+MEMO_FN = '.digests.txt'
+paranoid = False
+memo_lock = threading.Lock()
+memos = {}
+
+
+def read_memo(dir_path):
+    """
+    Returns the digest memo for the directory, which maps filenames to
+    tuples((inode, size, mtime), md5).
+    """
+    if dir_path in memos:
+        return memos[dir_path]
+    memo = memos[dir_path] = {}
+    try:
+        fi = open(join(dir_path, MEMO_FN))
+    except IOError:
+        return memo
+    for line in fi:
+        md5, ino, size, mtime, fn = line.rstrip('\n').split(' ', 4)
+        try:
+            memo[fn] = (int(ino), int(size), int(mtime)), md5
+        except ValueError:
+            # written by an older version (with a float mtime)
+            continue
+    fi.close()
+    return memo
+
+
+def stat_key(path):
+    st = os.stat(path)
+    # the mtime as integer nanoseconds, which (unlike a float) is stored
+    # and compared exactly
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return st.st_ino, st.st_size, mtime_ns
+
+
+def record_md5(path, md5):
+    """
+    Record the md5 of the file at path, which is known already, e.g.
+    because it was computed while the file was written, in the memo.
+    """
+    dir_path, fn = os.path.split(abspath(path))
+    memo_lock.acquire()
+    try:
+        memo = read_memo(dir_path)
+        memo[fn] = stat_key(path), md5
+        # other processes may read (or write) the memo at the same time,
+        # so it is replaced atomically
+        path = join(dir_path, MEMO_FN)
+        tmp = '%s.%i.tmp' % (path, os.getpid())
+        try:
+            fo = open(tmp, 'w')
+            for fn in sorted(memo):
+                (ino, size, mtime), md5 = memo[fn]
+                fo.write('%s %i %i %i %s\n' % (md5, ino, size, mtime, fn))
+            fo.close()
+            replace(tmp, path)
+        except (IOError, OSError):
+            # the directory may not be writable, which is fine
+            pass
+    finally:
+        memo_lock.release()
+
+
+def md5_file(path, memo=False):
     """
     Returns the md5sum of the file (located at `path`) as a hexadecimal
-    string of length 32.
+    string of length 32.  When memo is True (only for files in LOCAL-REPO),
+    the md5 is taken from the digest memo (unless paranoid is True), when
+    the file has not changed since it was recorded, and recorded otherwise.
+    """
+    if memo and not paranoid:
+        dir_path, fn = os.path.split(abspath(path))
+        memo_lock.acquire()
+        try:
+            entry = read_memo(dir_path).get(fn)
+        finally:
+            memo_lock.release()
+        if entry and entry[0] == stat_key(path):
+            return entry[1]
+
+    md5 = egginst.utils.md5_file(path)
+    if memo:
+        record_md5(path, md5)
+    return md5
+
+
+def open_url(url, offset=0):
+    """
+    Open the url through the pool of persistent connections, handling
+    HTTP authentication (username and password in the url).  When an
+    offset is given, only the data starting at offset is requested (the
+    server may ignore this, see resume_url below).
+    """
+    headers = {}
+    if offset:
+        headers['Range'] = 'bytes=%i-' % offset
+    return connpool.pool.open(url, headers)
+
+
+def resume_url(fo, url):
+    """
+    Resume a download into the file handle fo, which must be open for
+    reading and writing, and already contains the beginning of the data.
+    Returns a tuple(file-like object, hash object, offset), where the md5
+    object already contains the data in fo.  If the server ignores the
+    Range request, fo is truncated and the download starts from zero.
     """
-    fi = open(path, 'rb')
     h = hashlib.new('md5')
+    offset = 0
+    fo.seek(0)
     while True:
-        chunk = fi.read(65536)
+        chunk = fo.read(65536)
         if not chunk:
             break
         h.update(chunk)
-    fi.close()
-    return h.hexdigest()
-
-
-def open_url(url):
-    """
-    Open a urllib2 request, handling HTTP authentication
-    """
-    scheme, netloc, path, params, query, frag = urlparse.urlparse(url)
-    assert not query
-    auth, host = urllib2.splituser(netloc)
+        offset += len(chunk)
 
-    request = urllib2.Request(url)
-    request.add_header('User-Agent', 'IronPkg/%s' % __version__)
-    return urllib2.urlopen(request)
+    try:
+        fi = open_url(url, offset)
+    except urllib2.HTTPError, e:
+        if e.code != 416:
+            raise
+        # requested range not satisfiable, e.g. the data in fo is already
+        # longer than the file on the server
+        fi = open_url(url)
+    content_range = fi.info().getheader('Content-Range', '')
+    if offset and not (fi.code == 206 and
+                       content_range.startswith('bytes %i-' % offset)):
+        if fi.code == 206:
+            # the server send a different range than requested
+            fi.close()
+            fi = open_url(url)
+        h = hashlib.new('md5')
+        offset = 0
+        fo.seek(0)
+        fo.truncate()
+    fo.seek(0, 2)
+    return fi, h, offset
 
 
-def write_data_from_url(fo, url, md5=None, size=None):
+def write_data_from_url(fo, url, md5=None, size=None, callback=None,
+                        resume=False, tee=None):
     """
     Read data from the url and write to the file handle fo, which must be
     open for writing.  Optionally check the MD5.  When the size in bytes
     is provided, a progress bar is displayed using the download/copy.
+    When a callback is provided, it is called with the number of bytes of
+    each chunk written, which allows progress to be reported elsewhere.
+    When resume is True, the http:// download continues after the data
+    already in fo, see resume_url above.  When tee is provided, it is
+    called with all data (including the data already in fo, when
+    resuming), e.g. to extract an egg while it is downloaded.
     """
-    if size:
-        sys.stdout.write('%9s [' % human_bytes(size))
-        sys.stdout.flush()
-        n = cur = 0
+    h = hashlib.new('md5')
+    n = 0
 
     if url.startswith('file://'):
         path = url[7:]
         fi = open(path, 'rb')
     elif url.startswith('http://'):
         try:
-            fi = open_url(url)
+            if resume:
+                fi, h, n = resume_url(fo, url)
+            else:
+                fi = open_url(url)
         except urllib2.URLError, e:
             raise urllib2.URLError("\n%s\nCannot open URL:\n    %s" % (e, url))
     else:
         raise Exception("Invalid url: %r" % url)
 
-    h = hashlib.new('md5')
+    if callback and n:
+        callback(n)
+    if tee and n:
+        fo.seek(0)
+        while True:
+            chunk = fo.read(65536)
+            if not chunk:
+                break
+            tee(chunk)
+        fo.seek(0, 2)
+    if size:
+        sys.stdout.write('%9s [' % human_bytes(size))
+        cur = int(float(n) / size * 64)
+        sys.stdout.write('.' * cur)
+        sys.stdout.flush()
 
     if size and size < 131072:
         buffsize = 256
@@ -107,8 +252,12 @@ def write_data_from_url(fo, url, md5=None, size=None):
         if not chunk:
             break
         fo.write(chunk)
+        if tee:
+            tee(chunk)
         if md5:
             h.update(chunk)
+        if callback:
+            callback(len(chunk))
         if not size:
             continue
         n += len(chunk)
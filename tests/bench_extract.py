@@ -0,0 +1,84 @@
+"""
+Benchmark for installing eggs.  A synthetic egg is created and installed
+into a temporary prefix, and the time and the peak memory (on Unix
+systems) are printed.  By default, the egg has a single data file of 2048
+MB, and the peak memory should not depend on this size.  Using --files,
+an egg with many small files is created instead.
+
+    python bench_extract.py [--size MB] [--files N] [--jobs N]
+"""
+import os
+import time
+import shutil
+import tempfile
+import zipfile
+from optparse import OptionParser
+from os.path import join
+
+from egginst.main import EggInst
+
+
+def create_egg(path, size):
+    tmp = path + '.data'
+    fo = open(tmp, 'wb')
+    block = os.urandom(1024) * 1024
+    for i in xrange(size):
+        fo.write(block)
+    fo.close()
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+    z.write(tmp, 'bench/data.bin')
+    z.writestr('bench/__init__.py', '')
+    z.close()
+    os.unlink(tmp)
+
+
+def create_small_files_egg(path, n):
+    z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    for i in xrange(n):
+        z.writestr('bench/sub%i/mod%i.py' % (i % 100, i),
+                   os.urandom(2000).encode('hex'))
+    z.close()
+
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return 'n/a'
+    return '%.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                        / 1024.0)
+
+
+def main():
+    p = OptionParser(usage="usage: %prog [options]", description=__doc__)
+    p.add_option("--size", type="int", default=2048,
+                 help="size (in MB) of the single data file")
+    p.add_option("--files", type="int", default=0,
+                 help="number of small files (instead of one large file)")
+    p.add_option('-j', "--jobs", type="int", default=1,
+                 help="number of threads used for extracting")
+    opts, args = p.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        egg_path = join(tmp_dir, 'bench-1.0-1.egg')
+        if opts.files:
+            create_small_files_egg(egg_path, opts.files)
+            what = '%i files' % opts.files
+        else:
+            create_egg(egg_path, opts.size)
+            what = '%i MB member' % opts.size
+        print "peak memory before install:", peak_rss()
+
+        t0 = time.time()
+        EggInst(egg_path, workers=opts.jobs,
+                prefix=join(tmp_dir, 'prefix')).install()
+        print "installed %s (%i threads) in %.2f sec" % (what, opts.jobs,
+                                                          time.time() - t0)
+        print "peak memory after install:", peak_rss()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
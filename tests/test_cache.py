@@ -0,0 +1,112 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+from cStringIO import StringIO
+from os.path import isfile, join
+
+from enstaller.cache import ACCESS_TXT, LocalCache, cache_gc
+from enstaller.fetch import fetch_lock
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def add(self, c, fn, data):
+        open(join(self.path, fn), 'wb').write(data)
+        md5 = hashlib.md5(data).hexdigest()
+        c.add(fn, md5)
+        return md5
+
+    def test_batched_save(self):
+        c = LocalCache(self.path)
+        self.add(c, 'foo-1.0-1.egg', 'foo')
+        self.assert_(c.lookup('foo-1.0-1.egg', size=3))
+        # the access times are only written when flushed
+        self.assert_(not isfile(join(self.path, ACCESS_TXT)))
+        c.flush()
+        self.assertEqual(LocalCache(self.path).atimes.keys(),
+                         ['foo-1.0-1.egg'])
+
+    def test_relink(self):
+        c = LocalCache(self.path)
+        md5 = self.add(c, 'foo-1.0-1.egg', 'foo')
+        path = join(self.path, 'foo-1.0-1.egg')
+        os.unlink(path)
+        # the egg is found under another name by its md5
+        c = LocalCache(self.path)
+        self.assert_(c.lookup('bar-1.0-1.egg', md5, 3))
+        self.assertEqual(os.stat(join(self.path, 'bar-1.0-1.egg')).st_ino,
+                         os.stat(c.blob_path(md5)).st_ino)
+        self.assert_(not c.lookup('baz-1.0-1.egg', md5, 4))
+        self.assert_(not isfile(join(self.path, 'baz-1.0-1.egg')))
+        # in dry-run mode, nothing is linked
+        self.assert_(c.lookup('qux-1.0-1.egg', md5, 3, link=False))
+        self.assert_(not isfile(join(self.path, 'qux-1.0-1.egg')))
+
+    def test_gc(self):
+        c = LocalCache(self.path)
+        for i, fn in enumerate(['a-1.0-1.egg', 'b-1.0-1.egg',
+                                'c-1.0-1.egg']):
+            self.add(c, fn, fn * 100)
+            c.atimes[fn] = 1000 + i
+        c.save()
+        # the blobs share the data with the eggs
+        self.assertEqual(LocalCache(self.path).total_size(), 3300)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            # the least recently used egg, which is not kept, is removed
+            cache_gc(self.path, max_size=2500, keep=['a-1.0-1.egg'])
+        finally:
+            sys.stdout = stdout
+        c = LocalCache(self.path)
+        self.assertEqual(sorted(c.files), ['a-1.0-1.egg', 'c-1.0-1.egg'])
+        self.assertEqual(len(c.blobs), 2)
+        self.assertEqual(sorted(c.atimes), ['a-1.0-1.egg', 'c-1.0-1.egg'])
+
+    def test_gc_locked(self):
+        c = LocalCache(self.path)
+        for i, fn in enumerate(['a-1.0-1.egg', 'b-1.0-1.egg']):
+            self.add(c, fn, fn * 100)
+            c.atimes[fn] = 1000 + i
+        c.save()
+        # a-1.0-1.egg is being fetched by another process
+        lock = fetch_lock(join(self.path, 'a-1.0-1.egg'))
+        lock.acquire()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            cache_gc(self.path)
+        finally:
+            sys.stdout = stdout
+            lock.release()
+        self.assertEqual(sorted(LocalCache(self.path).files),
+                         ['a-1.0-1.egg'])
+
+    def test_sweep_locks(self):
+        # left behind by a process which was killed
+        path = join(self.path, '.a-1.0-1.egg.lock')
+        open(path, 'w').close()
+        open(path + '.info', 'w').close()
+        held = fetch_lock(join(self.path, 'b-1.0-1.egg'))
+        held.acquire()
+        try:
+            LocalCache(self.path).sweep_locks()
+            self.assertEqual(sorted(os.listdir(self.path)),
+                             ['.b-1.0-1.egg.lock', '.b-1.0-1.egg.lock.info'])
+        finally:
+            held.release()
+        self.assertEqual(os.listdir(self.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import base64
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib2
+from cStringIO import StringIO
+from os.path import join
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from enstaller.connpool import ConnectionPool
+from enstaller.fetch import fetch_file
+from enstaller.utils import write_data_from_url
+import enstaller.connpool as connpool
+
+
+FILES = {
+    '/index-depend.txt': 'index data\n' * 100,
+    '/foo-1.0-1.egg': 'egg data' * 10000,
+    '/bar-2.0-1.egg': '',
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.auth.append(self.headers.getheader('Authorization'))
+        data = FILES.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        rng = self.headers.getheader('Range')
+        if rng and self.server.ranges:
+            start = int(rng[6:-1])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %i-%i/%i' %
+                             (start, len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.connections = 0
+        self.server.auth = []
+        self.server.ranges = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.base = 'http://127.0.0.1:%i' % self.server.server_address[1]
+        connpool.pool.clear()
+
+    def tearDown(self):
+        connpool.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch(self, path, base=None):
+        faux = StringIO()
+        write_data_from_url(faux, (base or self.base) + path,
+                            hashlib.md5(FILES[path]).hexdigest())
+        return faux.getvalue()
+
+    def test_reuse(self):
+        for i in xrange(3):
+            for path in sorted(FILES):
+                self.assertEqual(self.fetch(path), FILES[path])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_partial_read(self):
+        pool = ConnectionPool()
+        fi = pool.open(self.base + '/foo-1.0-1.egg')
+        fi.read(10)
+        fi.close()
+        fi = pool.open(self.base + '/foo-1.0-1.egg')
+        self.assertEqual(fi.read(), FILES['/foo-1.0-1.egg'])
+        fi.close()
+        # the first connection could not be reused
+        self.assertEqual(self.server.connections, 2)
+
+    def test_error(self):
+        pool = ConnectionPool()
+        self.assertRaises(urllib2.HTTPError, pool.open,
+                          self.base + '/missing.egg')
+        fi = pool.open(self.base + '/bar-2.0-1.egg')
+        self.assertEqual(fi.read(), '')
+        fi.close()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_auth(self):
+        base = self.base.replace('://', '://joe:s%40cret@')
+        self.assertEqual(self.fetch('/index-depend.txt', base),
+                         FILES['/index-depend.txt'])
+        self.assertEqual(self.server.auth,
+                         ['Basic ' + base64.b64encode('joe:s@cret')])
+
+    def resume(self, ranges):
+        self.server.ranges = ranges
+        data = FILES['/foo-1.0-1.egg']
+        tmp_dir = tempfile.mkdtemp()
+        dst = join(tmp_dir, 'foo-1.0-1.egg')
+        fo = open(dst + '.part', 'wb')
+        fo.write(data[:1000] if ranges else 'garbage')
+        fo.close()
+        fetch_file(self.base + '/foo-1.0-1.egg', dst,
+                   hashlib.md5(data).hexdigest(), len(data))
+        self.assertEqual(open(dst, 'rb').read(), data)
+        self.assertFalse(os.path.exists(dst + '.part'))
+        shutil.rmtree(tmp_dir)
+
+    def test_resume(self):
+        self.resume(True)
+
+    def test_resume_ignored(self):
+        # the server ignores the Range header, download starts from zero
+        self.resume(False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+from os.path import isfile, join
+
+from enstaller import connpool
+from enstaller.fetch import fetch_lock
+from enstaller.utils import md5_file
+from enstaller.indexed_repo import Chain
+from enstaller.indexed_repo.delta import (delta_name, previous_build,
+                                          make_delta, apply_delta)
+from enstaller.indexed_repo.metadata import parse_depend_index, update_index
+from enstaller.serve import IndexedRepo, RepoServer
+
+
+SPEC = """\
+metadata_version = '1.1'
+name = 'foo'
+version = '1.2'
+build = %i
+
+arch = None
+platform = None
+osdist = None
+python = None
+packages = []
+"""
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def mk_egg(self, fn, members):
+        path = join(self.tmp_dir, fn)
+        z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        for arcname, data in sorted(members.iteritems()):
+            info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            z.writestr(info, data)
+        z.close()
+        return path
+
+    def mk_builds(self):
+        r = random.Random(0)
+        big = ''.join(chr(r.randrange(256)) for i in xrange(200000))
+        base = self.mk_egg('foo-1.2-3.egg', {
+                'EGG-INFO/spec/depend': SPEC % 3,
+                'foo/big.bin': big,
+                'foo/a.py': 'A',
+                'foo/old.py': 'old'})
+        target = self.mk_egg('foo-1.2-4.egg', {
+                'EGG-INFO/spec/depend': SPEC % 4,
+                'foo/big.bin': big,
+                'foo/a.py': 'AA',
+                'foo/new.py': 'new'})
+        return base, target
+
+    def test_naming(self):
+        self.assertEqual(delta_name('foo-1.2-3.egg', 'foo-1.2-4.egg'),
+                         'foo-1.2-3_4.delta')
+        fns = ['foo-1.2-1.egg', 'foo-1.2-3.egg', 'foo-1.3-2.egg',
+               'foo-1.2-4.egg', 'bar-1.2-2.egg']
+        self.assertEqual(previous_build('foo-1.2-4.egg', fns),
+                         'foo-1.2-3.egg')
+        self.assertEqual(previous_build('foo-1.2-1.egg', fns), None)
+
+    def test_round_trip(self):
+        base, target = self.mk_builds()
+        delta = join(self.tmp_dir, 'foo-1.2-3_4.delta')
+        make_delta(base, target, delta)
+        self.assert_(os.path.getsize(delta) < os.path.getsize(target) / 10)
+        z = zipfile.ZipFile(delta)
+        manifest = {}
+        exec z.read('DELTA-INFO/manifest') in manifest
+        z.close()
+        self.assertEqual(manifest['removed'], ['foo/old.py'])
+        self.assertEqual(sorted(manifest['changed']), [
+                'EGG-INFO/spec/depend', 'foo/a.py', 'foo/new.py'])
+
+        dst = join(self.tmp_dir, 'out.egg')
+        apply_delta(base, delta, dst)
+        self.assertEqual(open(dst, 'rb').read(), open(target, 'rb').read())
+
+    def test_update_index(self):
+        base, target = self.mk_builds()
+        update_index(self.tmp_dir, deltas=True)
+        index = parse_depend_index(
+            open(join(self.tmp_dir, 'index-depend.txt')).read())
+        self.assert_('delta' not in index['foo-1.2-3.egg'])
+        delta = index['foo-1.2-4.egg']['delta']
+        self.assertEqual(delta['base'], 'foo-1.2-3.egg')
+        self.assertEqual(delta['base_md5'], md5_file(base))
+        path = join(self.tmp_dir, delta['file'])
+        self.assert_(isfile(path))
+        self.assertEqual(delta['md5'], md5_file(path))
+
+    def test_stale_delta(self):
+        base, target = self.mk_builds()
+        update_index(self.tmp_dir, deltas=True)
+        txt_path = join(self.tmp_dir, 'index-depend.txt')
+        # the (unchanged) section is reused, without the delta
+        update_index(self.tmp_dir)
+        index = parse_depend_index(open(txt_path).read())
+        self.assert_('delta' not in index['foo-1.2-4.egg'])
+
+        update_index(self.tmp_dir, deltas=True)
+        index = parse_depend_index(open(txt_path).read())
+        delta = index['foo-1.2-4.egg']['delta']
+        delta_path = join(self.tmp_dir, delta['file'])
+        self.assert_(isfile(delta_path))
+        os.unlink(base)
+        update_index(self.tmp_dir, deltas=True)
+        index = parse_depend_index(open(txt_path).read())
+        self.assertEqual(index.keys(), ['foo-1.2-4.egg'])
+        self.assert_('delta' not in index['foo-1.2-4.egg'])
+        # the delta from the removed egg is removed as well
+        self.assert_(not isfile(delta_path))
+
+    def test_fetch_delta_lock(self):
+        base, target = self.mk_builds()
+        repo_dir = join(self.tmp_dir, 'repo')
+        os.mkdir(repo_dir)
+        for path in base, target:
+            shutil.move(path, repo_dir)
+        server = RepoServer(('localhost', 0),
+                            IndexedRepo(repo_dir, deltas=True))
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            url = 'http://localhost:%i/' % server.server_address[1]
+            c = Chain([url])
+            local = join(self.tmp_dir, 'local')
+            os.mkdir(local)
+            shutil.copy(join(repo_dir, 'foo-1.2-3.egg'), local)
+            dst = join(local, 'foo-1.2-4.egg')
+
+            # another process is fetching the egg
+            lock = fetch_lock(dst)
+            lock.acquire()
+            res = []
+            t = threading.Thread(target=lambda: res.append(
+                    c.fetch_delta(url + 'foo-1.2-4.egg', local)))
+            t.start()
+            time.sleep(0.3)
+            self.assertEqual(res, [])
+            self.assertEqual(sorted(fn for fn in os.listdir(local)
+                                    if 'delta' in fn), [])
+            shutil.copy(join(repo_dir, 'foo-1.2-4.egg'), local)
+            lock.release()
+            t.join()
+            # the egg fetched by the other process is used
+            self.assertEqual(res, [True])
+            self.assertEqual(sorted(fn for fn in os.listdir(local)
+                                    if 'delta' in fn), [])
+        finally:
+            connpool.pool.clear()
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
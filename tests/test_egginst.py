@@ -0,0 +1,263 @@
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+import unittest
+import zipfile
+import zlib
+from cStringIO import StringIO
+from os.path import basename, isdir, isfile, join
+
+from egginst.main import EggInst, batch_deps, install_batch, main
+from egginst.utils import crc32_file, trash_dir
+
+
+class TestEggInst(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prefix = join(self.tmp_dir, 'prefix')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def mk_egg(self, fn, members):
+        path = join(self.tmp_dir, fn)
+        z = zipfile.ZipFile(path, 'w')
+        for arcname, data in members.iteritems():
+            z.writestr(arcname, data)
+        z.close()
+        return path
+
+    def read(self, path):
+        return open(path).read()
+
+    def test_relocated_prefix(self):
+        egg = self.mk_egg('foo-1.0-1.egg', {
+                'foo/a.py': 'A',
+                'EGG-INFO/scripts/foo': '#!/usr/bin/python\nprint 1\n'})
+        ei = EggInst(egg, prefix=self.prefix)
+        ei.install()
+        # the hashbang points to the interpreter of the prefix
+        script = join(ei.bin_dir, 'foo')
+        self.assertEqual(self.read(script).splitlines()[0], '#!"%s"' %
+                         join(self.prefix, basename(sys.executable)))
+
+        copy = join(self.tmp_dir, 'copy')
+        shutil.copytree(self.prefix, copy)
+        ei = EggInst('foo', prefix=copy)
+        ei.remove()
+        self.assert_(not isfile(join(ei.site_packages, 'foo', 'a.py')))
+        # the original prefix is untouched
+        ei = EggInst('foo', prefix=self.prefix)
+        self.assert_(isfile(join(ei.site_packages, 'foo', 'a.py')))
+        self.assert_(isfile(script))
+        self.assert_(isfile(ei.meta_txt))
+
+    def test_relative_prefix(self):
+        egg = self.mk_egg('foo-1.0-1.egg', {'foo/sub/a.py': 'A'})
+        # a staged install of bar, which crashed after it was committed
+        ei = EggInst(self.mk_egg('bar-1.0-1.egg', {'bar/sub/b.py': 'B'}),
+                     prefix=self.prefix)
+        def crash():
+            raise KeyboardInterrupt
+        ei.write_meta = crash
+        ei.roll_back = lambda: None
+        self.assertRaises(KeyboardInterrupt, ei.install, staged=True)
+        self.assert_(isfile(ei.transaction.journal))
+
+        cwd = os.getcwd()
+        argv = sys.argv
+        stdout = sys.stdout
+        os.chdir(self.tmp_dir)
+        sys.stdout = StringIO()
+        try:
+            for args in [[egg], ['--recover'], ['--remove', 'foo']]:
+                sys.argv = ['egginst', '--prefix', 'prefix'] + args
+                main()
+        finally:
+            os.chdir(cwd)
+            sys.argv = argv
+            sys.stdout = stdout
+        # the empty directories are removed (but not the roots)
+        for name in 'foo', 'bar':
+            self.assert_(not isdir(join(ei.site_packages, name)))
+        self.assert_(isdir(ei.site_packages))
+        self.assert_(isfile(join(self.prefix, '.ironpkg.lock')))
+
+    def test_deferred_remove(self):
+        egg = self.mk_egg('foo-1.0-1.egg', {'foo/a.py': 'A',
+                                            'foo/sub/b.py': 'B',
+                                            'bar/c.py': 'C'})
+        ei = EggInst(egg, prefix=self.prefix)
+        ei.install()
+        user = join(ei.site_packages, 'foo', 'user.txt')
+        open(user, 'w').write('U')
+
+        ei = EggInst('foo', prefix=self.prefix)
+        ei.remove(defer=True)
+        # the untracked file is kept, the files of the package are not
+        self.assertEqual(self.read(user), 'U')
+        for path in ['foo/a.py', 'foo/sub/b.py', 'bar/c.py']:
+            self.assert_(not isfile(join(ei.site_packages, path)))
+        # bar/ only contains files of the package, so it is moved as a whole
+        trash = os.listdir(trash_dir(self.prefix))
+        self.assertEqual(len(trash), 1)
+        moved = os.listdir(join(trash_dir(self.prefix), trash[0]))
+        self.assert_([fn for fn in moved if fn.endswith('_bar')])
+        # while the files in foo/ are moved one by one
+        self.assert_([fn for fn in moved if fn.endswith('_a.py')])
+
+    def test_differential(self):
+        script = '#!/usr/bin/python\nprint 1\n'
+        EggInst(self.mk_egg('foo-1.0-1.egg', {
+                    'foo/same.py': 'S',
+                    'foo/changed.py': 'A',
+                    'foo/old/stale.py': 'X',
+                    'EGG-INFO/scripts/foo': script}),
+                prefix=self.prefix).install()
+        ei = EggInst('foo', prefix=self.prefix)
+        paths = dict((name, join(ei.site_packages, 'foo', name))
+                     for name in ['same.py', 'changed.py', 'old'])
+        paths['script'] = join(ei.bin_dir, 'foo')
+        for path in paths['same.py'], paths['script']:
+            os.utime(path, (1000, 1000))
+
+        ei = EggInst(self.mk_egg('foo-1.0-2.egg', {
+                    'foo/same.py': 'S',
+                    'foo/changed.py': 'B',
+                    'EGG-INFO/scripts/foo': script}),
+                prefix=self.prefix)
+        ei.install(differential=True)
+        # the unchanged files (including the script, whose hashbang was
+        # fixed) are not written again
+        self.assertEqual(os.stat(paths['same.py']).st_mtime, 1000)
+        self.assertEqual(os.stat(paths['script']).st_mtime, 1000)
+        self.assertEqual(self.read(paths['changed.py']), 'B')
+        # the stale file, and its directory, are removed
+        self.assert_(not isdir(paths['old']))
+        # the recorded information of the script is still the one of the
+        # fixed file, as used by --verify
+        ei = EggInst('foo', prefix=self.prefix)
+        ei.read_meta()
+        self.assertEqual(ei.file_info[paths['script']],
+                         (os.path.getsize(paths['script']),
+                          crc32_file(paths['script'])))
+        self.assertEqual(ei.member_info[paths['script']],
+                         (len(script), zlib.crc32(script) & 0xffffffff))
+
+        # a changed script is written (and fixed) again
+        EggInst(self.mk_egg('foo-1.0-3.egg', {
+                    'foo/same.py': 'S',
+                    'EGG-INFO/scripts/foo': script + 'print 2\n'}),
+                prefix=self.prefix).install(differential=True)
+        self.assertNotEqual(os.stat(paths['script']).st_mtime, 1000)
+        self.assertEqual(self.read(paths['script']).splitlines()[1:],
+                         ['print 1', 'print 2'])
+        self.assert_(self.read(paths['script']).startswith('#!"'))
+        self.assert_(not isfile(paths['changed.py']))
+
+    def test_compile(self):
+        for staged in False, True:
+            egg = self.mk_egg('foo-1.0-1.egg', {
+                    'foo/__init__.py': '',
+                    'foo/a.py': 'x = 1\n',
+                    'foo/bad.py': 'syntax error\n',
+                    'EGG-INFO/usage.py': ''})
+            ei = EggInst(egg, prefix=self.prefix)
+            ei.install(staged=staged, precompile=True)
+            pkg_dir = join(ei.site_packages, 'foo')
+            pycs = [join(pkg_dir, fn) for fn in '__init__.pyc', 'a.pyc']
+            # the modules were compiled, and the .pyc files recorded, except
+            # for the metadata, and modules which do not compile
+            installed = ei.installed_files()
+            for path in pycs:
+                self.assert_(isfile(path))
+                self.assert_(path in installed)
+            self.assert_(not isfile(join(pkg_dir, 'bad.pyc')))
+            self.assert_(not isfile(join(ei.meta_dir, 'usage.pyc')))
+
+            EggInst('foo', prefix=self.prefix).remove()
+            self.assert_(not isdir(pkg_dir))
+            self.assert_(not isdir(ei.meta_dir))
+
+    def test_store(self):
+        store = join(self.tmp_dir, 'store')
+        egg = self.mk_egg('foo-1.0-1.egg', {'foo/a.py': 'A'})
+        paths = []
+        for prefix in 'p1', 'p2':
+            ei = EggInst(egg, store=store, prefix=join(self.tmp_dir, prefix))
+            ei.install()
+            paths.append(join(ei.site_packages, 'foo', 'a.py'))
+        # the egg was extracted into the store once, and both prefixes
+        # link to its files
+        self.assertEqual(len([fn for fn in os.listdir(store)
+                              if isdir(join(store, fn))]), 1)
+        self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+        self.assertEqual(os.stat(paths[0]).st_nlink, 3)
+        # the linked files are read-only
+        self.assertEqual(os.stat(paths[0]).st_mode & 0222, 0)
+
+    def test_store_md5(self):
+        store = join(self.tmp_dir, 'store')
+        egg = self.mk_egg('foo-1.0-1.egg', {'foo/a.py': 'A'})
+        md5 = hashlib.md5(open(egg, 'rb').read()).hexdigest()
+        ei = EggInst(egg, store=store, prefix=self.prefix)
+        ei.install()
+        self.assertEqual(ei.store_dir, join(store, md5))
+        # a known md5 is used as is, instead of reading the egg
+        ei = EggInst(egg, store=store, prefix=join(self.tmp_dir, 'p2'),
+                     md5=32 * '0')
+        ei.install()
+        self.assertEqual(ei.store_dir, join(store, 32 * '0'))
+
+    def test_store_post_egginst(self):
+        store = join(self.tmp_dir, 'store')
+        egg = self.mk_egg('foo-1.0-1.egg', {
+                'foo/a.py': 'A',
+                'EGG-INFO/post_egginst.py':
+                    'import sys\n'
+                    'open(sys.argv[2] + "/Lib\\\\site-packages/foo/a.py",'
+                    ' "a").write("B")\n'})
+        paths = []
+        for prefix in 'p1', 'p2':
+            ei = EggInst(egg, store=store, prefix=join(self.tmp_dir, prefix))
+            ei.install()
+            paths.append(join(ei.site_packages, 'foo', 'a.py'))
+        # the files modified by the post-install script are not shared
+        for path in paths:
+            self.assertEqual(self.read(path), 'AB')
+            self.assertEqual(os.stat(path).st_nlink, 1)
+
+    def test_batch_scripts(self):
+        ep = '[console_scripts]\ntool = %s:main\n'
+        eggs = [EggInst(self.mk_egg('%s-1.0-1.egg' % name, {
+                        '%s/__init__.py' % name: '',
+                        'EGG-INFO/entry_points.txt': ep % name}),
+                        prefix=self.prefix)
+                for name in 'foo', 'bar', 'baz']
+        # both generate the same script, so bar waits for foo
+        self.assertEqual(batch_deps(eggs), [set(), set([0]), set([1])])
+        install_batch(eggs, workers=3)
+        script = join(eggs[0].bin_dir, 'tool-script.py')
+        self.assert_('baz-1.0-1.egg' in self.read(script))
+
+    def test_batch_stale(self):
+        EggInst(self.mk_egg('foo-1.0-1.egg', {'foo/a.py': 'A',
+                                              'moved.py': 'M'}),
+                prefix=self.prefix).install()
+        eggs = [EggInst(self.mk_egg('foo-1.0-2.egg', {'foo/a.py': 'A'}),
+                        prefix=self.prefix),
+                EggInst(self.mk_egg('bar-1.0-1.egg', {'moved.py': 'B'}),
+                        prefix=self.prefix)]
+        # the upgrade of foo removes moved.py, which bar installs
+        self.assertEqual(batch_deps(eggs, True), [set(), set([0])])
+        self.assertEqual(batch_deps(eggs), [set(), set()])
+        install_batch(eggs, workers=2, differential=True)
+        self.assertEqual(self.read(join(eggs[1].site_packages, 'moved.py')),
+                         'B')
+
+
+if __name__ == '__main__':
+    unittest.main()
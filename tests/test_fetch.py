@@ -0,0 +1,285 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import zipfile
+from os.path import isfile, join
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from enstaller import connpool
+from enstaller.fetch import FetchError, Fetcher, fetch_lock
+from enstaller.indexed_repo import Chain
+from enstaller.indexed_repo.metadata import update_index
+
+
+SPEC = """\
+metadata_version = '1.1'
+name = %r
+version = '1.0'
+build = 1
+
+arch = None
+platform = None
+osdist = None
+python = None
+packages = []
+"""
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.lock.acquire()
+        server.active += 1
+        server.max_active = max(server.max_active, server.active)
+        server.lock.release()
+        # keep the request open for a while, such that concurrent requests
+        # overlap
+        time.sleep(0.1)
+        data = 'data of %s' % self.path
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        server.lock.acquire()
+        server.active -= 1
+        server.lock.release()
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('localhost', 0), Handler)
+        self.lock = threading.Lock()
+        self.active = self.max_active = 0
+
+
+class TestFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo_dir = join(self.tmp_dir, 'repo')
+        self.local = join(self.tmp_dir, 'local')
+        os.mkdir(self.repo_dir)
+        os.mkdir(self.local)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def mk_jobs(self, n):
+        jobs = []
+        for i in xrange(n):
+            fn = 'egg%i.egg' % i
+            data = fn * 1000
+            open(join(self.repo_dir, fn), 'wb').write(data)
+            jobs.append(('file://' + join(self.repo_dir, fn),
+                         join(self.local, fn),
+                         hashlib.md5(data).hexdigest(), len(data)))
+        return jobs
+
+    def test_fetch_files(self):
+        jobs = self.mk_jobs(6)
+        done = []
+        f = Fetcher(jobs, workers=3, progress=False,
+                    done=lambda url, dst, md5: done.append(url))
+        f.start()
+        f.join()
+        self.assertEqual(sorted(done), sorted(job[0] for job in jobs))
+        for url, dst, md5, size in jobs:
+            self.assertEqual(open(dst, 'rb').read(),
+                             open(url[7:], 'rb').read())
+
+    def fetch(self, jobs, workers=1, **kwargs):
+        f = Fetcher(jobs, workers, progress=False, **kwargs)
+        f.start()
+        f.join()
+
+    def test_force(self):
+        jobs = self.mk_jobs(1)
+        url, dst, md5, size = jobs[0]
+        self.fetch(jobs)
+        # replace the file in the repository by a copy
+        shutil.copy(url[7:], url[7:] + '.tmp')
+        os.rename(url[7:] + '.tmp', url[7:])
+        self.fetch(jobs)
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(url[7:]).st_ino)
+        # the file is fetched again, although it exists already
+        self.fetch(jobs, force=True)
+        self.assertEqual(os.stat(dst).st_ino, os.stat(url[7:]).st_ino)
+
+    def test_hardlink(self):
+        jobs = self.mk_jobs(1)
+        url, dst, md5, size = jobs[0]
+        self.fetch(jobs)
+        # the file is linked to the one in the (file://) repository
+        self.assertEqual(os.stat(dst).st_ino, os.stat(url[7:]).st_ino)
+
+    def test_copy_fallback(self):
+        jobs = self.mk_jobs(1)
+        url, dst, md5, size = jobs[0]
+        def link(src, dst):
+            raise OSError(18, "Invalid cross-device link")
+        os_link = os.link
+        os.link = link
+        try:
+            self.fetch(jobs)
+        finally:
+            os.link = os_link
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(url[7:]).st_ino)
+        self.assertEqual(open(dst, 'rb').read(), open(url[7:], 'rb').read())
+
+    def test_trust_md5(self):
+        jobs = self.mk_jobs(1)
+        url, dst, md5, size = jobs[0]
+        jobs[0] = url, dst, 32 * '0', size
+        # the md5 of the local repository is not checked when trusted
+        self.fetch(jobs, trust_md5=True)
+        self.assertEqual(open(dst, 'rb').read(), open(url[7:], 'rb').read())
+        os.unlink(dst)
+        self.assertRaises(FetchError, self.fetch, jobs)
+        self.assert_(not isfile(dst))
+
+    def test_lock_files(self):
+        jobs = self.mk_jobs(2)
+        self.fetch(jobs)
+        # the lock files are removed once the files are fetched
+        self.assertEqual(sorted(fn for fn in os.listdir(self.local)
+                                if fn.endswith(('.lock', '.info'))), [])
+
+        url, dst, md5, size = jobs[0]
+        lock1, lock2 = fetch_lock(dst), fetch_lock(dst)
+        lock1.acquire()
+        self.assert_(isfile(lock1.path + '.info'))
+        self.assertEqual(lock2.try_lock(), False)
+        # a lock on the removed file is not acquired
+        fd = os.open(lock1.path, os.O_RDWR)
+        lock1.release()
+        self.assert_(not isfile(lock1.path))
+        self.assertEqual(lock2.same_file(fd), False)
+        os.close(fd)
+        self.assertEqual(lock2.try_lock(), True)
+        lock2.release()
+        self.assert_(not isfile(lock2.path))
+
+    def test_md5_mismatch(self):
+        jobs = self.mk_jobs(3)
+        url, dst, md5, size = jobs[1]
+        jobs[1] = url, dst, 32 * '0', size
+        try:
+            self.fetch(jobs)
+        except FetchError, e:
+            self.assert_('Could not fetch %s: MD5 sums mismatch' % url
+                         in str(e))
+        else:
+            self.fail("FetchError not raised")
+        # no (partial) file is left behind for the corrupted download, and
+        # no further downloads were started
+        self.assertEqual([fn for fn in os.listdir(self.local)
+                          if not fn.startswith('.')], ['egg0.egg'])
+
+    def test_per_host(self):
+        server = Server()
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            url = 'http://localhost:%i/' % server.server_address[1]
+            jobs = [(url + 'egg%i.egg' % i, join(self.local, 'egg%i.egg' % i),
+                     None, None) for i in xrange(6)]
+            self.fetch(jobs, workers=4, per_host=2)
+        finally:
+            connpool.pool.clear()
+            server.shutdown()
+            server.server_close()
+        # the downloads were concurrent, but limited per host
+        self.assertEqual(server.max_active, 2)
+        for url, dst, md5, size in jobs:
+            self.assertEqual(open(dst).read(),
+                             'data of /%s' % dst[len(self.local) + 1:])
+
+    def test_fetch_dists(self):
+        for name in 'foo', 'bar', 'baz':
+            z = zipfile.ZipFile(join(self.repo_dir, '%s-1.0-1.egg' % name),
+                                'w')
+            z.writestr('EGG-INFO/spec/depend', SPEC % name)
+            z.close()
+        update_index(self.repo_dir)
+        c = Chain(['file://%s/' % self.repo_dir])
+        dists = sorted(c.index)
+        self.assertEqual(len(dists), 3)
+        c.fetch_dists(dists, self.local, workers=3)
+        for dist in dists:
+            fn = dist.split('/')[-1]
+            self.assertEqual(open(join(self.local, fn), 'rb').read(),
+                             open(join(self.repo_dir, fn), 'rb').read())
+            self.assertEqual(c.needs_fetch(dist, self.local), False)
+
+    def test_wait(self):
+        server = Server()
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            url = 'http://localhost:%i/' % server.server_address[1]
+            jobs = [(url + 'egg%i.egg' % i, join(self.local, 'egg%i.egg' % i),
+                     None, None) for i in xrange(3)]
+            f = Fetcher(jobs, workers=1, progress=False)
+            f.start()
+            # the first file is available while the others are still being
+            # fetched
+            f.wait(jobs[0][0])
+            self.assert_(isfile(jobs[0][1]))
+            self.assert_(jobs[2][0] not in f.done)
+            # urls which are not fetched by the Fetcher return immediately
+            f.wait(url + 'other.egg')
+            f.wait(jobs[2][0])
+            self.assert_(isfile(jobs[2][1]))
+            f.join()
+        finally:
+            connpool.pool.clear()
+            server.shutdown()
+            server.server_close()
+
+    def test_wait_error(self):
+        jobs = self.mk_jobs(2)
+        url, dst, md5, size = jobs[0]
+        jobs[0] = url, dst, 32 * '0', size
+        f = Fetcher(jobs, workers=1, progress=False)
+        f.start()
+        self.assertRaises(FetchError, f.wait, jobs[1][0])
+        self.assertRaises(FetchError, f.join)
+
+    def test_start_fetch(self):
+        for name in 'foo', 'bar':
+            z = zipfile.ZipFile(join(self.repo_dir, '%s-1.0-1.egg' % name),
+                                'w')
+            z.writestr('EGG-INFO/spec/depend', SPEC % name)
+            z.close()
+        update_index(self.repo_dir)
+        c = Chain(['file://%s/' % self.repo_dir])
+        dists = sorted(c.index)
+        c.fetch_dist(dists[0], self.local)
+        f = c.start_fetch(dists, self.local, progress=False)
+        # only the distribution which is not in the local repository yet
+        # is fetched
+        self.assertEqual(f.urls, set([dists[1]]))
+        for dist in dists:
+            f.wait(dist)
+            self.assert_(isfile(join(self.local, dist.split('/')[-1])))
+        f.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import zipfile
+from cStringIO import StringIO
+from os.path import join
+
+from enstaller import connpool
+from enstaller.indexed_repo import Chain, Req
+from enstaller.indexed_repo.remote import RemoteIndexer
+from enstaller.serve import IndexedRepo, RepoHandler, RepoServer
+
+
+SPEC = """\
+metadata_version = '1.1'
+name = %r
+version = '1.0'
+build = 1
+
+arch = None
+platform = None
+osdist = None
+python = None
+packages = %r
+"""
+
+
+class NoIndexHandler(RepoHandler):
+    """
+    Serves the repository without its index file.
+    """
+    def handle_request(self, send_body):
+        if self.path.startswith('/index-depend'):
+            self.send_error(404)
+            return
+        RepoHandler.handle_request(self, send_body)
+
+
+class TestRemote(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo_dir = join(self.tmp_dir, 'repo')
+        os.mkdir(self.repo_dir)
+        self.mk_egg('foo', [])
+        self.mk_egg('bar', ['foo'])
+        self.server = RepoServer(('localhost', 0),
+                                 IndexedRepo(self.repo_dir))
+        self.server.RequestHandlerClass = NoIndexHandler
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.url = 'http://localhost:%i/' % self.server.server_address[1]
+
+    def tearDown(self):
+        connpool.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def mk_egg(self, name, packages, data='x'):
+        path = join(self.repo_dir, '%s-1.0-1.egg' % name)
+        z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr('%s/__init__.py' % name, data * 1000)
+        z.writestr('EGG-INFO/spec/depend', SPEC % (name, packages))
+        z.close()
+        return path
+
+    def index_repo(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            index = RemoteIndexer().index_repo(self.url)
+            return index, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_unreadable_egg(self):
+        open(join(self.repo_dir, 'baz-1.0-1.egg'), 'wb').write('no zip')
+        index, out = self.index_repo()
+        # the egg is skipped, and the others are indexed
+        self.assertEqual(sorted(index), ['bar-1.0-1.egg', 'foo-1.0-1.egg'])
+        self.assert_('WARNING: could not index %sbaz-1.0-1.egg' % self.url
+                     in out)
+        for spec in index.itervalues():
+            self.assert_(spec['etag'])
+
+    def test_rebuilt_egg(self):
+        local = join(self.tmp_dir, 'local')
+        c = Chain([self.url])
+        self.assertEqual(c.install_order(Req('bar')),
+                         [self.url + 'foo-1.0-1.egg',
+                          self.url + 'bar-1.0-1.egg'])
+        dist = self.url + 'foo-1.0-1.egg'
+        self.assertEqual(c.fetch_dist(dist, local), True)
+        self.assertEqual(Chain([self.url]).needs_fetch(dist, local), False)
+
+        # rebuild the egg with the same name and size, but different data
+        path = self.mk_egg('foo', [], 'y')
+        st = os.stat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        c = Chain([self.url])
+        self.assertEqual(c.needs_fetch(dist, local), True)
+        c.fetch_dist(dist, local)
+        self.assertEqual(open(join(local, 'foo-1.0-1.egg'), 'rb').read(),
+                         open(path, 'rb').read())
+
+
+if __name__ == '__main__':
+    unittest.main()
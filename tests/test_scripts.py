@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from os.path import join
+
+from egginst import scripts
+
+
+EXE = '/prefix/python'
+
+
+class TestScripts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, data):
+        """
+        Write data as a script member, and return tuple(fixed, written data).
+        """
+        egg = join(self.tmp_dir, 'foo-1.0-1.egg')
+        z = zipfile.ZipFile(egg, 'w')
+        z.writestr('EGG-INFO/scripts/foo', data)
+        z.close()
+        path = join(self.tmp_dir, 'foo')
+        z = zipfile.ZipFile(egg)
+        fixed = scripts.write_script_member(z, 'EGG-INFO/scripts/foo', path,
+                                            EXE, chunk_size=16)
+        z.close()
+        return fixed, open(path, 'rb').read()
+
+    def test_fix(self):
+        body = 'print 1\n' * 100
+        self.assertEqual(self.write('#!/usr/bin/python\n' + body),
+                         (True, '#!"%s"\n%s' % (EXE, body)))
+        # the line ending is preserved
+        self.assertEqual(self.write('#!/usr/bin/env python\r\n' + body),
+                         (True, '#!"%s"\r\n%s' % (EXE, body)))
+        # already pointing to the interpreter
+        data = '#!"%s"\n%s' % (EXE, body)
+        self.assertEqual(self.write(data), (False, data))
+
+    def test_no_fix(self):
+        for data in [
+            # not python
+            '#!/bin/sh\necho 1\n',
+            # not a script
+            'python\n',
+            '',
+            # the first line is too long
+            '#!/usr/bin/python' + 5000 * ' ' + '\nprint 1\n',
+            # created by egginst (see write_script())
+            '#!/usr/bin/python\n# This script was created by egginst when '
+            'installing:\n',
+            ]:
+            self.assertEqual(self.write(data), (False, data))
+            path = join(self.tmp_dir, 'foo')
+            self.assertEqual(scripts.needs_fix(path, EXE), False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import gzip
+import shutil
+import httplib
+import tempfile
+import threading
+import unittest
+import zipfile
+from cStringIO import StringIO
+from os.path import join
+
+from enstaller import connpool
+from enstaller.fetch import fetch_file
+from enstaller.indexed_repo import Chain, Req
+from enstaller.indexed_repo.remote import RemoteIndexer
+from enstaller.serve import IndexedRepo, RepoServer
+
+
+SPEC = """\
+metadata_version = '1.1'
+name = %r
+version = '1.0'
+build = 1
+
+arch = None
+platform = None
+osdist = None
+python = None
+packages = %r
+"""
+
+
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo_dir = join(self.tmp_dir, 'repo')
+        os.mkdir(self.repo_dir)
+        self.mk_egg('foo', [])
+        self.mk_egg('bar', ['foo'])
+        self.server = RepoServer(('localhost', 0),
+                                 IndexedRepo(self.repo_dir))
+        t = threading.Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        self.port = self.server.server_address[1]
+        self.url = 'http://localhost:%i/' % self.port
+
+    def tearDown(self):
+        # close the kept-alive connections to the server
+        connpool.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def mk_egg(self, name, packages):
+        path = join(self.repo_dir, '%s-1.0-1.egg' % name)
+        z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr('%s/__init__.py' % name, 'x = %r\n' % (1000 * name))
+        z.writestr('EGG-INFO/spec/depend', SPEC % (name, packages))
+        z.close()
+        return path
+
+    def get(self, path, headers={}):
+        conn = httplib.HTTPConnection('localhost', self.port)
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        conn.close()
+        return resp, data
+
+    def test_index(self):
+        resp, data = self.get('/index-depend.txt',
+                              {'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.getheader('Content-Encoding'), 'gzip')
+        index = gzip.GzipFile(fileobj=StringIO(data)).read()
+        self.assert_('==> foo-1.0-1.egg <==' in index)
+        resp, data = self.get('/index-depend.txt',
+                              {'If-None-Match': resp.getheader('ETag'),
+                               'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status, 304)
+
+        c = Chain([self.url])
+        self.assertEqual(c.install_order(Req('bar')),
+                         [self.url + 'foo-1.0-1.egg',
+                          self.url + 'bar-1.0-1.egg'])
+
+        # the index is regenerated when eggs are added
+        self.mk_egg('baz', [])
+        resp, data = self.get('/index-depend.txt')
+        self.assert_('==> baz-1.0-1.egg <==' in data)
+
+    def test_range(self):
+        egg = open(join(self.repo_dir, 'foo-1.0-1.egg'), 'rb').read()
+        resp, data = self.get('/foo-1.0-1.egg', {'Range': 'bytes=10-19'})
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(data, egg[10:20])
+        resp, data = self.get('/foo-1.0-1.egg', {'Range': 'bytes=-5'})
+        self.assertEqual(data, egg[-5:])
+        resp, data = self.get('/foo-1.0-1.egg',
+                              {'Range': 'bytes=%i-' % len(egg)})
+        self.assertEqual(resp.status, 416)
+        resp, data = self.get('/.hidden')
+        self.assertEqual(resp.status, 404)
+
+    def test_remote_index(self):
+        cache_path = join(self.tmp_dir, 'remote_index.txt')
+        index = RemoteIndexer(cache_path).index_repo(self.url)
+        self.assertEqual(sorted(index), ['bar-1.0-1.egg', 'foo-1.0-1.egg'])
+        self.assertEqual(index['bar-1.0-1.egg']['packages'], ['foo'])
+        # cached by ETag
+        self.assertEqual(RemoteIndexer(cache_path).index_repo(self.url),
+                         index)
+
+    def test_resume(self):
+        egg = open(join(self.repo_dir, 'bar-1.0-1.egg'), 'rb').read()
+        dst = join(self.tmp_dir, 'bar-1.0-1.egg')
+        open(dst + '.part', 'wb').write(egg[:100])
+        fetch_file(self.url + 'bar-1.0-1.egg', dst, size=len(egg))
+        self.assertEqual(open(dst, 'rb').read(), egg)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+from os.path import isdir, isfile, join
+
+from egginst.main import EggInst
+from egginst.staging import Transaction, recover
+
+
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.old_prefix = sys.prefix
+        sys.prefix = join(self.tmp_dir, 'prefix')
+
+    def tearDown(self):
+        sys.prefix = self.old_prefix
+        shutil.rmtree(self.tmp_dir)
+
+    def mk_egg(self, fn, members):
+        path = join(self.tmp_dir, fn)
+        z = zipfile.ZipFile(path, 'w')
+        for arcname, data in members.iteritems():
+            z.writestr(arcname, data)
+        z.close()
+        return path
+
+    def read(self, path):
+        return open(path).read()
+
+    def test_install(self):
+        ei = EggInst(self.mk_egg('foo-1.0-1.egg', {'foo/a.py': 'A'}))
+        ei.install(staged=True)
+        path = join(ei.site_packages, 'foo', 'a.py')
+        self.assertEqual(self.read(path), 'A')
+        self.assert_(isfile(ei.meta_txt))
+        # nothing is left in the prefix
+        self.assert_(not isdir(join(sys.prefix, '.stage_ironpkg')))
+        self.assert_(not isdir(ei.transaction.stage_dir))
+        self.assert_(not isfile(ei.transaction.journal))
+
+    def test_roll_back(self):
+        ei = EggInst(self.mk_egg('foo-1.0-1.egg', {'foo/a.py': 'A'}))
+        ei.install()
+        path = join(ei.site_packages, 'foo', 'a.py')
+        egg = self.mk_egg('foo-1.0-2.egg', {
+                'foo/a.py': 'B',
+                'foo/b.py': 'B',
+                'EGG-INFO/post_egginst.py': 'import sys; sys.exit(1)'})
+        ei = EggInst(egg)
+        self.assertRaises(Exception, ei.install, True, True)
+        # the previous version is restored
+        self.assertEqual(self.read(path), 'A')
+        self.assert_(not isdir(ei.transaction.stage_dir))
+        self.assert_(not isfile(join(ei.site_packages, 'foo', 'b.py')))
+        self.assert_(not isfile(join(ei.meta_dir, 'post_egginst.py')))
+        ei = EggInst('foo')
+        ei.read_meta()
+        self.assertEqual(ei.egg_name, 'foo-1.0-1.egg')
+
+    def test_recover(self):
+        ei = EggInst(self.mk_egg('foo-1.0-1.egg', {'foo/a.py': 'A'}))
+        ei.install()
+        path = join(ei.site_packages, 'foo', 'a.py')
+        # simulate a crash after one file of a committed transaction
+        # was moved into place
+        t = Transaction('foo')
+        plan = t.stage([('foo/a.py', path, True),
+                        ('foo/b.py', path[:-4] + 'b.py', False)])
+        for arcname, staged, exists in plan:
+            open(staged, 'w').write('B')
+        t.write_journal('committed')
+        os.rename(path, t.backup(0))
+        os.rename(t.staged(0), path)
+
+        # the install was not completed, so it is rolled back
+        self.assertEqual(recover(), 1)
+        self.assertEqual(self.read(path), 'A')
+        self.assert_(not isfile(path[:-4] + 'b.py'))
+        self.assert_(not isdir(t.stage_dir))
+        self.assertEqual(recover(), 0)
+
+    def mk_versions(self):
+        ep = '[console_scripts]\n%s = foo.a:main\n'
+        ei = EggInst(self.mk_egg('foo-1.0-1.egg', {
+                    'foo/a.py': 'A',
+                    'EGG-INFO/entry_points.txt': ep % 'foo'}))
+        ei.install()
+        egg = self.mk_egg('foo-1.0-2.egg', {
+                'foo/a.py': 'B',
+                'foo/b.py': 'B',
+                'EGG-INFO/entry_points.txt': ep % 'foo' + ep[17:] % 'bar'})
+        return ei, EggInst(egg)
+
+    def assert_old_version(self, ei):
+        self.assertEqual(self.read(join(ei.site_packages, 'foo', 'a.py')),
+                         'A')
+        self.assert_(not isfile(join(ei.site_packages, 'foo', 'b.py')))
+        script = join(ei.bin_dir, 'foo-script.py')
+        self.assert_('foo-1.0-1.egg' in self.read(script))
+        self.assert_(not isfile(join(ei.bin_dir, 'bar-script.py')))
+        self.assert_(not isfile(join(ei.bin_dir, 'bar.exe')))
+        ei = EggInst('foo')
+        ei.read_meta()
+        self.assertEqual(ei.egg_name, 'foo-1.0-1.egg')
+        for p in ei.files:
+            self.assert_(isfile(p), p)
+        self.assertEqual(recover(), 0)
+
+    def crash(self, ei, method):
+        # simulate a crash in method, which is not handled
+        def raise_exc(*args):
+            raise KeyboardInterrupt
+        setattr(ei, method, raise_exc)
+        ei.roll_back = lambda: None
+        self.assertRaises(KeyboardInterrupt, ei.install, False, True)
+        self.assert_(isfile(ei.transaction.journal))
+
+    def test_crash_before_complete(self):
+        old, ei = self.mk_versions()
+        self.crash(ei, 'complete')
+        self.assertEqual(recover(), 1)
+        self.assert_old_version(old)
+
+    def test_crash_in_complete(self):
+        old, ei = self.mk_versions()
+        # the entry point scripts are (re-)generated already
+        self.crash(ei, 'write_meta')
+        self.assert_('foo-1.0-2.egg' in
+                     self.read(join(ei.bin_dir, 'foo-script.py')))
+        self.assertEqual(recover(), 1)
+        self.assert_old_version(old)
+
+    def test_crash_fresh_install(self):
+        ei = EggInst(self.mk_egg('foo-1.0-1.egg', {
+                    'foo/a.py': 'A',
+                    'EGG-INFO/entry_points.txt':
+                        '[console_scripts]\nfoo = foo.a:main\n'}))
+        self.crash(ei, 'write_meta')
+        self.assertEqual(recover(), 1)
+        self.assert_(not isdir(join(ei.site_packages, 'foo')))
+        self.assert_(not isfile(join(ei.bin_dir, 'foo-script.py')))
+        self.assert_(not isdir(ei.meta_dir))
+
+    def test_crash_after_complete(self):
+        old, ei = self.mk_versions()
+        finish = Transaction.finish
+        Transaction.finish = lambda self: None
+        try:
+            ei.install(staged=True)
+        finally:
+            Transaction.finish = finish
+        self.assert_(isfile(ei.transaction.journal))
+        # the install is complete, only the backups are removed
+        self.assertEqual(recover(), 1)
+        self.assert_(not isdir(ei.transaction.stage_dir))
+        self.assert_('foo-1.0-2.egg' in
+                     self.read(join(ei.bin_dir, 'bar-script.py')))
+        ei = EggInst('foo')
+        ei.read_meta()
+        self.assertEqual(ei.egg_name, 'foo-1.0-2.egg')
+
+    def test_discard(self):
+        t = Transaction('foo')
+        path = join(sys.prefix, 'a.py')
+        plan = t.stage([('a.py', path, False)])
+        open(plan[0][1], 'w').write('A')
+        self.assertEqual(recover(), 1)
+        self.assert_(not isfile(path))
+        self.assert_(not isdir(t.stage_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
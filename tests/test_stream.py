@@ -0,0 +1,161 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+import zipfile
+from os.path import basename, isdir, join
+
+from egginst.main import EggInst
+from egginst.stream import LOCAL_FMT, LOCAL_SIZE, StreamExtractor
+from enstaller import connpool
+from enstaller import main as enpkg
+from enstaller.indexed_repo import Chain
+from enstaller.serve import IndexedRepo, RepoServer
+
+
+SPEC = """\
+metadata_version = '1.1'
+name = 'foo'
+version = '1.0'
+build = %i
+
+arch = None
+platform = None
+osdist = None
+python = None
+packages = []
+"""
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def mk_egg(self, path, build=1):
+        z = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        z.writestr('foo/__init__.py', 'x = %r\n' % (1000 * 'foo'))
+        z.writestr('foo/sub/', '')
+        z.writestr('foo/sub/a.txt', 'A' * 5000)
+        z.writestr(zipfile.ZipInfo('foo/stored.dat'), 'stored data')
+        z.writestr('EGG-INFO/scripts/foo', '#!/usr/bin/python\nprint 1\n')
+        z.writestr('EGG-INFO/spec/depend', SPEC % build)
+        z.close()
+        return path
+
+    def stream(self, egg, chunk_size=7):
+        dir_path = join(self.tmp_dir, 'stream')
+        os.mkdir(dir_path)
+        se = StreamExtractor(dir_path)
+        data = open(egg, 'rb').read()
+        for i in xrange(0, len(data), chunk_size):
+            se.feed(data[i:i + chunk_size])
+        se.close()
+        return se.members
+
+    def install(self, egg, prefix, prestaged=None):
+        ei = EggInst(egg, prefix=join(self.tmp_dir, prefix))
+        if prestaged:
+            ei.prestaged = prestaged
+        ei.install()
+        return ei
+
+    def tree(self, prefix):
+        res = {}
+        for root, dirs, files in os.walk(prefix):
+            for fn in files:
+                path = join(root, fn)
+                res[path[len(prefix):]] = open(path, 'rb').read()
+        return res
+
+    def assert_same_install(self, egg, members):
+        # the scripts (and metadata) depend on the prefix, so both installs
+        # are done into the same prefix
+        ei = self.install(egg, 'prefix', members)
+        streamed = self.tree(ei.prefix)
+        shutil.rmtree(ei.prefix)
+        self.install(egg, 'prefix')
+        self.assertEqual(streamed, self.tree(ei.prefix))
+        shutil.rmtree(ei.prefix)
+
+    def test_small_chunks(self):
+        egg = self.mk_egg(join(self.tmp_dir, 'foo-1.0-1.egg'))
+        members = self.stream(egg)
+        # all members (but the directory) were extracted from the stream
+        self.assertEqual(sorted(members),
+                         sorted(n for n in zipfile.ZipFile(egg).namelist()
+                                if not n.endswith('/')))
+        self.assert_same_install(egg, members)
+        # the extracted files were moved into place, except for the script
+        # whose hashbang is fixed (which is written again)
+        self.assertEqual(os.listdir(join(self.tmp_dir, 'stream')),
+                         [basename(members['EGG-INFO/scripts/foo'])])
+
+    def patch_local_header(self, egg, arcname, **kwargs):
+        """
+        Change fields of the local header of arcname in the egg.
+        """
+        z = zipfile.ZipFile(egg)
+        offset = z.getinfo(arcname).header_offset
+        z.close()
+        fi = open(egg, 'r+b')
+        fi.seek(offset)
+        rec = list(struct.unpack(LOCAL_FMT, fi.read(LOCAL_SIZE)))
+        for name, value in kwargs.iteritems():
+            rec[{'flags': 3, 'csize': 8}[name]] = value
+        fi.seek(offset)
+        fi.write(struct.pack(LOCAL_FMT, *rec))
+        fi.close()
+
+    def test_fallback(self):
+        for kwargs in [dict(flags=0x08),         # data descriptor
+                       dict(csize=0xffffffff)]:  # ZIP64
+            egg = self.mk_egg(join(self.tmp_dir, 'foo-1.0-1.egg'))
+            self.patch_local_header(egg, 'foo/sub/a.txt', **kwargs)
+            members = self.stream(egg)
+            # decoding ends at the member which cannot be decoded
+            self.assertEqual(members.keys(), ['foo/__init__.py'])
+            self.assert_same_install(egg, members)
+            shutil.rmtree(join(self.tmp_dir, 'stream'))
+
+    def test_md5_mismatch(self):
+        repo_dir = join(self.tmp_dir, 'repo')
+        os.mkdir(repo_dir)
+        self.mk_egg(join(repo_dir, 'foo-1.0-2.egg'), 2)
+        old = self.install(self.mk_egg(join(self.tmp_dir, 'foo-1.0-1.egg')),
+                           'prefix')
+        before = self.tree(old.prefix)
+
+        server = RepoServer(('localhost', 0), IndexedRepo(repo_dir))
+        t = threading.Thread(target=server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+        try:
+            url = 'http://localhost:%i/' % server.server_address[1]
+            c = Chain([url])
+            dist = url + 'foo-1.0-2.egg'
+            c.index[dist]['md5'] = 32 * '0'
+            conf = dict(local=join(self.tmp_dir, 'local'),
+                        trust_local_md5=False, unpacked_store=None)
+            os.mkdir(conf['local'])
+            self.assertRaises(SystemExit, enpkg.stream_install, c, conf,
+                              dist, set(['foo-1.0-1.egg']),
+                              prefix=old.prefix)
+        finally:
+            connpool.pool.clear()
+            server.shutdown()
+            server.server_close()
+        # the installed version, and the prefix, are untouched
+        self.assertEqual(self.tree(old.prefix), before)
+        self.assert_(not isdir(join(old.prefix, '.stream_ironpkg')))
+        self.assertEqual([fn for fn in os.listdir(conf['local'])
+                          if not fn.startswith('.')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
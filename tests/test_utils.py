@@ -1,8 +1,15 @@
+import os
 import random
+import sys
+import shutil
+import tempfile
 import unittest
+from os.path import dirname, isdir, isfile, join
 
 from egginst.main import name_version_fn
+from egginst.utils import prune_dirs, replace
 from enstaller.utils import canonical, cname_fn, comparable_version
+import enstaller.utils as utils
 
 
 class TestUtils(unittest.TestCase):
@@ -42,6 +49,94 @@ class TestUtils(unittest.TestCase):
             versions.sort(key=comparable_version)
             self.assertEqual(versions, org)
 
+    def test_md5_memo(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = join(tmp_dir, 'foo-1.0-1.egg')
+        open(path, 'wb').write('foo data')
+        md5 = '5bc1c7e6d2ac9b8c7df3f3a2e8c7e3d7'
+        # the (wrong) md5 recorded in the memo is used
+        utils.record_md5(path, md5)
+        self.assertEqual(utils.md5_file(path, memo=True), md5)
+        # the memo is only used when asked for
+        self.assertEqual(utils.md5_file(path),
+                         '56e61c083c36939cc32bbecfdbadf036')
+        utils.paranoid = True
+        try:
+            self.assertEqual(utils.md5_file(path, memo=True),
+                             '56e61c083c36939cc32bbecfdbadf036')
+        finally:
+            utils.paranoid = False
+        # the memo was updated, and is reread from disk
+        utils.memos.clear()
+        self.assertEqual(utils.md5_file(path, memo=True),
+                         '56e61c083c36939cc32bbecfdbadf036')
+        self.assert_(isinstance(utils.stat_key(path)[2], (int, long)))
+        shutil.rmtree(tmp_dir)
+
+    def test_md5_no_memo(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = join(tmp_dir, 'foo-1.0-1.egg')
+        open(path, 'wb').write('foo data')
+        self.assertEqual(utils.md5_file(path),
+                         '56e61c083c36939cc32bbecfdbadf036')
+        # no memo is written into (repository) directories
+        self.assertEqual(os.listdir(tmp_dir), ['foo-1.0-1.egg'])
+        shutil.rmtree(tmp_dir)
+
+    def test_prune_dirs(self):
+        tmp_dir = tempfile.mkdtemp()
+        prefix = join(tmp_dir, 'prefix')
+        sp = join(prefix, 'lib', 'site-packages')
+        files = [join(sp, 'foo', 'sub', 'deep', 'a.py'),
+                 join(sp, 'foo', 'b.py'),
+                 join(sp, 'shared', 'c.py'),
+                 join(sp, 'top.py'),
+                 join(prefix, 'bin', 'foo')]
+        for path in files:
+            if not isdir(dirname(path)):
+                os.makedirs(dirname(path))
+        # a file of another package
+        other = join(sp, 'shared', 'sub', 'other.py')
+        os.makedirs(dirname(other))
+        open(other, 'w').write('')
+        # outside of the roots
+        outside = join(tmp_dir, 'outside', 'x.py')
+
+        prune_dirs(files + [outside], set([prefix, sp]))
+        # the nested empty directories are removed
+        self.assert_(not isdir(join(sp, 'foo')))
+        self.assert_(not isdir(join(prefix, 'bin')))
+        # the shared directory is kept, and so are the roots
+        self.assert_(isfile(other))
+        self.assert_(isdir(sp))
+        self.assert_(isdir(prefix))
+        # nothing outside the roots is touched (or fails)
+        self.assertEqual(sorted(os.listdir(tmp_dir)), ['prefix'])
+        self.assertEqual(os.listdir(sp), ['shared'])
+
+        # empty roots are never removed
+        os.unlink(other)
+        prune_dirs([other, join(sp, 'shared', 'c.py')], set([prefix, sp]))
+        self.assertEqual(os.listdir(sp), [])
+        self.assert_(isdir(sp))
+        shutil.rmtree(tmp_dir)
+
+    def test_replace(self):
+        tmp_dir = tempfile.mkdtemp()
+        src, dst = join(tmp_dir, 'a.tmp'), join(tmp_dir, 'a')
+        platform = sys.platform
+        # IronPython, on which os.rename() does not replace files
+        sys.platform = 'cli'
+        try:
+            for data in 'AB':
+                open(src, 'w').write(data)
+                replace(src, dst)
+                self.assertEqual(open(dst).read(), data)
+        finally:
+            sys.platform = platform
+        self.assertEqual(os.listdir(tmp_dir), ['a'])
+        shutil.rmtree(tmp_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,74 @@
+import sys
+import shutil
+import tempfile
+import unittest
+import zipfile
+from cStringIO import StringIO
+from os.path import join
+
+from egginst import verify
+from egginst.main import EggInst
+
+
+class TestVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prefix = join(self.tmp_dir, 'prefix')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def install(self, fn, members):
+        path = join(self.tmp_dir, fn)
+        z = zipfile.ZipFile(path, 'w')
+        for arcname, data in members.iteritems():
+            z.writestr(arcname, data)
+        z.close()
+        ei = EggInst(path, prefix=self.prefix)
+        ei.install()
+        return ei
+
+    def verify(self, **kwargs):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            n = verify.verify(prefix=self.prefix, **kwargs)
+            return n, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_fixed_script(self):
+        ei = self.install('foo-1.0-1.egg', {
+                'foo/a.py': 'A',
+                'EGG-INFO/scripts/foo': '#!/usr/bin/python\nprint 1\n'})
+        self.assertEqual(self.verify(crc=True),
+                         (0, 'foo-1.0-1.egg: OK\n'))
+
+        # the size is unchanged
+        open(join(ei.site_packages, 'foo', 'a.py'), 'w').write('B')
+        n, out = self.verify(crc=True)
+        self.assertEqual(n, 1)
+        self.assert_('modified: Lib\\site-packages/foo/a.py' in out)
+
+    def test_error(self):
+        self.install('foo-1.0-1.egg', {'foo/a.py': 'A'})
+        self.install('bar-1.0-1.egg', {'bar/b.py': 'B'})
+        verify_package = verify.verify_package
+        def failing(ei, recorded, crc=False):
+            if ei.cname == 'bar':
+                raise IOError("cannot read")
+            return verify_package(ei, recorded, crc)
+        verify.verify_package = failing
+        try:
+            n, out = self.verify()
+        finally:
+            verify.verify_package = verify_package
+        # the error is reported for the package, the others are verified
+        self.assertEqual(n, 1)
+        self.assert_('bar-1.0-1.egg: Error: cannot read' in out)
+        self.assert_('foo-1.0-1.egg: OK' in out)
+
+
+if __name__ == '__main__':
+    unittest.main()